@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+## Button input benchmark
+# Plays bouncing button presses into fake RPi.GPIO from another thread, as
+# the real library's edge thread would, through turret.buttons.Buttons on
+# a running reactor. Reports presses seen against presses played, bounce
+# edges filtered and edge-to-callback latency as JSON.
+import json
+import os
+import random
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+
+from twisted.internet import reactor, task, threads
+
+from turret import backends
+from turret.buttons import Buttons
+from turret.loopstats import Histogram
+from turret.timing import monotonic
+
+
+def script(fake_gpio, pins, presses, bounces, seed=3):
+    """ Steps for `presses` presses spread over pins, each chattering """
+    rng = random.Random(seed)
+    steps = []
+    for i in range(presses):
+        steps += fake_gpio.press(rng.choice(pins), hold=rng.uniform(0.03, 0.15),
+                                 bounces=rng.randint(0, bounces), after=rng.uniform(0.02, 0.1))
+    return steps
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--presses", type=int, default=200)
+    parser.add_argument("--bounces", type=int, default=5, help="most chatter edges per make/break")
+    parser.add_argument("--debounce", type=float, default=0.02, help="seconds")
+    parser.add_argument("--load", type=float, default=0.002,
+                        help="seconds of work per 10 ms reactor tick, to compete with")
+    args = parser.parse_args()
+
+    gpio = backends.get("sim").gpio() # fake_gpio
+    buttons = Buttons(gpio)
+    pins = [5, 6, 13, 19, 26]
+    steps = script(gpio, pins, args.presses, args.bounces)
+    injector = gpio.EdgeInjector(steps)
+    seen = {"pressed": 0, "released": 0}
+    since_press = Histogram() # press edge played to pressed callback
+    def pressed(pin):
+        now = monotonic()
+        seen["pressed"] += 1
+        for t, channel, level in reversed(injector.played):
+            if channel == pin and level:
+                since_press.add(now - t)
+                break
+    def released(pin):
+        seen["released"] += 1
+    for pin in pins:
+        buttons.add(pin, lambda pin=pin: pressed(pin), lambda pin=pin: released(pin),
+                    debounce=args.debounce)
+
+    def busy():
+        end = monotonic() + args.load
+        while monotonic() < end:
+            pass
+    load = task.LoopingCall(busy)
+    load.start(0.01)
+
+    def report(_):
+        load.stop()
+        ms = 1e3
+        print(json.dumps({"config": vars(args),
+                          "played": {"presses": args.presses, "edges": len(steps)},
+                          "seen": seen,
+                          "buttons": buttons.stats(),
+                          "press_latency_p50_ms": since_press.percentile(50) * ms,
+                          "press_latency_p99_ms": since_press.percentile(99) * ms,
+                          "press_latency_max_ms": since_press.max * ms},
+                         indent=2, sort_keys=True))
+        reactor.stop()
+
+    def finished():
+        injector.join()
+    injector.start()
+    d = threads.deferToThread(finished)
+    d.addCallback(lambda _: task.deferLater(reactor, args.debounce * 2, lambda: None))
+    d.addCallback(report)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
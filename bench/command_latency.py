@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+## End-to-end command latency benchmark
+# Runs the net_controller server on simulated hardware (fake PCA9685 bus,
+# fake RPi.GPIO and optionally fake pigpio, all timestamping their writes),
+# drives it over loopback AMP with the real command definitions, and reports
+# command-to-actuation latency, sustained command rate and CPU per command
+# as JSON. Client and server share one process and one reactor, so the CPU
+# figure covers both ends.
+import json
+import os
+import resource
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+
+from turret import backends
+from turret.timing import monotonic
+
+
+class Probe(object):
+    """ Write log that fires a Deferred on the first entry matching a test """
+    def __init__(self):
+        self.pending = None
+
+    def append(self, entry):
+        if self.pending is not None and self.pending[0](entry):
+            match, d, timeout = self.pending
+            self.pending = None
+            timeout.cancel()
+            d.callback(entry[0])
+
+    def wait_for(self, match, timeout=2.0):
+        from twisted.internet import defer, reactor
+        d = defer.Deferred()
+        def expire():
+            self.pending = None
+            d.errback(RuntimeError("no actuation within {}s".format(timeout)))
+        self.pending = (match, d, reactor.callLater(timeout, expire))
+        return d
+
+
+def percentiles(samples):
+    ms = sorted(s * 1e3 for s in samples)
+    if not ms:
+        return {"n": 0}
+    def pct(p):
+        return ms[min(len(ms) - 1, int(p / 100.0 * len(ms)))]
+    return {"n": len(ms), "mean_ms": sum(ms) / len(ms), "p50_ms": pct(50),
+            "p90_ms": pct(90), "p99_ms": pct(99), "max_ms": ms[-1]}
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--samples", type=int, default=100, help="latency samples per axis")
+    parser.add_argument("--pan-samples", type=int, default=20, help="pan samples (each waits for a deceleration)")
+    parser.add_argument("--flood", type=int, default=5000, help="commands in the throughput run")
+    parser.add_argument("--pigpio", action="store_true", help="use the pigpio wave stepper")
+    parser.add_argument("-o", "--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    from twisted.internet import defer, reactor, task
+    from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+    from twisted.protocols import amp
+
+    import net_controller
+    from commands import (TiltCommand, PanCommand, StopTiltCommand, StopPanCommand,
+                          FireCommand, StatsCommand)
+    from turret import Turret
+
+    backend = backends.get("sim-pigpio" if args.pigpio else "sim")
+    factory = net_controller.TurretControlFactory(lambda: Turret(backend=backend))
+    factory.protocol = net_controller.TurretControlProtocol
+    port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+    turret = factory.turret
+
+    probe = Probe()
+    backend.i2c_device().log = probe
+    backend.gpio().log = probe
+    stepper = turret.stepper
+    if args.pigpio:
+        stepper.pi.log = probe
+
+    fire = turret.fire
+    def stamped_fire():
+        probe.append((monotonic(), "fire"))
+        fire()
+    turret.fire = stamped_fire
+
+    tilt_registers = range(0x06, 0x06 + 4*2) # channels 0 and 1
+    def tilt_write(entry):
+        return len(entry) == 3 and isinstance(entry[1], int) and entry[1] in tilt_registers
+    step_pins = tuple(stepper.step_pins)
+    def pan_write(entry):
+        if args.pigpio:
+            return entry[1] == "wave_chain"
+        return entry[1] == step_pins and any(entry[2])
+    def fire_call(entry):
+        return entry[1] == "fire"
+
+    def sleep(seconds):
+        return task.deferLater(reactor, seconds, lambda: None)
+
+    @defer.inlineCallbacks
+    def latency(proto, command, kwargs, match, n, stop=None, settle=None):
+        samples = []
+        for i in range(n):
+            d = probe.wait_for(match)
+            t = monotonic()
+            proto.callRemote(command, **kwargs(i))
+            actuated = yield d
+            samples.append(actuated - t)
+            if stop is not None:
+                proto.callRemote(stop)
+            if settle is not None:
+                yield settle()
+        defer.returnValue(percentiles(samples))
+
+    @defer.inlineCallbacks
+    def settle_pan():
+        while stepper.is_moving():
+            yield sleep(0.01)
+
+    @defer.inlineCallbacks
+    def flood(proto, n):
+        cpu = cpu_seconds()
+        t = monotonic()
+        for i in range(n):
+            if i % 2:
+                proto.callRemote(StopTiltCommand)
+            else:
+                proto.callRemote(TiltCommand, speed=float(10 + i % 50))
+        yield proto.callRemote(StatsCommand) # answered after everything before it
+        elapsed = monotonic() - t
+        cpu = cpu_seconds() - cpu
+        defer.returnValue({"commands": n, "seconds": elapsed, "commands_per_s": n / elapsed,
+                           "cpu_us_per_command": cpu / n * 1e6})
+
+    @defer.inlineCallbacks
+    def run(proto):
+        results = {"config": {"samples": args.samples, "pan_samples": args.pan_samples,
+                              "flood": args.flood,
+                              "stepper": "pigpio" if args.pigpio else "gpio",
+                              "python": sys.version.split()[0]}}
+        yield sleep(0.1)
+        results["tilt"] = yield latency(
+            proto, TiltCommand, lambda i: {"speed": 45.0 if i % 2 else -45.0}, tilt_write,
+            args.samples, StopTiltCommand, lambda: sleep(2 * turret.tilt_delay))
+        results["pan"] = yield latency(
+            proto, PanCommand, lambda i: {"speed": 45.0 if i % 2 else -45.0}, pan_write,
+            args.pan_samples, StopPanCommand, settle_pan)
+        results["fire"] = yield latency(proto, FireCommand, lambda i: {}, fire_call, args.samples)
+        results["throughput"] = yield flood(proto, args.flood)
+        stats = yield proto.callRemote(StatsCommand)
+        stats = json.loads(stats["stats"])
+        results["loops"] = stats["loops"]
+        results["turrets"] = stats["turrets"]
+        defer.returnValue(results)
+
+    def report(results):
+        text = json.dumps(results, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+
+    outcome = []
+    def done(result):
+        outcome.append(result)
+        reactor.stop()
+
+    endpoint = TCP4ClientEndpoint(reactor, "127.0.0.1", port.getHost().port)
+    d = connectProtocol(endpoint, amp.AMP())
+    d.addCallback(run)
+    d.addCallback(report)
+    d.addErrback(lambda f: sys.stderr.write(f.getTraceback()))
+    d.addBoth(done)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+## Input shaping benchmark
+# Replays input traces through turret_client.InputShaper on a fake clock
+# and counts the commands and AMP bytes that would go on the wire, for a
+# few shaping settings against sending every sample. Traces are JSON lines
+# of [seconds, axis, speed]; without --trace, a gamepad trace (100 Hz stick
+# samples with sensor noise) and a key-repeat trace (30 Hz repeats of a
+# fixed speed) are generated. Reports per trace and setting as JSON.
+import json
+import os
+import random
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+
+from twisted.internet import task
+from twisted.protocols import amp
+
+from commands import TiltCommand, PanCommand, StopTiltCommand, StopPanCommand
+from turret_client import InputShaper
+
+settings = {"every sample": dict(on_change=False),
+            "on change": dict(),
+            "deadband + step": dict(deadband=2.0, step=1.0),
+            "deadband + step + 50ms": dict(deadband=2.0, step=1.0, min_interval=0.05)}
+
+commands = {"tilt": (TiltCommand, StopTiltCommand), "pan": (PanCommand, StopPanCommand)}
+
+
+def wire_bytes(command, **arguments):
+    """ Size of the AMP box a client sends for command """
+    box = command.makeArguments(arguments, None)
+    box[amp.COMMAND] = command.commandName
+    return len(box.serialize())
+
+def gamepad(seconds=20.0, rate=100.0, seed=1):
+    """ Both stick axes sampled together: rests, holds and sweeps, plus noise """
+    rng = random.Random(seed)
+    trace = []
+    for axis in ("tilt", "pan"):
+        t, speed = 0.0, 0.0
+        while t < seconds:
+            kind = rng.choice(("rest", "hold", "sweep"))
+            length = rng.uniform(0.5, 2.0)
+            goal = 0.0 if kind == "rest" else rng.uniform(-90.0, 90.0)
+            start, end = speed, goal
+            n = int(length * rate)
+            for i in range(n):
+                if kind == "sweep":
+                    speed = start + (end - start) * (i + 1.0) / n
+                else:
+                    speed = goal
+                trace.append((t, axis, speed + rng.gauss(0.0, 0.6)))
+                t += 1.0 / rate
+    return sorted(trace)
+
+def key_repeat(seconds=20.0, rate=30.0, delay=0.5, seed=2):
+    """ Arrow keys held and let go: a sample per repeat, then one zero """
+    rng = random.Random(seed)
+    trace = []
+    t = 0.0
+    while t < seconds:
+        axis = rng.choice(("tilt", "pan"))
+        speed = rng.choice((-45.0, 45.0))
+        held = rng.uniform(0.2, 2.0)
+        trace.append((t, axis, speed))
+        repeat = t + delay
+        while repeat < t + held:
+            trace.append((repeat, axis, speed))
+            repeat += 1.0 / rate
+        t += held
+        trace.append((t, axis, 0.0))
+        t += rng.uniform(0.2, 1.0)
+    return trace
+
+def load(path):
+    with open(path) as f:
+        return [tuple(json.loads(line)) for line in f if line.strip()]
+
+def replay(trace, options):
+    clock = task.Clock()
+    sent = {"commands": 0, "bytes": 0}
+    shapers = {}
+    def sender(axis):
+        move, stop = commands[axis]
+        def send(speed):
+            sent["commands"] += 1
+            sent["bytes"] += wire_bytes(move, speed=speed) if speed else wire_bytes(stop)
+        return send
+    for t, axis, speed in trace:
+        clock.advance(max(0.0, t - clock.seconds()))
+        if axis not in shapers:
+            shapers[axis] = InputShaper(sender(axis), clock=clock, **options)
+        shapers[axis].update(speed)
+    clock.advance(1.0) # let held-back sends go
+    samples = sum(s.samples for s in shapers.values())
+    suppressed = sum(s.summary()["suppressed"] for s in shapers.values())
+    return dict(sent, samples=samples, suppressed=suppressed)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", action="append", default=[], help="JSON lines [seconds, axis, speed]")
+    args = parser.parse_args()
+
+    if args.trace:
+        traces = dict((os.path.basename(path), load(path)) for path in args.trace)
+    else:
+        traces = {"gamepad": gamepad(), "key repeat": key_repeat()}
+    results = {"config": {"settings": settings, "python": sys.version.split()[0]}, "traces": {}}
+    for name, trace in sorted(traces.items()):
+        runs = dict((setting, replay(trace, options)) for setting, options in settings.items())
+        baseline = float(runs["every sample"]["bytes"]) or 1.0
+        for run in runs.values():
+            run["bytes_vs_every_sample"] = run["bytes"] / baseline
+        results["traces"][name] = runs
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
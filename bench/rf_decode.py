@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+## 433 MHz decode benchmark
+# Builds a synthetic receiver edge stream (fob presses, each a burst of code
+# repeats, buried in random radio noise) and decodes it three ways: rx's
+# per-edge callback, bulk_rx fed ticks in batches, and bulk_rx reading
+# pigpio notification reports through a pipe. Checks all three find the same
+# (code, bits, gap, t0, t1) and reports the CPU each took, as JSON. The rx
+# figure is its decoding alone, called directly; on a Pi, pigpio's per-edge
+# socket read and thread dispatch come on top of it.
+import fcntl
+import json
+import os
+import random
+import struct
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "remote"))
+
+from turret import fake_pigpio
+import _433
+
+GPIO = 3
+
+
+def code_edges(code, bits=24, repeats=6, gap=9000, t0=300, t1=900, jitter=40, rng=random):
+    """ Edge lengths (us) for one press, as tx.send would transmit it """
+    lengths = []
+    for r in range(repeats):
+        lengths += [t0, gap]
+        for i in range(bits - 1, -1, -1):
+            pair = (t1, t0) if code >> i & 1 else (t0, t1)
+            lengths += [n + rng.randint(-jitter, jitter) for n in pair]
+    lengths += [t0, gap]
+    return lengths
+
+def noise_edges(seconds, rate, rng=random):
+    """ Random edges at about `rate` per second for `seconds` """
+    lengths = []
+    total = 0.0
+    while total < seconds * 1e6:
+        n = int(rng.expovariate(rate / 1e6)) + 150 # the glitch filter's floor
+        lengths.append(n)
+        total += n
+    return lengths
+
+def signal(presses, noise, seed=4):
+    """ (ticks, codes sent) for `presses` presses, a second apart, in noise """
+    rng = random.Random(seed)
+    lengths = []
+    codes = []
+    for i in range(presses):
+        code = rng.getrandbits(24)
+        codes.append(code)
+        lengths += noise_edges(1.0, noise, rng) if noise else [20000]
+        lengths += code_edges(code, rng=rng)
+    ticks = []
+    tick = 0xFFFFFFFF - 5000000 # wraps during the run, like the real counter
+    for n in lengths:
+        tick = (tick + n) & 0xFFFFFFFF
+        ticks.append(tick)
+    return ticks, codes
+
+# process CPU time, fine grained enough to sum over many short polls
+cpu = getattr(time, "process_time", None) or time.clock
+
+def per_edge(ticks, start):
+    found = []
+    rx = _433.rx(fake_pigpio.pi(), GPIO, lambda *details: found.append(details))
+    rx._last_edge_tick = start
+    t = cpu()
+    level = 0
+    for tick in ticks:
+        level ^= 1
+        rx._cbf(GPIO, level, tick)
+    return found, cpu() - t
+
+def batched(ticks, start, batch):
+    found = []
+    rx = _433.bulk_rx(None, GPIO, lambda *details: found.append(details), start_tick=start)
+    t = cpu()
+    for i in range(0, len(ticks), batch):
+        rx.feed(ticks[i:i + batch])
+    return found, cpu() - t
+
+def piped(ticks, start, batch):
+    found = []
+    r, w = os.pipe()
+    fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+    source = _433.notify_edges(None, GPIO, fd=r)
+    rx = _433.bulk_rx(None, GPIO, lambda *details: found.append(details),
+                      source=source, start_tick=start)
+    report = struct.Struct("HHII")
+    reports = [report.pack(i & 0xFFFF, 0, tick, (i & 1) << GPIO) for i, tick in enumerate(ticks)]
+    elapsed = 0.0
+    for i in range(0, len(reports), batch):
+        os.write(w, b"".join(reports[i:i + batch])) # the daemon's side, not timed
+        t = cpu()
+        rx.poll()
+        elapsed += cpu() - t
+    os.close(w)
+    os.close(r)
+    return found, elapsed
+
+def best(runs, decode, *args):
+    """ (results, least CPU) over `runs` runs, as other load only adds time """
+    results = [decode(*args) for i in range(runs)]
+    return results[0][0], min(elapsed for found, elapsed in results)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--presses", type=int, default=50)
+    parser.add_argument("--noise", default="0,2000,10000", help="noise edges per second to try")
+    parser.add_argument("--batch", type=int, default=1024, help="edges per batch (pipe: per write)")
+    parser.add_argument("-r", "--runs", type=int, default=5, help="keep the best of this many")
+    args = parser.parse_args()
+
+    results = {"config": {"presses": args.presses, "batch": args.batch, "runs": args.runs,
+                          "python": sys.version.split()[0]}, "runs": []}
+    for noise in [int(n) for n in args.noise.split(",")]:
+        ticks, codes = signal(args.presses, noise)
+        start = (ticks[0] - 20000) & 0xFFFFFFFF
+        base, base_cpu = best(args.runs, per_edge, ticks, start)
+        bulk, bulk_cpu = best(args.runs, batched, ticks, start, args.batch)
+        # keep each write inside the pipe's buffer
+        pipe, pipe_cpu = best(args.runs, piped, ticks, start, min(args.batch, 4096))
+        us = 1e6 / len(ticks)
+        results["runs"].append({
+            "noise_edges_per_s": noise, "edges": len(ticks),
+            "codes": len(base), "presses_found": len(set(c[0] for c in base) & set(codes)),
+            "same_results": base == bulk == pipe,
+            "per_edge_us": {"rx": base_cpu * us, "bulk_rx": bulk_cpu * us, "bulk_rx_pipe": pipe_cpu * us},
+            "speedup": {"bulk_rx": base_cpu / max(bulk_cpu, 1e-9),
+                        "bulk_rx_pipe": base_cpu / max(pipe_cpu, 1e-9)}})
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+## RF fob remote benchmark
+# Records a synthetic session of fob taps and holds in radio noise as a
+# capture (remote/rf_capture.py), then plays it in real time the way pigpio
+# would deliver it: notification reports written to a pipe, which the
+# reactor watches through EdgeReader, decoded by bulk_rx and turned into
+# turret actions by FobRemote on a simulated Turret. Reports presses seen
+# against presses played, repeats suppressed, and the latency from the
+# first edge of a press to its motion being commanded, and from the last
+# repeat to the stop, as JSON.
+import fcntl
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "remote"))
+
+from twisted.internet import reactor, task
+
+from rf_decode import code_edges, noise_edges, GPIO
+import _433
+import rf_capture
+from turret import Turret
+from turret.loopstats import Histogram
+from turret.rf_remote import FobRemote, EdgeReader
+
+REPEAT = 0.0381 # seconds per code repeat, at rf_decode's default timings
+
+
+def session(buttons, presses, noise, seed=5):
+    """ (lengths, played): edge lengths (us) for `presses` taps and holds
+    of buttons' codes, and (code, first edge, last edge, hold) per press,
+    in us from the start """
+    rng = random.Random(seed)
+    lengths = []
+    played = []
+    elapsed = 0
+    for i in range(presses):
+        quiet = noise_edges(rng.uniform(0.3, 0.8), noise, rng) if noise else [400000]
+        code = rng.choice(buttons)
+        hold = rng.random() < 0.5
+        repeats = int(rng.uniform(0.3, 1.2) / REPEAT) if hold else 6
+        burst = code_edges(code, repeats=repeats, rng=rng)
+        elapsed += sum(quiet)
+        first = elapsed + burst[0]
+        elapsed += sum(burst)
+        lengths += quiet + burst
+        played.append((code, first, elapsed - burst[-1], hold))
+    lengths.append(400000) # let the last release happen
+    return lengths, played
+
+def write(path, lengths, start):
+    writer = rf_capture.CaptureWriter(path, GPIO, 150, start=start)
+    tick = start
+    for i, n in enumerate(lengths):
+        tick = (tick + n) & 0xFFFFFFFF
+        writer.add(tick, (i & 1) ^ 1)
+    writer.close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--presses", type=int, default=20)
+    parser.add_argument("--noise", type=int, default=2000, help="noise edges per second")
+    parser.add_argument("--holdoff", type=float, default=0.15, help="seconds")
+    parser.add_argument("--load", type=float, default=0.002,
+                        help="seconds of work per 10 ms reactor tick, to compete with")
+    args = parser.parse_args()
+
+    rng = random.Random(6)
+    buttons = [rng.getrandbits(24) for i in range(5)]
+    lengths, played = session(buttons, args.presses, args.noise)
+    fd, path = tempfile.mkstemp(suffix=".rfc")
+    os.close(fd)
+    write(path, lengths, 0)
+    capture = rf_capture.Capture(path)
+
+    # the daemon's side: reports into a pipe the decoder reads
+    r, w = os.pipe()
+    fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+    report = struct.Struct("HHII")
+    sequence = [0]
+    def deliver(ticks):
+        first = sequence[0]
+        sequence[0] += len(ticks)
+        os.write(w, b"".join(report.pack(i & 0xFFFF, 0, tick, ((i & 1) ^ 1) << GPIO)
+                            for i, tick in enumerate(ticks, first)))
+    decoder = _433.bulk_rx(None, GPIO, None, source=_433.notify_edges(None, GPIO, fd=r),
+                           start_tick=capture.start)
+    reader = EdgeReader(decoder)
+
+    turret = Turret(backend="sim")
+    remote = FobRemote(args.holdoff)
+    decoder.cb = remote.code
+    events = [] # (seconds, "press"/"release", code)
+    def action(code, move, kind):
+        def act():
+            move()
+            events.append((reactor.seconds(), kind, code))
+        return act
+    moves = [(lambda: turret.tilt(45), turret.stop_tilt), (lambda: turret.tilt(-45), turret.stop_tilt),
+             (lambda: turret.pan_at(-45), turret.stop_pan), (lambda: turret.pan_at(45), turret.stop_pan),
+             (turret.fire, None)]
+    for code, (move, stop) in zip(buttons, moves):
+        remote.add(code, action(code, move, "press"),
+                   action(code, stop, "release") if stop else action(code, lambda: None, "release"))
+
+    def busy():
+        end = reactor.seconds() + args.load
+        while reactor.seconds() < end:
+            pass
+    load = task.LoopingCall(busy)
+    load.start(0.01)
+
+    def report_results(edges):
+        load.stop()
+        reader.stop()
+        capture.close()
+        os.close(w)
+        os.close(r)
+        os.remove(path)
+        press_latency = Histogram()
+        release_latency = Histogram()
+        found = missed = extra = 0
+        for i, (code, first, last, hold) in enumerate(played):
+            start = began + first / 1e6
+            end = began + (played[i + 1][1] / 1e6 if i + 1 < len(played) else 1e9)
+            presses = [t for t, kind, c in events if kind == "press" and c == code and start <= t < end]
+            releases = [t for t, kind, c in events if kind == "release" and c == code and start <= t < end]
+            if not presses:
+                missed += 1
+                continue
+            found += 1
+            extra += len(presses) - 1
+            press_latency.add(presses[0] - start)
+            if releases:
+                release_latency.add(releases[-1] - (began + last / 1e6))
+        ms = 1e3
+        print(json.dumps({
+            "config": vars(args),
+            "played": {"presses": len(played), "holds": sum(1 for p in played if p[3]),
+                       "edges": edges},
+            "seen": {"presses": found, "missed": missed, "extra_presses": extra,
+                     "releases": sum(1 for e in events if e[1] == "release")},
+            "remote": remote.stats(),
+            "reader": {"reads": reader.reads, "edges": reader.edges},
+            "press_to_motion_p50_ms": press_latency.percentile(50) * ms,
+            "press_to_motion_p99_ms": press_latency.percentile(99) * ms,
+            "press_to_motion_max_ms": press_latency.max * ms,
+            "release_to_stop_p50_ms": release_latency.percentile(50) * ms,
+            "release_to_stop_max_ms": release_latency.max * ms},
+            indent=2, sort_keys=True))
+        reactor.stop()
+
+    reader.start()
+    began = reactor.seconds()
+    d = rf_capture.replay_on_reactor(capture, deliver)
+    d.addCallback(report_results)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
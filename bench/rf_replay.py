@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+## 433 MHz capture replay benchmark
+# Writes a large synthetic capture (rf_decode's fob presses in noise) with
+# remote/rf_capture.py, then times opening it and replaying it through the
+# decoder at full speed: bulk_rx as is, bulk_rx behind a stricter glitch
+# filter, and rx's per-edge decoding for comparison. Also replays it under a
+# few slack settings to show the kind of tuning captures are for. Reports
+# edges per second (wall clock) as JSON.
+import json
+import os
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "remote"))
+
+from turret import fake_pigpio
+from rf_decode import signal, GPIO
+import _433
+import rf_capture
+
+
+def timed(f, *args):
+    t = time.time()
+    result = f(*args)
+    return result, time.time() - t
+
+def write(path, ticks, start):
+    writer = rf_capture.CaptureWriter(path, GPIO, 150, start=start)
+    levels = bytearray((i & 1) ^ 1 for i in range(len(ticks)))
+    step = 4096 # about what one notify_edges read brings in, under load
+    for i in range(0, len(ticks), step):
+        writer.extend(ticks[i:i + step], levels[i:i + step])
+    writer.close()
+
+def decode(path, glitch=None, **tuning):
+    capture = rf_capture.Capture(path)
+    found = []
+    rx = _433.bulk_rx(None, GPIO, lambda *details: found.append(details[0]),
+                      start_tick=capture.start)
+    for name, value in tuning.items():
+        setattr(rx, name, value)
+    rf_capture.replay(capture, rx.feed, glitch=glitch)
+    capture.close()
+    return found
+
+def per_edge(path):
+    capture = rf_capture.Capture(path)
+    found = []
+    rx = _433.rx(fake_pigpio.pi(), GPIO, lambda *details: found.append(details[0]))
+    rx._last_edge_tick = capture.start
+    for ticks, levels in capture.chunks():
+        for tick, level in zip(ticks, levels):
+            rx._cbf(GPIO, level, tick)
+    capture.close()
+    return found
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--presses", type=int, default=200)
+    parser.add_argument("--noise", type=int, default=10000, help="noise edges per second")
+    parser.add_argument("--keep", help="write the capture here and keep it")
+    args = parser.parse_args()
+
+    ticks, codes = signal(args.presses, args.noise)
+    start = (ticks[0] - 20000) & 0xFFFFFFFF
+    path = args.keep
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=".rfc")
+        os.close(fd)
+    try:
+        nothing, write_s = timed(write, path, ticks, start)
+        capture, open_s = timed(rf_capture.Capture, path)
+        capture.close()
+        edges = len(ticks)
+        rate = lambda seconds: edges / max(seconds, 1e-9)
+        found, bulk_s = timed(decode, path)
+        filtered, glitch_s = timed(decode, path, 200)
+        slow, rx_s = timed(per_edge, path)
+        sweep = {}
+        for slack in (0.1, 0.2, 0.3, 0.4):
+            tuned = decode(path, slack_0=slack, slack_1=slack)
+            sweep["slack {}".format(slack)] = {"codes": len(tuned),
+                                               "presses_found": len(set(tuned) & set(codes))}
+        results = {
+            "config": {"presses": args.presses, "noise_edges_per_s": args.noise,
+                       "python": sys.version.split()[0]},
+            "capture": {"edges": edges, "bytes": os.path.getsize(path),
+                        "bytes_per_edge": os.path.getsize(path) / float(edges),
+                        "write_edges_per_s": rate(write_s), "open_ms": open_s * 1e3},
+            "replay_edges_per_s": {"bulk_rx": rate(bulk_s), "bulk_rx_glitch_200": rate(glitch_s),
+                                   "rx_per_edge": rate(rx_s)},
+            "codes": len(found), "presses_found": len(set(found) & set(codes)),
+            "same_as_rx": found == slow,
+            "slack_sweep": sweep}
+    finally:
+        if not args.keep and os.path.exists(path):
+            os.remove(path)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
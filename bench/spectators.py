@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+## Spectator benchmark
+# Runs the server on simulated hardware with the tilt sweeping back and forth,
+# and for each spectator count starts a second process holding that many AMP
+# connections subscribed to telemetry. Reports the tilt loop's lateness and
+# the telemetry frames and bytes sent per count as JSON, to show spectators
+# don't add jitter to the control loop.
+import json
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+
+from twisted.internet import reactor, defer, protocol, task
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.protocols import amp
+
+from commands import TelemetryCommand, TelemetryFrame
+
+
+class Spectator(amp.AMP):
+    received = 0
+
+    @TelemetryFrame.responder
+    def frame(self, turret, seq, time, **fields):
+        Spectator.received += 1
+        return {}
+
+
+def child(port, n):
+    """ Hold n telemetry subscriptions until killed """
+    @defer.inlineCallbacks
+    def watch():
+        endpoint = TCP4ClientEndpoint(reactor, "127.0.0.1", port)
+        for i in range(n):
+            proto = yield connectProtocol(endpoint, Spectator())
+            yield proto.callRemote(TelemetryCommand)
+        sys.stdout.write("ready\n")
+        sys.stdout.flush()
+    watch().addErrback(lambda f: (sys.stderr.write(f.getTraceback()), reactor.stop()))
+    reactor.run()
+
+
+class Child(protocol.ProcessProtocol):
+    def __init__(self):
+        self.ready = defer.Deferred()
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        if b"ready" in data and not self.ready.called:
+            self.ready.callback(None)
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--counts", default="0,10,100,300", help="spectator counts to try")
+    parser.add_argument("-s", "--seconds", type=float, default=3.0, help="sweep time per count")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        return child(args.port, args.child)
+
+    import net_controller
+    from turret import Turret, loopstats
+
+    factory = net_controller.TurretControlFactory(lambda: Turret(backend="sim"))
+    factory.protocol = net_controller.TurretControlProtocol
+    port = reactor.listenTCP(0, factory, interface="127.0.0.1", backlog=1024)
+    controller = factory.controller()
+
+    def sweep(speed=[90.0]):
+        speed[0] = -speed[0]
+        controller.Tilt(speed[0])
+    sweeper = task.LoopingCall(sweep)
+
+    @defer.inlineCallbacks
+    def run():
+        results = {"config": {"seconds": args.seconds, "python": sys.version.split()[0]}, "runs": []}
+        for n in [int(c) for c in args.counts.split(",")]:
+            proc = Child()
+            reactor.spawnProcess(proc, sys.executable,
+                                 [sys.executable, os.path.abspath(__file__),
+                                  "--child", str(n), "--port", str(port.getHost().port)],
+                                 env=os.environ)
+            yield proc.ready
+            for stats in loopstats.loops.values():
+                stats.reset()
+            before = factory.command_stats()["telemetry"]
+            sweeper.start(1.0)
+            yield sleep(args.seconds)
+            sweeper.stop()
+            loops = loopstats.summary()
+            after = factory.command_stats()["telemetry"]
+            results["runs"].append({"spectators": n,
+                                    "tilt": loops["tilt"],
+                                    "frames": after["frames"] - before["frames"],
+                                    "skipped": after["skipped"] - before["skipped"],
+                                    "bytes": after["bytes"] - before["bytes"]})
+            proc.transport.signalProcess("TERM")
+            yield proc.ended
+            yield sleep(0.2) # let the server see the hangups
+        defer.returnValue(results)
+
+    def report(results):
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    d = run()
+    d.addCallback(report)
+    d.addErrback(lambda f: sys.stderr.write(f.getTraceback()))
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
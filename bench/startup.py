@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+## Server startup benchmark
+# Starts net_controller.py as a fresh process, over and over, and times how
+# long it takes from exec to the first accepted TCP connection and to the
+# first answered KeepalivePing. Reports min/median/max of each as JSON.
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+
+from twisted.protocols import amp
+
+from commands import KeepalivePing
+from turret.timing import monotonic
+
+
+def ping_box(tag="1"):
+    """ The bytes an AMP client sends for a KeepalivePing """
+    box = amp.AmpBox(_command=KeepalivePing.commandName, _ask=tag)
+    return box.serialize()
+
+def connect(port, deadline):
+    """ Keep trying until the server accepts; returns the socket """
+    while True:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(("127.0.0.1", port))
+            return s
+        except socket.error:
+            s.close()
+            if monotonic() > deadline:
+                raise RuntimeError("server did not come up")
+            time.sleep(0.002)
+
+def read_answer(s, deadline):
+    data = b""
+    while b"_answer" not in data or not data.endswith(b"\x00\x00"):
+        s.settimeout(max(0.01, deadline - monotonic()))
+        chunk = s.recv(4096)
+        if not chunk:
+            raise RuntimeError("server closed the connection")
+        data += chunk
+    return data
+
+def run_once(args, port):
+    command = [sys.executable, os.path.join(root, "net_controller.py"), "--port", str(port)]
+    command += args.server_args
+    with open(os.devnull, "w") as devnull:
+        t = monotonic()
+        server = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+        try:
+            deadline = t + args.timeout
+            s = connect(port, deadline)
+            accepted = monotonic() - t
+            s.sendall(ping_box())
+            read_answer(s, deadline)
+            answered = monotonic() - t
+            s.close()
+        finally:
+            server.terminate()
+            server.wait()
+    return accepted, answered
+
+def describe(samples):
+    ms = sorted(x * 1e3 for x in samples)
+    return {"min_ms": ms[0], "median_ms": ms[len(ms) // 2], "max_ms": ms[-1]}
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--runs", type=int, default=10)
+    parser.add_argument("-p", "--port", type=int, default=18750)
+    parser.add_argument("--timeout", type=float, default=20.0, help="seconds allowed per run")
+    parser.add_argument("server_args", nargs="*", help="passed on to net_controller.py (after --)")
+    args = parser.parse_args()
+
+    accepted, answered = [], []
+    for i in range(args.runs):
+        a, b = run_once(args, args.port)
+        accepted.append(a)
+        answered.append(b)
+    print(json.dumps({"config": {"runs": args.runs, "server_args": args.server_args,
+                                 "python": sys.version.split()[0]},
+                      "first_connection": describe(accepted),
+                      "first_ping": describe(answered)}, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
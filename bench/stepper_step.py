@@ -0,0 +1,42 @@
+#! /usr/bin/env python
+## Stepper.step micro-benchmark
+# Runs Stepper.step against the counting fake RPi.GPIO and reports steps per
+# second, next to the old one-GPIO.output-per-pin loop for comparison.
+import os
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "turret"))
+
+import fake_gpio
+from stepper import Stepper
+
+def per_pin_step(self, step_dir = 1):
+    """ Stepper.step as it used to be """
+    self.step_counter += step_dir
+    for pin in range(0,4):
+        io_pin=self.step_pins[pin]# Get GPIO
+        fake_gpio.output(io_pin, self.seq[self.step_counter%self.steps][pin])
+
+def run(step, stepper, n):
+    fake_gpio.reset_counters()
+    start = time.time()
+    for i in range(n):
+        step(stepper, 1)
+    elapsed = time.time() - start
+    return n / elapsed, fake_gpio.calls / float(n)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--steps", type=int, default=200000)
+    args = parser.parse_args()
+
+    stepper = Stepper(fake_gpio)
+    for name, step in (("per-pin", per_pin_step), ("bank", Stepper.step)):
+        rate, calls = run(step, stepper, args.steps)
+        print("{:>8}: {:>10.0f} steps/s  {:.0f} GPIO calls/step".format(name, rate, calls))
+
+if __name__ == "__main__":
+    main()
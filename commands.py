@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+## Turret control protocol
+# AMP commands understood by the turret server, shared with its clients.
+
+import struct
+
+from twisted.protocols.amp import Integer, Float, String, Unicode, Boolean, ListOf, Command
+
+
+class UnknownTurret(Exception):
+    """ No turret with the id a command asked for """
+
+class NotInControl(Exception):
+    """ Another client holds the control lease """
+
+# Every control command takes an optional turret id, for servers hosting a
+# fleet; without one it goes to the server's default turret. Only the
+# client holding the control lease may send them.
+turret_id = ('turret', Unicode(optional=True))
+turret_errors = {UnknownTurret: 'UNKNOWN_TURRET', NotInControl: 'NOT_IN_CONTROL'}
+
+class TiltCommand(Command):
+    arguments = [('speed', Float()), turret_id]
+    errors = turret_errors
+    requiresAnswer = False
+
+class PanCommand(Command):
+    arguments = [('speed', Float()), turret_id]
+    errors = turret_errors
+    requiresAnswer = False
+
+class StopTiltCommand(Command):
+    arguments = [turret_id]
+    errors = turret_errors
+    requiresAnswer = False
+
+class StopPanCommand(Command):
+    arguments = [turret_id]
+    errors = turret_errors
+    requiresAnswer = False
+
+class FireCommand(Command):
+    arguments = [turret_id]
+    errors = turret_errors
+    requiresAnswer = False
+
+class TiltToCommand(Command):
+    """ Tilt to an angle and answer on arrival. speed is in degrees per
+    second, 0 or absent for the axis's default; after deadline seconds
+    the move is stopped where it is and answered with arrived=False """
+    arguments = [('angle', Float()),
+                 ('speed', Float(optional=True)),
+                 ('deadline', Float(optional=True)),
+                 turret_id]
+    response = [('arrived', Boolean()), ('angle', Float())]
+    errors = turret_errors
+
+class PanToCommand(Command):
+    """ Pan the short way round to an angle; as TiltToCommand """
+    arguments = [('angle', Float()),
+                 ('speed', Float(optional=True)),
+                 ('deadline', Float(optional=True)),
+                 turret_id]
+    response = [('arrived', Boolean()), ('angle', Float())]
+    errors = turret_errors
+
+class AimCommand(Command):
+    """ Tilt and pan at once; arrived once both axes have """
+    arguments = [('tilt', Float()),
+                 ('pan', Float()),
+                 ('tilt_speed', Float(optional=True)),
+                 ('pan_speed', Float(optional=True)),
+                 ('deadline', Float(optional=True)),
+                 turret_id]
+    response = [('arrived', Boolean()), ('tilt', Float()), ('pan', Float())]
+    errors = turret_errors
+
+class KeepalivePing(Command):
+    """ Keeps the session (and control lease) alive; answered with the
+    server's clock, for round trip and clock offset measurement """
+    response = [('time', Float(optional=True))]
+
+class AcquireControlCommand(Command):
+    """ Take the control lease, if nobody else holds it. The lease lasts
+    `lease` seconds (the server's default if left out) past the holder's
+    last command or ping; a control command from a client while the lease
+    is free takes it too. """
+    arguments = [('lease', Float(optional=True))]
+    response = [('granted', Boolean()), ('lease', Float())]
+
+class ReleaseControlCommand(Command):
+    response = []
+
+class TelemetryCommand(Command):
+    """ Subscribe to TelemetryFrames for a turret, `rate` a second (the
+    server's default if left out, 0 to unsubscribe). The server sends fewer
+    while this connection's transport is backed up. """
+    arguments = [('rate', Float(optional=True)), turret_id]
+    errors = {UnknownTurret: 'UNKNOWN_TURRET'}
+    response = []
+
+class TelemetryFrame(Command):
+    """ Sent by the server to telemetry subscribers. Angles in degrees,
+    velocities in degrees per second, states "idle", "moving" or
+    "continuous", led the status LED's (r, g, b). Fields left out haven't
+    changed since this subscriber's previous frame for the turret; the
+    first frame has them all (but led only if the turret has an LED). """
+    arguments = [('turret', Unicode()),
+                 ('seq', Integer()),
+                 ('time', Float()),
+                 ('tilt', Float(optional=True)),
+                 ('tilt_velocity', Float(optional=True)),
+                 ('tilt_state', Unicode(optional=True)),
+                 ('pan', Float(optional=True)),
+                 ('pan_velocity', Float(optional=True)),
+                 ('pan_state', Unicode(optional=True)),
+                 ('led', ListOf(Float(), optional=True))]
+    requiresAnswer = False
+
+class StatsCommand(Command):
+    """ JSON object: "loops", timing per actuator loop keyed by loop name
+    (prefixed with the turret id in a fleet); "turrets", per turret id the
+    applied/dropped counts from command coalescing and its PWM chip's write
+    cache; "sessions", whether the control lease is held; "telemetry",
+    subscriber, frame and byte counts; and "udp" when control datagrams are
+    enabled """
+    response = [('stats', String())]
+
+
+## Binary control datagram
+# Continuous control over UDP: one fixed-size packet carries the whole
+# control state, so a lost packet is simply superseded by the next one.
+#   version  B   CONTROL_VERSION
+#   seq      I   per-sender sequence number, wrapping at 2**32
+#   time     d   sender's clock, seconds
+#   tilt     f   tilt speed, degrees per second (0 stops)
+#   pan      f   pan speed, degrees per second (0 stops)
+#   flags    B   FIRE_BIT: trigger held
+
+CONTROL_VERSION = 1
+FIRE_BIT = 0x01
+control_struct = struct.Struct("!BIdffB")
+
+def pack_control(seq, timestamp, tilt, pan, fire=False):
+    flags = FIRE_BIT if fire else 0
+    return control_struct.pack(CONTROL_VERSION, seq & 0xFFFFFFFF, timestamp, tilt, pan, flags)
+
+def unpack_control(data):
+    """ (seq, timestamp, tilt, pan, fire); ValueError if data isn't a control packet """
+    if len(data) != control_struct.size:
+        raise ValueError("control packet is {} bytes, not {}".format(len(data), control_struct.size))
+    version, seq, timestamp, tilt, pan, flags = control_struct.unpack(data)
+    if version != CONTROL_VERSION:
+        raise ValueError("control packet version {}".format(version))
+    return seq, timestamp, tilt, pan, bool(flags & FIRE_BIT)
+
+def seq_newer(seq, last):
+    """ True if seq comes after last, allowing for wraparound """
+    return 0 < ((seq - last) & 0xFFFFFFFF) < 0x80000000
@@ -1,83 +1,60 @@
 #! /usr/bin/env python
 ## Networked Turret Controller
-# acts as a server
+# command-line client: sends one set of commands, then keeps the session
+# alive for a while and reports the measured link
 from sys import stdout
 from twisted.python.log import startLogging, err
-from twisted.internet import reactor, task
-from twisted.internet.protocol import Factory
-from twisted.internet.endpoints import TCP4ClientEndpoint
-from twisted.application.internet import ClientService, backoffPolicy
+from twisted.internet import reactor
 
-from twisted.protocols.amp import Integer, Float, String, Boolean, Command
-from twisted.protocols import amp
+from turret_client import TurretClient, ControlSender
 
 import argparse
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    
-    parser.add_argument("-t", "--tilt", action="store", type=float)
-    parser.add_argument("-p", "--pan", action="store", type=float)
+
+    parser.add_argument("-t", "--tilt", action="store", type=float, help="degrees per second")
+    parser.add_argument("-p", "--pan", action="store", type=float,
+                        help="degrees per second, positive pans right (was a direction, 1 or -1)")
     parser.add_argument("-f", "--fire", action="store_true", default=False)
+    parser.add_argument("-u", "--udp", type=int, metavar="PORT",
+                        help="send tilt/pan/fire as control datagrams to this port")
+    parser.add_argument("-r", "--rate", type=float, default=50.0, help="datagrams per second")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8750)
+    parser.add_argument("--turret", help="turret id, for a fleet server")
     return parser.parse_args()
 
-class TiltCommand(Command):
-    arguments = [('speed', Float())]
-    requiresAnswer = False
-
-class PanCommand(Command):
-    arguments = [('speed', Float())]
-    requiresAnswer = False
-
-class StopTiltCommand(Command):
-    requiresAnswer = False
-
-class StopPanCommand(Command):
-    requiresAnswer = False
-
-class FireCommand(Command):
-    requiresAnswer = False
-
-class KeepalivePing(Command):
-    pass
-
-def connect():
-    endpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', 8750)
-    factory = Factory()
-    factory.protocol = amp.AMP
-    service = ClientService(endpoint, factory, retryPolicy=backoffPolicy(0.5, 15.0))
-    service.startService()
-    return service.whenConnected()
-
-def keepalive(p):
-    d = p.callRemote(KeepalivePing)
-
-def start_keepalive(p):
-    loop = task.LoopingCall(f=keepalive, a=p)
-    loop.start(3)
-
-def connected(p):
-    args = parse_args()
-    if args.tilt:
-        p.callRemote(TiltCommand, speed=args.tilt)
-    if args.pan:
-        p.callRemote(PanCommand, speed=args.pan)
-    if args.fire:
-        p.callRemote(FireCommand)
-
-    start_keepalive(p)
-    reactor.callLater(13,reactor.stop)
+def connected(client, args):
+    if args.udp:
+        sender = ControlSender(args.host, args.udp, args.rate)
+        reactor.listenUDP(0, sender)
+        sender.set(args.tilt or 0.0, args.pan or 0.0, args.fire)
+    else:
+        if args.tilt:
+            client.tilt(args.tilt)
+        if args.pan:
+            client.pan(args.pan)
+        if args.fire:
+            client.fire()
+
+    def report():
+        print("link: {}".format(client.link.summary()))
+        reactor.stop()
+    reactor.callLater(13, report)
 
 def main():
     startLogging(stdout)
+    args = parse_args()
 
-    d = connect()
-    d.addCallback(connected)
+    client = TurretClient(args.host, args.port, args.turret)
+    d = client.start()
+    d.addCallback(connected, args)
     d.addErrback(err, 'connection failed')
     d.addErrback(lambda p: reactor.stop())
 
     reactor.run()
-    
+
 
 if __name__ == "__main__":
     main()
@@ -2,70 +2,124 @@
 ## Networked Turret Controller
 # acts as a server
 
+import json
+import socket
+from functools import partial
 from sys import stdout
 from twisted.python.log import startLogging, err
 
 from turret import Turret, TestTurret
+from turret.tracelog import trace, DEBUG
+from turret import loopstats, backends
 
-from twisted.internet import reactor
-from twisted.internet.protocol import Factory
+from zope.interface import implementer
+from twisted.internet import reactor, defer, task
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Factory, DatagramProtocol
 from twisted.internet.endpoints import TCP4ServerEndpoint
 
-from twisted.protocols.amp import Integer, Float, String, Boolean, Command
 from twisted.protocols import amp
 
-
-class TiltCommand(Command):
-    arguments = [('speed', Float())]
-    requiresAnswer = False
-
-class PanCommand(Command):
-    arguments = [('speed', Float())]
-    requiresAnswer = False
-
-class StopTiltCommand(Command):
-    requiresAnswer = False
-
-class StopPanCommand(Command):
-    requiresAnswer = False
-
-class FireCommand(Command):
-    requiresAnswer = False
-
-class KeepalivePing(Command):
-    pass
+from commands import (TiltCommand, PanCommand, StopTiltCommand, StopPanCommand,
+                      FireCommand, TiltToCommand, PanToCommand, AimCommand,
+                      KeepalivePing, AcquireControlCommand, ReleaseControlCommand,
+                      TelemetryCommand, TelemetryFrame, StatsCommand,
+                      UnknownTurret, NotInControl, unpack_control, seq_newer)
 
 class TurretControlProtocol(amp.AMP):
+    telemetry_stream = None
+    
+    def _controller(self, turret):
+        self.factory.sessions.check(self)
+        return self.factory.controller(turret)
+    
     @TiltCommand.responder
-    def tilt(self, speed):
-        self.factory.Tilt(speed)
+    def tilt(self, speed, turret=None):
+        self._controller(turret).Tilt(speed)
         return {"result": True}
     
     @PanCommand.responder
-    def pan(self, speed):
-        self.factory.Pan(speed)
+    def pan(self, speed, turret=None):
+        self._controller(turret).Pan(speed)
         return {"result": True}
     
     @StopTiltCommand.responder
-    def stop_tilt(self):
-        self.factory.StopTilt()
+    def stop_tilt(self, turret=None):
+        self._controller(turret).StopTilt()
         return {}
         
     @StopPanCommand.responder
-    def stop_pan(self):
-        self.factory.StopPan()
+    def stop_pan(self, turret=None):
+        self._controller(turret).StopPan()
         return {}
     
     @FireCommand.responder
-    def fire(self):
-        self.factory.Fire()
+    def fire(self, turret=None):
+        self._controller(turret).Fire()
         return {}
 
+    @TiltToCommand.responder
+    def tilt_to(self, angle, speed=None, deadline=None, turret=None):
+        controller = self._controller(turret)
+        d = controller.TiltTo(angle, speed, deadline)
+        d.addCallback(lambda arrived: {"arrived": arrived,
+                                       "angle": float(controller.turret.tilt_angle)})
+        return d
+
+    @PanToCommand.responder
+    def pan_to(self, angle, speed=None, deadline=None, turret=None):
+        controller = self._controller(turret)
+        d = controller.PanTo(angle, speed, deadline)
+        d.addCallback(lambda arrived: {"arrived": arrived,
+                                       "angle": float(controller.turret.pan_angle)})
+        return d
+
+    @AimCommand.responder
+    def aim(self, tilt, pan, tilt_speed=None, pan_speed=None, deadline=None, turret=None):
+        controller = self._controller(turret)
+        d = controller.Aim(tilt, pan, tilt_speed, pan_speed, deadline)
+        d.addCallback(lambda arrived: {"arrived": arrived,
+                                       "tilt": float(controller.turret.tilt_angle),
+                                       "pan": float(controller.turret.pan_angle)})
+        return d
+
     @KeepalivePing.responder
     def keepalive(self):
-        print("alive")
+        trace.debug("keepalive", self.transport.getPeer().host)
+        self.factory.sessions.renew(self)
+        return {"time": reactor.seconds()}
+
+    @AcquireControlCommand.responder
+    def acquire_control(self, lease=None):
+        sessions = self.factory.sessions
+        granted = sessions.acquire(self, lease)
+        return {"granted": granted, "lease": float(sessions.lease_time)}
+
+    @ReleaseControlCommand.responder
+    def release_control(self):
+        self.factory.sessions.release(self)
+        return {}
+
+    @TelemetryCommand.responder
+    def telemetry(self, rate=None, turret=None):
+        controller = self.factory.controller(turret) # read-only; no lease needed
+        turret_id = self.factory.order[0] if turret is None else turret
+        stream = self.telemetry_stream
+        if rate == 0:
+            if stream is not None:
+                stream.unwatch(turret_id)
+            return {}
+        if stream is None:
+            stream = self.telemetry_stream = TelemetryStream(self, self.factory.streams)
+        stream.watch(turret_id, controller, rate or TelemetryStream.rate)
         return {}
 
+    @StatsCommand.responder
+    def stats(self):
+        stats = self.factory.command_stats()
+        stats["loops"] = loopstats.summary()
+        return {"stats": json.dumps(stats).encode("utf-8")}
+
     def logout(self):
         self.factory.disconnect()
     
@@ -80,35 +134,155 @@ class TurretControlProtocol(amp.AMP):
         amp.AMP.connectionLost(self, reason)
         if reason == "logout":
             self.factory.Logout()
-        self.factory.StopAll()
+        self.factory.sessions.drop(self)
+        if self.telemetry_stream is not None:
+            self.telemetry_stream.stop()
 
-class TurretControlFactory(Factory):
-    def __init__(self, selected_turret):
-        self.connected = False # flag to distinguish intentional and unintentional disconnections
-        self.turret = selected_turret()
+class TurretController(object):
+    """ Drives one turret for its controllers.
+
+    Tilt and pan commands are coalesced per axis: only the newest pending
+    command for an axis is kept, and each axis is actuated at most once per
+    control frame, so a burst from a joystick costs one actuator update
+    instead of one per command. Commands replaced before they were applied
+    are counted in `dropped`.
+    """
+    frame = 1.0/60.0 # control frame, matched to the servo PWM frame
+    
+    def __init__(self, turret, clock=reactor.seconds):
+        self.turret = turret
+        self.clock = clock
+        self.pending = {} # axis -> (method, args), newest command wins
+        self.applied = 0
+        self.dropped = 0
+        self._next_frame = 0 # earliest time the next batch may be applied
+        self._apply_call = None
+    
+    def _submit(self, axis, method, *args):
+        if axis in self.pending:
+            self.dropped += 1
+        self.pending[axis] = (method, args)
+        if self._apply_call is None:
+            # first command after a quiet frame goes out this reactor tick
+            delay = max(0, self._next_frame - self.clock())
+            self._apply_call = reactor.callLater(delay, self._apply)
+    
+    def _apply(self):
+        self._apply_call = None
+        self._next_frame = self.clock() + self.frame
+        pending, self.pending = self.pending, {}
+        for method, args in pending.values():
+            self.applied += 1
+            method(*args)
+    
+    def stats(self):
+        stats = {"applied": self.applied, "dropped": self.dropped,
+                 "pending": len(self.pending)}
+        pwm = getattr(self.turret, "pwm", None)
+        if pwm is not None:
+            stats["pwm"] = pwm.stats()
+        return stats
     
     def Tilt(self, speed):
-        self.turret.tilt(speed)
+        self._submit("tilt", self.turret.tilt, speed)
     
     def Pan(self, speed):
-        self.turret.pan_forever(speed)
+        self._submit("pan", self.turret.pan_at, speed)
     
     def StopTilt(self):
-        self.turret.stop_tilt()
+        self._submit("tilt", self.turret.stop_tilt)
     
     def StopPan(self):
-        self.turret.stop_pan()
+        self._submit("pan", self.turret.stop_pan)
 
+    def _move(self, d, deadline, stop):
+        """ Give up on the move d after deadline seconds, stopping the axis """
+        if deadline is None:
+            return d
+        timeout = reactor.callLater(deadline, stop)
+        def done(arrived):
+            if timeout.active():
+                timeout.cancel()
+            return arrived
+        return d.addBoth(done)
+    
+    def TiltTo(self, angle, speed=None, deadline=None):
+        # an absolute move replaces any speed command still waiting its frame
+        self.pending.pop("tilt", None)
+        d = self.turret.tilt_toward(angle, speed)
+        return self._move(d, deadline, self.turret.stop_tilt)
+    
+    def PanTo(self, angle, speed=None, deadline=None):
+        self.pending.pop("pan", None)
+        d = self.turret.pan_to(angle, speed)
+        return self._move(d, deadline, self.turret.stop_pan)
+    
+    def Aim(self, tilt, pan, tilt_speed=None, pan_speed=None, deadline=None):
+        d = defer.gatherResults([self.TiltTo(tilt, tilt_speed, deadline),
+                                 self.PanTo(pan, pan_speed, deadline)])
+        return d.addCallback(all)
+    
     def StopAll(self):
+        # applies at once; nothing queued before it may start the turret again
+        self.pending.clear()
         self.turret.stop_tilt()
         self.turret.stop_pan()
 
     def Fire(self):
         self.turret.fire()
+
+class TurretControlFactory(Factory):
+    """ Serves one turret, or a fleet of them in one process.
+
+    Commands carrying a turret id go to that turret's TurretController, the
+    rest to the default (first) one. Turrets share the process's hardware
+    backend, so turrets on one PWM chip share its driver and bus writes.
+    """
+    default_id = u"turret"
+    
+    def __init__(self, turrets, clock=reactor.seconds):
+        """ turrets is a callable making the one turret, or a list of
+        (id, callable) pairs for a fleet """
+        self.connected = False # flag to distinguish intentional and unintentional disconnections
+        if callable(turrets):
+            turrets = [(self.default_id, turrets)]
+        self.order = [turret_id for turret_id, make in turrets]
+        self.controllers = dict((turret_id, TurretController(make(), clock))
+                                for turret_id, make in turrets)
+        self.default = self.controllers[self.order[0]]
+        self.turret = self.default.turret
+        self.datagrams = None # TurretControlDatagram, when listening on UDP
+        self.sessions = ControlSessions(self)
+        self.streams = set() # TelemetryStreams
+    
+    def controller(self, turret_id=None):
+        if turret_id is None:
+            return self.default
+        try:
+            return self.controllers[turret_id]
+        except KeyError:
+            raise UnknownTurret(turret_id)
+    
+    def command_stats(self):
+        stats = {"turrets": dict((turret_id, controller.stats())
+                                 for turret_id, controller in self.controllers.items())}
+        stats["sessions"] = self.sessions.summary()
+        stats["telemetry"] = {"subscribers": len(self.streams),
+                              "frames": sum(s.frames for s in self.streams),
+                              "skipped": sum(s.skipped for s in self.streams),
+                              "bytes": sum(s.bytes for s in self.streams)}
+        if self.datagrams is not None:
+            stats["udp"] = self.datagrams.stats()
+        return stats
+
+    def StopAll(self):
+        for controller in self.controllers.values():
+            controller.StopAll()
     
     def Calibrate(self):
         if not self.connected:
-            self.turret.calibrate()
+            for turret_id in self.order:
+                self.controllers[turret_id].turret.calibrate()
     
     def disconnect(self):
         self.connected = False
@@ -116,24 +290,313 @@ class TurretControlFactory(Factory):
     def login(self):
         self.connected = True
 
+class ControlSessions(object):
+    """ The control lease.
+
+    One client at a time holds the lease and may send control commands. It
+    lapses `lease` seconds after the holder was last heard from, and every
+    turret is stopped when it lapses, is released or the holder hangs up;
+    other clients coming and going don't touch the turrets. Clients that only
+    watch subscribe to telemetry (TelemetryStream), which needs no lease.
+    """
+    lease = 5.0
+    
+    def __init__(self, factory):
+        self.factory = factory
+        self.holder = None # protocol holding the lease
+        self.lease_time = self.lease
+        self._expiry = None
+    
+    def acquire(self, proto, lease=None):
+        if self.holder is not None and self.holder is not proto:
+            return False
+        self.holder = proto
+        self.lease_time = lease or self.lease
+        self.renew(proto)
+        return True
+    
+    def renew(self, proto):
+        if proto is not self.holder:
+            return
+        if self._expiry is not None and self._expiry.active():
+            self._expiry.reset(self.lease_time)
+        else:
+            self._expiry = reactor.callLater(self.lease_time, self._lapse)
+    
+    def check(self, proto):
+        """ Let proto send a control command, or raise NotInControl """
+        if self.holder is None:
+            self.acquire(proto)
+        elif self.holder is not proto:
+            raise NotInControl()
+        else:
+            self.renew(proto)
+    
+    def allows_datagram(self, host):
+        """ Control datagrams are taken from the lease holder's host """
+        if self.holder is None:
+            return True
+        if self.holder.transport.getPeer().host != host:
+            return False
+        self.renew(self.holder)
+        return True
+    
+    def release(self, proto):
+        if proto is not self.holder:
+            return
+        if self._expiry is not None and self._expiry.active():
+            self._expiry.cancel()
+        self._lapse()
+    
+    def _lapse(self):
+        self._expiry = None
+        self.holder = None
+        self.lease_time = self.lease
+        self.factory.StopAll()
+    
+    def drop(self, proto):
+        """ proto hung up """
+        self.release(proto)
+    
+    def summary(self):
+        return {"held": self.holder is not None}
+
+@implementer(IPushProducer)
+class TelemetryStream(object):
+    """ Telemetry for one subscriber.
+
+    Every `interval` each watched turret gets a TelemetryFrame holding only
+    the fields that changed (at the precision below) since the last frame
+    this subscriber got. The stream is its transport's producer, and the
+    transport pauses it once `buffer` bytes are queued: while paused, ticks
+    send nothing, since the next frame will carry every change anyway, and
+    each pause doubles the interval up to max_interval. Each tick sent
+    brings the interval back an eighth of the way to the rate asked for.
+    The socket's send buffer is shrunk to `sndbuf` so a slow subscriber's
+    backlog shows up here, instead of queueing out of sight in the kernel.
+    """
+    rate = 10.0 # frames a second, by default
+    max_rate = 60.0
+    max_interval = 2.0
+    buffer = 4096
+    sndbuf = 8192
+    precision = {"tilt": 1, "tilt_velocity": 1, "pan": 1, "pan_velocity": 1} # decimals
+    
+    def __init__(self, proto, streams, clock=reactor.seconds):
+        self.proto = proto
+        self.streams = streams
+        self.clock = clock
+        self.turrets = {} # turret id -> (controller, fields last sent)
+        self.interval = self.target = 1.0 / self.rate
+        self.paused = False
+        self.seq = 0
+        self.frames = 0
+        self.skipped = 0
+        self.bytes = 0
+        self._call = None
+        proto.transport.bufferSize = self.buffer
+        proto.transport.getHandle().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        proto.transport.registerProducer(self, True)
+        streams.add(self)
+    
+    def watch(self, turret_id, controller, rate):
+        self.target = 1.0 / min(rate, self.max_rate)
+        self.interval = self.target
+        self.turrets[turret_id] = (controller, {})
+        if self._call is None:
+            self._call = reactor.callLater(0, self.tick)
+    
+    def unwatch(self, turret_id):
+        self.turrets.pop(turret_id, None)
+        if not self.turrets:
+            self.stop()
+    
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self.streams.discard(self)
+        if self.proto.telemetry_stream is self:
+            self.proto.telemetry_stream = None
+            if self.proto.transport.connected:
+                self.proto.transport.unregisterProducer()
+    
+    def _fields(self, turret):
+        fields = turret.telemetry()
+        for name, places in self.precision.items():
+            fields[name] = round(fields[name], places)
+        if fields["led"] is None:
+            del fields["led"]
+        else:
+            fields["led"] = [round(c, 3) for c in fields["led"]]
+        return fields
+    
+    def tick(self):
+        self._call = reactor.callLater(self.interval, self.tick)
+        if self.paused:
+            self.skipped += 1
+            return
+        now = self.clock()
+        for turret_id, (controller, sent) in self.turrets.items():
+            fields = self._fields(controller.turret)
+            delta = dict((name, value) for name, value in fields.items()
+                         if sent.get(name) != value)
+            if not delta:
+                continue
+            sent.update(delta)
+            self.seq += 1
+            delta.update(turret=turret_id, seq=self.seq, time=now)
+            box = TelemetryFrame.makeArguments(delta, self.proto)
+            box[amp.COMMAND] = TelemetryFrame.commandName
+            data = box.serialize()
+            self.proto.transport.write(data)
+            self.frames += 1
+            self.bytes += len(data)
+        self.interval -= (self.interval - self.target) / 8
+    
+    def pauseProducing(self):
+        self.paused = True
+        self.interval = min(self.max_interval, self.interval * 2)
+    
+    def resumeProducing(self):
+        self.paused = False
+    
+    def stopProducing(self):
+        self.stop()
+
+class TurretControlDatagram(DatagramProtocol):
+    """ Continuous control over UDP, alongside the AMP session.
+
+    Each packet (see commands.pack_control) carries the whole control state.
+    Packets that arrive out of order, or more than max_age later than the
+    quickest packet seen from that sender, are discarded; the rest update
+    only the axes that changed, through the default turret's coalescing.
+    Fire goes off when the trigger bit is first seen set. A sender that falls
+    silent for `timeout` has its axes stopped. While a client holds the
+    control lease, only datagrams from its host are taken.
+    """
+    max_age = 0.25
+    timeout = 0.5
+    
+    def __init__(self, factory, clock=reactor.seconds):
+        self.controller = factory.controller()
+        self.sessions = factory.sessions
+        factory.datagrams = self
+        self.clock = clock
+        self.senders = {} # address -> [last seq, clock offset, tilt, pan, fire]
+        self.received = 0
+        self.stale = 0
+        self.malformed = 0
+        self.refused = 0
+        self._silence = None
+    
+    def datagramReceived(self, data, addr):
+        self.received += 1
+        try:
+            seq, timestamp, tilt, pan, fire = unpack_control(data)
+        except ValueError:
+            self.malformed += 1
+            return
+        if not self.sessions.allows_datagram(addr[0]):
+            self.refused += 1
+            return
+        offset = self.clock() - timestamp
+        sender = self.senders.get(addr)
+        if sender is None:
+            sender = self.senders[addr] = [seq - 1, offset, 0.0, 0.0, False]
+        if not seq_newer(seq, sender[0]) or offset > sender[1] + self.max_age:
+            self.stale += 1
+            return
+        sender[0] = seq
+        sender[1] = min(sender[1], offset)
+        if tilt != sender[2]:
+            sender[2] = tilt
+            if tilt:
+                self.controller.Tilt(tilt)
+            else:
+                self.controller.StopTilt()
+        if pan != sender[3]:
+            sender[3] = pan
+            if pan:
+                self.controller.Pan(pan)
+            else:
+                self.controller.StopPan()
+        if fire and not sender[4]:
+            self.controller.Fire()
+        sender[4] = fire
+        if self._silence is not None and self._silence.active():
+            self._silence.reset(self.timeout)
+        else:
+            self._silence = reactor.callLater(self.timeout, self._stop)
+    
+    def _stop(self):
+        self._silence = None
+        self.senders.clear() # a sender that comes back starts over
+        self.controller.StopAll()
+    
+    def stats(self):
+        return {"received": self.received, "stale": self.stale, "malformed": self.malformed,
+                "refused": self.refused}
+
+def load_fleet(path):
+    """ A fleet config file; see fleet_config.yml """
+    import yaml
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+def fleet_turrets(config, turret=TestTurret):
+    """ [(id, turret maker)] for the turrets in a fleet config, the default
+    turret first. turret is the class, or a partial of it with the backend
+    filled in. """
+    ids = sorted(config["turrets"])
+    default = config.get("default")
+    if default is not None:
+        ids.remove(default)
+        ids.insert(0, default)
+    return [(turret_id, partial(turret, name=turret_id, **(config["turrets"][turret_id] or {})))
+            for turret_id in ids]
+
+def serve(turret, port=8750, udp_port=None):
+    """ Listen for controllers, driving a turret made by calling turret(),
+    or a fleet given as [(id, turret maker)] """
+    factory = TurretControlFactory(turret)
+    factory.protocol = TurretControlProtocol
+    if udp_port is not None:
+        reactor.listenUDP(udp_port, TurretControlDatagram(factory))
+    server_endpoint = TCP4ServerEndpoint(reactor, port)
+    listening_port = server_endpoint.listen(factory)
+    print("Running")
+    try:
+        reactor.run()
+    finally:
+        backends.cleanup()
+
 def main():
     startLogging(stdout)
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-r", "--real", action="store_true") #Use test by default
+    parser.add_argument("-v", "--trace", action="store_true") #log actuator events
+    parser.add_argument("-b", "--backend", choices=backends.names(),
+                        help="hardware for --real to drive (default: real, or the fleet's)")
+    parser.add_argument("-p", "--port", type=int, default=8750)
+    parser.add_argument("-u", "--udp", type=int, metavar="PORT", help="also take control datagrams")
+    parser.add_argument("-f", "--fleet", metavar="CONFIG", help="serve the turrets in this file")
     args = parser.parse_args()
     
+    if args.trace:
+        trace.level = DEBUG
+        trace.start_flushing()
+    
+    fleet = load_fleet(args.fleet) if args.fleet else {}
     if args.real:
-        turret = Turret
+        turret = partial(Turret, backend=args.backend or fleet.get("backend", "real"))
     else:
         turret = TestTurret
+    if fleet:
+        turret = fleet_turrets(fleet, turret)
     
-    factory = TurretControlFactory(turret)
-    factory.protocol = TurretControlProtocol
-    server_endpoint = TCP4ServerEndpoint(reactor, 8750)
-    listening_port = server_endpoint.listen(factory)
-    print("Running")
-    reactor.run()
+    serve(turret, args.port, args.udp)
     
 
 if __name__ == "__main__":
@@ -5,18 +5,43 @@
 # Public Domain
 
 """
-This module provides two classes to use with wireless 433MHz fobs.
-The rx class decodes received fob codes. The tx class transmits
-fob codes.
+This module provides classes to use with wireless 433MHz fobs.
+The rx class decodes received fob codes. The bulk_rx class decodes
+the same codes from edges read in bulk, e.g. from a pigpio
+notification pipe by notify_edges. The tx class transmits fob codes,
+blocking or, under Twisted, with send_async.
 """
+import array
+import collections
+import os
 import time
-import pigpio
+
+# pigpio's values for the names the receivers use, so that captures
+# can be decoded where pigpio isn't installed. tx, which needs a
+# real Pi, imports pigpio when it makes its waves.
+INPUT = 0
+OUTPUT = 1
+EITHER_EDGE = 2
+
+def tickDiff(t1, t2):
+    """
+    Returns the microseconds from tick t1 to tick t2, allowing for
+    the 32 bit wrap (as pigpio.tickDiff).
+    """
+    return (t2 - t1) & 0xFFFFFFFF
 
 class rx():
     """
     A class to read the wireless codes transmitted by 433 MHz
     wireless fobs.
     """
+    # Pulse tolerances, as fractions of the template pair's short
+    # and long pulses, and the least long/short ratio of a code.
+    # Class attributes so they can be tuned against captures.
+    slack_0 = 0.3
+    slack_1 = 0.2
+    min_ratio = 1.5
+
     def __init__(self, pi, gpio, callback=None,
                              min_bits=8, max_bits=32, glitch=150):
         """
@@ -49,11 +74,11 @@ class rx():
 
         self._ready = False
 
-        pi.set_mode(gpio, pigpio.INPUT)
+        pi.set_mode(gpio, INPUT)
         pi.set_glitch_filter(gpio, glitch)
 
         self._last_edge_tick = pi.get_current_tick()
-        self._cb = pi.callback(gpio, pigpio.EITHER_EDGE, self._cbf)
+        self._cb = pi.callback(gpio, EITHER_EDGE, self._cbf)
 
     def _timings(self, e0, e1):
         """
@@ -91,11 +116,11 @@ class rx():
 
         ratio = float(self._t1)/float(self._t0)
 
-        if ratio < 1.5:
+        if ratio < self.min_ratio:
             self._in_code = False
 
-        slack0 = int(0.3 * self._t0)
-        slack1 = int(0.2 * self._t1)
+        slack0 = int(self.slack_0 * self._t0)
+        slack1 = int(self.slack_1 * self._t1)
 
         self._min_0 = self._t0 - slack0
         self._max_0 = self._t0 + slack0
@@ -127,7 +152,7 @@ class rx():
         The code end is assumed when an edge greater than 5 ms
         is detected.
         """
-        edge_len = pigpio.tickDiff(self._last_edge_tick, t)
+        edge_len = tickDiff(self._last_edge_tick, t)
         self._last_edge_tick = t
 
         if edge_len > 5000: # 5000 us, 5 ms.
@@ -203,11 +228,304 @@ class rx():
             self._cb.cancel()
             self._cb = None
 
+class notify_edges():
+    """
+    Reads the edges of one GPIO in bulk from a pigpio notification
+    pipe, instead of taking a Python callback per edge.
+    """
+    report_words = 3 # seqno | flags << 16, tick, level
+
+    def __init__(self, pi, gpio, fd=None):
+        """
+        Instantiate with the Pi and the GPIO to watch.
+
+        fd may be given to read notification reports from somewhere
+        other than a new notification on the Pi (e.g. a pipe fed by
+        a test), in which case the Pi is not asked for one.
+        """
+        self.pi = pi
+        self.gpio = gpio
+        self.handle = None
+        if fd is None:
+            self.handle = pi.notify_open()
+            fd = os.open("/dev/pigpio{}".format(self.handle), os.O_RDONLY | os.O_NONBLOCK)
+            pi.notify_begin(self.handle, 1<<gpio)
+        self.fd = fd
+        self._partial = b""
+
+    def fileno(self):
+        """
+        Returns the pipe's file descriptor, to wait on for edges.
+        """
+        return self.fd
+
+    def read(self):
+        """
+        Returns the ticks of the edges reported since the last read,
+        oldest first, without blocking.
+        """
+        return reports_to_ticks(self._reports())
+
+    def read_edges(self):
+        """
+        As read, but returns (ticks, levels), the GPIO's level after
+        each edge alongside its tick.
+        """
+        return reports_to_edges(self._reports(), self.gpio)
+
+    def _reports(self):
+        """
+        Returns the whole reports that have arrived, keeping any
+        partial one for next time.
+        """
+        chunks = [self._partial]
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                break # nothing more for now
+            if not data:
+                break
+            chunks.append(data)
+        data = b"".join(chunks)
+        size = 4 * self.report_words
+        whole = len(data) - len(data) % size
+        self._partial = data[whole:]
+        return data[:whole]
+
+    def cancel(self):
+        """
+        Closes the notification.
+        """
+        if self.handle is not None:
+            self.pi.notify_close(self.handle)
+            self.handle = None
+            os.close(self.fd)
+
+def _report_words(data):
+    words = array.array("I")
+    if hasattr(words, "frombytes"):
+        words.frombytes(data)
+    else:
+        words.fromstring(data) # Python 2
+    return words
+
+def reports_to_ticks(data):
+    """
+    Returns the ticks of the level changes in a run of pigpio
+    notification reports. Watchdog and keep-alive reports, which
+    carry flags, are not edges and are left out.
+    """
+    words = _report_words(data)
+    # each report is uint16 seqno, uint16 flags, uint32 tick, uint32
+    # level; on the Pi's little endian ARM the flags are the top half
+    # of the first word.
+    heads = words[0::3]
+    if not heads or max(heads) >> 16 == 0:
+        return words[1::3].tolist() # the usual case: every report is an edge
+    return [tick for head, tick in zip(heads, words[1::3]) if not head >> 16]
+
+def reports_to_edges(data, gpio):
+    """
+    Returns (ticks, levels) for the level changes of gpio in a run
+    of pigpio notification reports, levels being 0 or 1.
+    """
+    words = _report_words(data)
+    ticks = []
+    levels = []
+    for head, tick, level in zip(words[0::3], words[1::3], words[2::3]):
+        if not head >> 16:
+            ticks.append(tick)
+            levels.append(level >> gpio & 1)
+    return ticks, levels
+
+class bulk_rx(rx):
+    """
+    Decodes the same codes as rx, from edges taken in batches.
+
+    Rather than a callback per edge, feed() gets the ticks of many
+    edges at once, turns them into edge lengths, finds the gaps
+    between codes in one pass and decodes only the stretches that
+    follow a gap, dropping each as soon as it stops looking like a
+    code. Radio noise, which rarely survives the first pulse pair,
+    then costs little more than its share of that one pass.
+    """
+    def __init__(self, pi, gpio, callback=None,
+                             min_bits=8, max_bits=32, glitch=150,
+                             source=None, start_tick=None):
+        """
+        As for rx. Edges come from source, anything whose read()
+        returns the ticks of new edges (a notify_edges on the GPIO by
+        default); call poll() to decode them, e.g. whenever its
+        fileno() is readable. With a source, pi may be None, and the
+        first edge is measured from start_tick.
+        """
+        self.pi = pi
+        self.gpio = gpio
+        self.cb = callback
+        self.min_bits = min_bits
+        self.max_bits = max_bits
+        self.glitch = glitch
+
+        self._in_code = False
+        self._edge = 0
+        self._code = 0
+        self._gap = 0
+        self._bits = 0
+        self._t0 = self._t1 = 0
+        self._even_edge_len = 0
+        self._limits = (0, 0, 0, 0)
+
+        self._ready = False
+        self._cb = None
+
+        if pi is not None:
+            pi.set_mode(gpio, INPUT)
+            pi.set_glitch_filter(gpio, glitch)
+            if source is None:
+                source = notify_edges(pi, gpio)
+            if start_tick is None:
+                start_tick = pi.get_current_tick()
+
+        self.source = source
+        self._last_edge_tick = start_tick or 0
+
+    def poll(self):
+        """
+        Decodes whatever edges the source has. Returns the number of
+        edges read.
+        """
+        ticks = self.source.read()
+        self.feed(ticks)
+        return len(ticks)
+
+    def feed(self, ticks):
+        """
+        Decodes a batch of edge ticks (microseconds, oldest first).
+        Codes are reported just as rx reports them.
+        """
+        if not len(ticks):
+            return
+        previous = [self._last_edge_tick]
+        previous.extend(ticks[:-1])
+        self._last_edge_tick = ticks[-1]
+        lengths = [(t - p) & 0xFFFFFFFF for p, t in zip(previous, ticks)]
+
+        start = 0
+        for i in [i for i, n in enumerate(lengths) if n > 5000]: # 5 ms gaps
+            if self._in_code:
+                self._decode(lengths, start, i)
+                if self._in_code and self.min_bits <= self._bits <= self.max_bits:
+                    self._found()
+            self._in_code = True
+            self._gap = lengths[i]
+            self._edge = 0
+            self._bits = 0
+            self._code = 0
+            start = i + 1
+        if self._in_code:
+            self._decode(lengths, start, len(lengths))
+
+    def _found(self):
+        self._lbits = self._bits
+        self._lcode = self._code
+        self._lgap = self._gap
+        self._lt0 = int(self._t0/self._bits)
+        self._lt1 = int(self._t1/self._bits)
+        self._ready = True
+        if self.cb is not None:
+            self.cb(self._lcode, self._lbits,
+                      self._lgap, self._lt0, self._lt1)
+
+    def _decode(self, lengths, i, end):
+        """
+        Runs rx's per-edge pulse pair decoding over lengths[i:end],
+        with the state kept in locals, until the stretch ends or
+        stops being a code.
+        """
+        edge = self._edge
+        bits = self._bits
+        code = self._code
+        t0 = self._t0
+        t1 = self._t1
+        even = self._even_edge_len
+        min_0, max_0, min_1, max_1 = self._limits
+        in_code = True
+
+        while i < end:
+            n = lengths[i]
+            i += 1
+            if not edge & 1:
+                even = n
+                edge += 1
+                continue
+
+            if edge == 1:
+                # The first pair is the template, as in rx._calibrate.
+                if even < n:
+                    t0, t1 = even, n
+                else:
+                    t0, t1 = n, even
+                if t1 < self.min_ratio * t0:
+                    in_code = False
+                slack0 = int(self.slack_0 * t0)
+                slack1 = int(self.slack_1 * t1)
+                min_0, max_0 = t0 - slack0, t0 + slack0
+                min_1, max_1 = t1 - slack1, t1 + slack1
+                bits = 0
+
+            if even < n:
+                shorter, longer = even, n
+            else:
+                shorter, longer = n, even
+            if bits:
+                t0 += shorter
+                t1 += longer
+            else:
+                t0 = shorter
+                t1 = longer
+            bits += 1
+
+            code = code << 1
+            if (min_0 < even < max_0) and (min_1 < n < max_1):
+                pass
+            elif (min_0 < n < max_0) and (min_1 < even < max_1):
+                code += 1
+            else:
+                in_code = False
+
+            edge += 1
+            if not in_code:
+                break
+
+        self._edge = edge
+        self._bits = bits
+        self._code = code
+        self._t0 = t0
+        self._t1 = t1
+        self._even_edge_len = even
+        self._limits = (min_0, max_0, min_1, max_1)
+        self._in_code = in_code
+
+    def cancel(self):
+        """
+        Cancels the wireless code receiver.
+        """
+        if self.source is not None:
+            if self.pi is not None:
+                self.pi.set_glitch_filter(self.gpio, 0) # Remove glitch filter.
+            if hasattr(self.source, "cancel"):
+                self.source.cancel()
+            self.source = None
+
 class tx():
     """
     A class to transmit the wireless codes sent by 433 MHz
     wireless fobs.
     """
+    chains_kept = 64 # compiled chains cached, least recently used out
+    poll = 0.002 # seconds between busy checks at the end of a send
+
     def __init__(self, pi, gpio, repeats=6, bits=24, gap=9000, t0=300, t1=900):
         """
         Instantiate with the Pi and the GPIO connected to the wireless
@@ -228,14 +546,19 @@ class tx():
         self.t0 = t0
         self.t1 = t1
 
+        self._chains = collections.OrderedDict()
+        self._queue = collections.deque() # (code, Deferred) for send_async
+        self._sending = None
         self._make_waves()
 
-        pi.set_mode(gpio, pigpio.OUTPUT)
+        pi.set_mode(gpio, OUTPUT)
 
     def _make_waves(self):
         """
         Generates the basic waveforms needed to transmit codes.
         """
+        import pigpio
+
         wf = []
         wf.append(pigpio.pulse(1<<self.gpio, 0, self.t0))
         wf.append(pigpio.pulse(0, 1<<self.gpio, self.gap))
@@ -280,34 +603,113 @@ class tx():
         self.pi.wave_delete(self._wid0)
         self.pi.wave_delete(self._wid1)
 
+        self._chains.clear() # they name the old waves
         self._make_waves()
 
-    def send(self, code):
+    def _chain(self, code):
         """
-        Transmits the code (using the current settings of repeats,
-        bits, gap, short, and long pulse length).
+        Returns the wave chain for code, from the cache if it has
+        been sent lately.
         """
-        chain = [self._amble, 255, 0]
+        key = (code, self.bits, self.repeats)
+        chain = self._chains.pop(key, None)
+        if chain is None:
+            chain = [self._amble, 255, 0]
 
-        bit = (1<<(self.bits-1))
-        for i in range(self.bits):
-            if code & bit:
-                chain += [self._wid1]
-            else:
-                chain += [self._wid0]
-            bit = bit >> 1
+            bit = (1<<(self.bits-1))
+            for i in range(self.bits):
+                if code & bit:
+                    chain += [self._wid1]
+                else:
+                    chain += [self._wid0]
+                bit = bit >> 1
+
+            chain += [self._amble, 255, 1, self.repeats, 0]
+
+            if len(self._chains) >= self.chains_kept:
+                self._chains.popitem(last=False)
+        self._chains[key] = chain
+        return chain
+
+    def duration(self):
+        """
+        Returns the seconds a send takes on air with the current
+        settings: the amble, then the code and amble repeated.
+        """
+        amble = self.t0 + self.gap
+        code = self.bits * (self.t0 + self.t1)
+        return (amble + self.repeats * (code + amble)) / 1e6
 
-        chain += [self._amble, 255, 1, self.repeats, 0]
+    def send(self, code):
+        """
+        Transmits the code (using the current settings of repeats,
+        bits, gap, short, and long pulse length).
 
-        self.pi.wave_chain(chain)
+        Blocks until it has gone: sleeps for as long as the chain
+        takes, then checks every few ms for the end.
+        """
+        self.pi.wave_chain(self._chain(code))
+        time.sleep(self.duration())
 
         while self.pi.wave_tx_busy():
-            time.sleep(0.1)
+            time.sleep(self.poll)
+
+    def send_async(self, code):
+        """
+        Transmits the code without blocking, for use under a Twisted
+        reactor. Returns a Deferred that fires with the code once it
+        has gone. Sends made while one is on air wait their turn.
+        """
+        from twisted.internet import defer
+        d = defer.Deferred()
+        self._queue.append((code, d))
+        if self._sending is None:
+            self._next()
+        return d
+
+    def _next(self):
+        from twisted.internet import reactor
+        while self._queue and self._queue[0][1].called:
+            self._queue.popleft() # cancelled by the caller while waiting
+        if not self._queue:
+            self._sending = None
+            return
+        code, d = self._queue.popleft()
+        self.pi.wave_chain(self._chain(code))
+        self._sending = (code, d, reactor.callLater(self.duration(), self._sent))
+
+    def _sent(self):
+        from twisted.internet import reactor
+        code, d, call = self._sending
+        if self.pi.wave_tx_busy():
+            self._sending = (code, d, reactor.callLater(self.poll, self._sent))
+            return
+        self._next()
+        if not d.called:
+            d.callback(code)
+
+    def pending(self):
+        """
+        Returns the number of async sends on air or waiting.
+        """
+        return len(self._queue) + (self._sending is not None)
 
     def cancel(self):
         """
-        Cancels the wireless code transmitter.
-        """
+        Cancels the wireless code transmitter. Async sends still
+        waiting fail with CancelledError.
+        """
+        if self._sending is not None:
+            code, d, call = self._sending
+            if call.active():
+                call.cancel()
+            self.pi.wave_tx_stop()
+            self._queue.appendleft((code, d))
+            self._sending = None
+        while self._queue:
+            code, d = self._queue.popleft()
+            if not d.called:
+                d.cancel()
         self.pi.wave_delete(self._amble)
         self.pi.wave_delete(self._wid0)
         self.pi.wave_delete(self._wid1)
@@ -0,0 +1,396 @@
+#! /usr/bin/env python
+## 433 MHz edge captures
+# Records what the receiver's GPIO does to a file, and plays it back through
+# the decoder, so glitch, min_bits and the pulse slack can be tuned against
+# real radio traffic without a Pi.
+#
+# A capture is a 24 byte little endian header (magic, gpio, the glitch filter
+# it was taken with in us, the tick capture started at, edge count), the
+# edges' 32 bit ticks as one array, then their levels as a bitmap, edge i in
+# bit i % 8 of byte i // 8. About 4.1 bytes an edge, and the ticks can be
+# used straight from a memory map. The count is written on close; a capture
+# cut short has its ticks but no levels, which are then taken to alternate.
+#
+#   rf_capture.py capture fob.rfc --seconds 60   (on the Pi)
+#   rf_capture.py replay fob.rfc --glitch 200 --slack0 0.35
+#   rf_capture.py info fob.rfc
+import array
+import binascii
+import mmap
+import struct
+import sys
+import time
+
+import _433
+
+MAGIC = b"RF433CAP"
+HEADER = struct.Struct("<8sIIII") # magic, gpio, glitch, start tick, edges
+OPEN = 0xFFFFFFFF # edge count of a capture not closed yet
+MASK = 0xFFFFFFFF # ticks are microseconds, wrapping at 32 bits
+NATIVE = sys.byteorder == "little" and array.array("I").itemsize == 4
+
+# level bytes (0 or 1) to and from "0"/"1", for packing the bitmap
+_to_digits = bytearray(range(256))
+_to_digits[0], _to_digits[1] = ord("0"), ord("1")
+_to_digits = bytes(_to_digits)
+_from_digits = bytearray(range(256))
+_from_digits[ord("0")], _from_digits[ord("1")] = 0, 1
+_from_digits = bytes(_from_digits)
+
+
+def pack_bits(levels):
+    """ bytearray of 0/1 levels to a bitmap, level i in bit i % 8 of byte i // 8 """
+    if not levels:
+        return b""
+    digits = bytes(levels).translate(_to_digits)[::-1]
+    size = (len(levels) + 7) // 8
+    packed = bytearray(binascii.unhexlify("%0*x" % (size * 2, int(digits, 2))))
+    packed.reverse()
+    return bytes(packed)
+
+def unpack_bits(bitmap, count):
+    """ bitmap to a bytearray of `count` 0/1 levels """
+    if not count:
+        return bytearray()
+    value = bytearray(bitmap)
+    value.reverse()
+    digits = bin(int(binascii.hexlify(bytes(value)), 16))[2:]
+    digits = digits.zfill(len(value) * 8)[::-1][:count]
+    return bytearray(digits.encode("ascii").translate(_from_digits))
+
+def _words(data):
+    words = array.array("I")
+    if hasattr(words, "frombytes"):
+        words.frombytes(data)
+    else:
+        words.fromstring(data) # Python 2
+    if not NATIVE:
+        words.byteswap()
+    return words
+
+
+class CaptureWriter(object):
+    """ Writes edges to a capture file as they come """
+    def __init__(self, path, gpio, glitch=0, start=0, buffered=4096):
+        self.path = path
+        self.gpio = gpio
+        self.glitch = glitch
+        self.start = start
+        self.buffered = buffered
+        self.edges = 0
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, gpio, glitch, start & MASK, OPEN))
+        self._ticks = array.array("I")
+        self._levels = bytearray()
+
+    def add(self, tick, level):
+        self._ticks.append(tick & MASK)
+        self._levels.append(level & 1)
+        if len(self._ticks) >= self.buffered:
+            self.flush()
+
+    def extend(self, ticks, levels):
+        """ Adds edges in bulk, e.g. from notify_edges.read_edges() """
+        self._ticks.extend(ticks)
+        self._levels.extend(levels)
+        if len(self._ticks) >= self.buffered:
+            self.flush()
+
+    def flush(self):
+        ticks = self._ticks
+        if not NATIVE:
+            ticks.byteswap()
+        self.file.write(ticks.tobytes() if hasattr(ticks, "tobytes") else ticks.tostring())
+        self.file.flush()
+        self.edges += len(ticks)
+        self._ticks = array.array("I")
+
+    def close(self):
+        """ Writes the levels and the edge count; the capture is complete """
+        if self.file is None:
+            return
+        # the levels are kept until here so the ticks stay one array
+        self.flush()
+        self.file.write(pack_bits(self._levels))
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, self.gpio, self.glitch, self.start & MASK, self.edges))
+        self.file.close()
+        self.file = None
+
+
+class Capture(object):
+    """ A capture file, memory mapped. ticks is an array-like of the edge
+    ticks; on Python 3 a view of the map itself, so opening is free and
+    slices of it cost no copying """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.gpio, self.glitch, self.start, edges = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("{} is not an edge capture".format(path))
+        self.complete = edges != OPEN
+        if not self.complete:
+            edges = (len(self.map) - HEADER.size) // 4
+        self.edges = edges
+        self._bitmap = HEADER.size + 4 * edges
+        end = self._bitmap
+        if NATIVE and hasattr(memoryview, "cast"):
+            self.ticks = memoryview(self.map)[HEADER.size:end].cast("I")
+        else:
+            self.ticks = _words(self.map[HEADER.size:end])
+
+    def __len__(self):
+        return self.edges
+
+    def levels(self, start=0, end=None):
+        """ bytearray of the levels after edges start to end """
+        end = self.edges if end is None else min(end, self.edges)
+        if not self.complete:
+            return bytearray((i & 1) ^ 1 for i in range(start, end))
+        first = start - start % 8
+        bitmap = self.map[self._bitmap + first // 8:self._bitmap + (end + 7) // 8]
+        return unpack_bits(bitmap, end - first)[start - first:]
+
+    def chunks(self, size=65536):
+        """ (ticks, levels) for successive runs of up to `size` edges """
+        for i in range(0, self.edges, size):
+            yield self.ticks[i:i + size], self.levels(i, i + size)
+
+    def duration(self):
+        """ Seconds from the start tick to the last edge (ignoring whole wraps) """
+        if not self.edges:
+            return 0.0
+        total = 0
+        last = self.start
+        # every 4096th edge is enough, unless they're over an hour apart
+        for i in range(0, self.edges, 4096):
+            tick = self.ticks[min(i + 4095, self.edges - 1)]
+            total += (tick - last) & MASK
+            last = tick
+        return total / 1e6
+
+    def close(self):
+        if getattr(self, "ticks", None) is not None and hasattr(self.ticks, "release"):
+            self.ticks.release()
+        self.ticks = None
+        self.map.close()
+        self.file.close()
+
+
+class GlitchFilter(object):
+    """ pigpio's glitch filter, after the fact: a level change is only
+    passed on once the level has held for `steady` us. Replaying with a
+    larger glitch than the capture was taken with shows what it would have
+    done to the decoding. State carries over between calls, so a capture
+    can be filtered a chunk at a time; the last edge waits for the next. """
+    def __init__(self, steady, level=None):
+        self.steady = steady
+        self.level = level # the last level passed on
+        self._pending = None # (tick, level), waiting to see if it holds
+
+    def filter(self, ticks, levels):
+        steady = self.steady
+        level = self.level
+        pending = self._pending
+        out_ticks = []
+        out_levels = []
+        for tick, new in zip(ticks, levels):
+            if pending is not None:
+                if (tick - pending[0]) & MASK >= steady and pending[1] != level:
+                    level = pending[1]
+                    out_ticks.append(pending[0])
+                    out_levels.append(level)
+            elif level is None:
+                level = new ^ 1 # the level before the first edge
+            pending = (tick, new)
+        self.level = level
+        self._pending = pending
+        return out_ticks, out_levels
+
+    def flush(self):
+        """ Passes on the last edge, taken to have held """
+        ticks, levels = [], []
+        if self._pending is not None and self._pending[1] != self.level:
+            ticks, levels = [self._pending[0]], [self._pending[1]]
+            self.level = self._pending[1]
+        self._pending = None
+        return ticks, levels
+
+
+def replay(capture, feed, realtime=False, speed=1.0, glitch=None, chunk=65536,
+           clock=time.time, sleep=time.sleep, interval=0.001):
+    """ Feeds the capture's edge ticks to feed (e.g. bulk_rx.feed), in
+    chunks as fast as they're taken, or with realtime at the pace they were
+    recorded (times speed). Realtime edges go in batches, each no sooner
+    than its last edge's time in the recording: `interval` is the least
+    time between batches, so edges during a code are grouped much as
+    pigpio's notifications group them, and a quiet spell is one sleep. A
+    glitch larger than the capture's is applied on the way. Returns the
+    edges fed """
+    pace = _Pace(capture.start, speed, clock, interval) if realtime else None
+    fed = 0
+    for ticks in _edges(capture, glitch, chunk):
+        fed += len(ticks)
+        if pace is None:
+            feed(ticks)
+            continue
+        i = 0
+        while i < len(ticks):
+            j, wait = pace.due(ticks, i)
+            if j > i:
+                feed(ticks[i:j])
+                i = j
+            if i < len(ticks):
+                sleep(wait)
+    return fed
+
+def replay_on_reactor(capture, feed, speed=1.0, glitch=None, chunk=65536, interval=0.001):
+    """ replay(realtime=True) without blocking: the edges are fed from
+    reactor calls. Returns a Deferred that fires with the edges fed """
+    from twisted.internet import reactor, defer
+    done = defer.Deferred()
+    pace = _Pace(capture.start, speed, reactor.seconds, interval)
+    chunks = _edges(capture, glitch, chunk)
+    state = {"ticks": [], "i": 0, "fed": 0}
+    def step():
+        ticks, i = state["ticks"], state["i"]
+        while i == len(ticks):
+            try:
+                ticks, i = state["ticks"], state["i"] = next(chunks), 0
+            except StopIteration:
+                done.callback(state["fed"])
+                return
+        j, wait = pace.due(ticks, i)
+        if j > i:
+            feed(ticks[i:j])
+            state["fed"] += j - i
+        state["i"] = j
+        reactor.callLater(wait if j < len(ticks) else 0, step)
+    reactor.callLater(0, step)
+    return done
+
+def _edges(capture, glitch, chunk):
+    """ The capture's ticks a chunk at a time, glitch filtered if asked """
+    glitch_filter = None
+    if glitch is not None and glitch > capture.glitch:
+        glitch_filter = GlitchFilter(glitch)
+    for ticks, levels in capture.chunks(chunk):
+        if glitch_filter is not None:
+            ticks, levels = glitch_filter.filter(ticks, levels)
+        if len(ticks):
+            yield ticks
+    if glitch_filter is not None:
+        ticks = glitch_filter.flush()[0]
+        if ticks:
+            yield ticks
+
+
+class _Pace(object):
+    """ Hands edges over no sooner than their time in the recording. It
+    only says what is due and how long to wait; replay() sleeps and
+    replay_on_reactor() calls later """
+    def __init__(self, start, speed, clock, interval):
+        self.last = start # tick of the last edge handed over
+        self.elapsed = 0 # us from start to it
+        self.speed = speed
+        self.clock = clock
+        self.interval = interval
+        self.began = clock()
+
+    def due(self, ticks, i):
+        """ (j, wait): ticks[i:j] are due now, and the next is due in
+        wait seconds, or `interval` if that is longer """
+        due = (self.clock() - self.began) * self.speed * 1e6
+        n = len(ticks)
+        while i < n:
+            step = (ticks[i] - self.last) & MASK
+            if self.elapsed + step > due:
+                wait = (self.elapsed + step - due) / (self.speed * 1e6)
+                return i, max(self.interval, wait)
+            self.elapsed += step
+            self.last = ticks[i]
+            i += 1
+        return i, 0.0
+
+
+def capture(path, gpio, glitch, seconds):
+    """ Records gpio's edges to path for `seconds`, or until ctrl-c """
+    import select
+    import pigpio
+    pi = pigpio.pi()
+    pi.set_mode(gpio, pigpio.INPUT)
+    pi.set_glitch_filter(gpio, glitch)
+    source = _433.notify_edges(pi, gpio)
+    writer = CaptureWriter(path, gpio, glitch, start=pi.get_current_tick())
+    end = time.time() + seconds
+    try:
+        while time.time() < end:
+            select.select([source], [], [], 0.5)
+            ticks, levels = source.read_edges()
+            writer.extend(ticks, levels)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        source.cancel()
+        pi.set_glitch_filter(gpio, 0)
+        pi.stop()
+    return writer.edges
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    record = commands.add_parser("capture", help="record the receiver's edges (on the Pi)")
+    record.add_argument("path")
+    record.add_argument("-g", "--gpio", type=int, default=3)
+    record.add_argument("--glitch", type=int, default=150, help="pigpio glitch filter, us")
+    record.add_argument("-s", "--seconds", type=float, default=60.0)
+    play = commands.add_parser("replay", help="decode a capture")
+    play.add_argument("path")
+    play.add_argument("--realtime", action="store_true", help="at the recorded pace")
+    play.add_argument("--speed", type=float, default=1.0, help="with --realtime")
+    play.add_argument("--glitch", type=int, help="filter again with this, us")
+    play.add_argument("--min-bits", type=int, default=8)
+    play.add_argument("--max-bits", type=int, default=32)
+    play.add_argument("--slack0", type=float, default=_433.rx.slack_0)
+    play.add_argument("--slack1", type=float, default=_433.rx.slack_1)
+    play.add_argument("--min-ratio", type=float, default=_433.rx.min_ratio)
+    play.add_argument("-q", "--quiet", action="store_true", help="summary only")
+    info = commands.add_parser("info", help="describe a capture")
+    info.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "capture":
+        print("{} edges".format(capture(args.path, args.gpio, args.glitch, args.seconds)))
+        return
+
+    recording = Capture(args.path)
+    if args.command == "info":
+        print("gpio {} glitch {}us, {} edges over {:.1f}s{}".format(
+            recording.gpio, recording.glitch, recording.edges, recording.duration(),
+            "" if recording.complete else " (cut short, no levels)"))
+        recording.close()
+        return
+
+    codes = []
+    def found(code, bits, gap, t0, t1):
+        codes.append(code)
+        if not args.quiet:
+            print("code={} bits={} gap={} t0={} t1={}".format(code, bits, gap, t0, t1))
+    decoder = _433.bulk_rx(None, recording.gpio, found, min_bits=args.min_bits,
+                           max_bits=args.max_bits, start_tick=recording.start)
+    decoder.slack_0 = args.slack0
+    decoder.slack_1 = args.slack1
+    decoder.min_ratio = args.min_ratio
+    t = time.time()
+    edges = replay(recording, decoder.feed, args.realtime, args.speed, args.glitch)
+    elapsed = time.time() - t
+    print("{} edges in {:.3f}s ({:.0f} edges/s): {} codes, {} distinct".format(
+        edges, elapsed, edges / max(elapsed, 1e-9), len(codes), len(set(codes))))
+    recording.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,110 @@
 #! /usr/bin/env python
-if __name__ == "__main__":
+## RF Fob Turret Controller
+# A 433 MHz fob drives the turret: held buttons tilt and pan until let go,
+# fire fires once per push. Edges from the receiver are decoded on the
+# reactor and the codes looked up in rf_config.yml; --learn prints the codes
+# a fob sends, --capture plays a recording (see rf_capture.py) instead of
+# listening, and --send transmits codes, as a fob would, without blocking.
+import argparse
+import os
+import sys
+from sys import stdout
 
-    import sys
-    import time
-    import pigpio
-    import _433
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
 
-    RX=3
-    TX=4
+from twisted.python.log import startLogging, err
+from twisted.internet import reactor
+import yaml
 
-    # define optional callback for received codes.
+from turret import Turret, TestTurret
+from turret import backends
+from turret.rf_remote import FobRemote, EdgeReader
+import _433
+import rf_capture
 
-    def rx_callback(code, bits, gap, t0, t1):
-        output = "{0:b}".format(code)
-        print("code={} bits={})".
-            format(code, output))
+def load_config(path):
+    with open(path) as f:
+        return yaml.safe_load(f)
 
-    pi = pigpio.pi() # Connect to local Pi.
 
-    rx=_433.rx(pi, gpio=RX, callback=rx_callback)
-    try:
-        args = len(sys.argv)
+def main():
+    startLogging(stdout)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--test", action="store_false")
+    parser.add_argument("-b", "--backend", choices=backends.names(), default="real",
+                        help="where the turret's hardware and the receiver's pigpio come from")
+    parser.add_argument("-c", "--config", default=os.path.join(here, "rf_config.yml"))
+    parser.add_argument("--tilt-speed", type=float, default=45.0, help="degrees per second")
+    parser.add_argument("--pan-speed", type=float, default=45.0, help="degrees per second")
+    parser.add_argument("--learn", action="store_true", help="print the codes received")
+    parser.add_argument("--capture", help="replay this capture instead of listening")
+    parser.add_argument("--send", type=int, nargs="+", default=[], metavar="CODE",
+                        help="transmit these codes, one after another")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    receiver = config["receiver"]
+    codes = config["codes"]
+    backend = backends.get(args.backend)
 
-        if args > 1:
+    if args.test:
+        turret = TestTurret()
+    else:
+        turret = Turret(backend=backend)
 
-            # If the script has arguments they are assumed to codes
-            # to be transmitted.
+    heard = {} # code -> when last heard, to print each press once
+    def learnt(code):
+        now = reactor.seconds()
+        if now - heard.get(code, 0.0) > remote.holdoff:
+            print("code={} bits={:b}".format(code, code))
+        heard[code] = now
+    remote = FobRemote(receiver.get("holdoff", 150) / 1000.0, unknown=learnt if args.learn else None)
+    if not args.learn:
+        tilt, pan = args.tilt_speed, args.pan_speed
+        remote.add(codes["up"], lambda: turret.tilt(tilt), turret.stop_tilt)
+        remote.add(codes["down"], lambda: turret.tilt(-tilt), turret.stop_tilt)
+        remote.add(codes["left"], lambda: turret.pan_at(-pan), turret.stop_pan)
+        remote.add(codes["right"], lambda: turret.pan_at(pan), turret.stop_pan)
+        remote.add(codes["fire"], turret.fire)
 
-            tx=_433.tx(pi, gpio=TX)
+    def pigpio(role):
+        found = backend.pigpio()
+        if found is None:
+            parser.error("the {} backend has no pigpio for the {}".format(backend.name, role))
+        return found[1]
 
-            for i in range(args-1):
-                print("sending {}".format(sys.argv[i+1]))
-                tx.send(int(sys.argv[i+1]))
-                time.sleep(1)
+    transmitter = None
+    if args.send:
+        sender = config.get("transmitter", {})
+        transmitter = _433.tx(pigpio("transmitter"), gpio=sender.get("gpio", 4))
+        def sent(code):
+            print("sent {}".format(code))
+        for code in args.send:
+            transmitter.send_async(code).addCallbacks(sent, err, errbackArgs=("send failed",))
 
-            tx.cancel() # Cancel the transmitter.
+    gpio = receiver.get("gpio", 3)
+    if args.capture:
+        recording = rf_capture.Capture(args.capture)
+        decoder = _433.bulk_rx(None, recording.gpio, remote.code, start_tick=recording.start)
+        d = rf_capture.replay_on_reactor(recording, decoder.feed, glitch=receiver.get("glitch"))
+        d.addErrback(err, "replay failed")
+        d.addBoth(lambda _: reactor.callLater(remote.holdoff, reactor.stop))
+    else:
+        decoder = _433.bulk_rx(pigpio("receiver"), gpio, remote.code, glitch=receiver.get("glitch", 150))
+        EdgeReader(decoder).start()
 
-        time.sleep(60)
+    print("Running")
+    try:
+        reactor.run()
     finally:
-        rx.cancel() # Cancel the receiver.
+        remote.release_all()
+        print("fob: {}".format(remote.stats()))
+        decoder.cancel()
+        if transmitter is not None:
+            transmitter.cancel()
+        backend.cleanup()
+
 
-        pi.stop() # Disconnect from local Pi.
+if __name__ == "__main__":
+    main()
@@ -1,130 +1,175 @@
-#!/usr/bin/env python
 #! /usr/bin/env python
-## Networked Turret Controller
-# acts as a server
-from sys import stdout
+## Terminal Turret Controller
+# Arrow keys tilt and pan while held, space fires, w stops everything and q
+# quits. stdin is read by the reactor, so nothing runs between keystrokes.
+import argparse
+import sys
+import termios
+import tty
+
 from twisted.python.log import startLogging, err
-from twisted.internet import reactor, task
-from twisted.internet.protocol import Factory
-from twisted.internet.endpoints import TCP4ClientEndpoint
-from twisted.application.internet import ClientService, backoffPolicy
+from twisted.internet import reactor, stdio, protocol
 
-from twisted.protocols.amp import Integer, Float, String, Boolean, Command
-from twisted.protocols import amp
+from turret_client import TurretClient
 
-import curses
-import argparse
+UP, DOWN, LEFT, RIGHT = "up", "down", "left", "right"
+FIRE, STOP, QUIT = b" ", b"w", b"q"
+
+# final byte of the arrow escape sequences (ESC [ x, or ESC O x in
+# application cursor mode)
+arrows = {b"A": UP, b"B": DOWN, b"C": RIGHT, b"D": LEFT}
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    
-    parser.add_argument("-t", "--tilt", action="store", type=float)
-    parser.add_argument("-p", "--pan", action="store", type=float)
-    parser.add_argument("-f", "--fire", action="store_true", default=False)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8750)
+    parser.add_argument("--turret", help="turret id, for a fleet server")
+    parser.add_argument("-t", "--tilt-speed", type=float, default=45.0, help="degrees per second")
+    parser.add_argument("-p", "--pan-speed", type=float, default=45.0, help="degrees per second")
+    parser.add_argument("--log", help="log to this file (the terminal is in use)")
     return parser.parse_args()
 
-class TiltCommand(Command):
-    arguments = [('speed', Float())]
-    requiresAnswer = False
-
-class PanCommand(Command):
-    arguments = [('speed', Float())]
-    requiresAnswer = False
-
-class StopTiltCommand(Command):
-    requiresAnswer = False
-
-class StopPanCommand(Command):
-    requiresAnswer = False
 
-class FireCommand(Command):
-    requiresAnswer = False
-
-class KeepalivePing(Command):
-    pass
-
-def connect():
-    endpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', 8750)
-    factory = Factory()
-    factory.protocol = amp.AMP
-    service = ClientService(endpoint, factory, retryPolicy=backoffPolicy(0.5, 15.0))
-    service.startService()
-    return service.whenConnected()
-
-def keepalive(p):
-    d = p.callRemote(KeepalivePing)
-
-def start_keepalive(p):
-    loop = task.LoopingCall(f=keepalive, a=p)
-    loop.start(3)
-
-def curses_check():
-    c = stdscr.getch()
-    if c == ord('q'):
-       return 
-    else:
-        controls[c]()
-    try:
-        key = chr(c)
-    except:
-        key = str(c)
-    stdscr.addstr(0,0, key)
-
-def init_curses():
-    global stdscr
-    stdscr = curses.initscr()
-    curses.noecho()
-    curses.cbreak()
-    stdscr.keypad(1)
-
-def end_curses():
-    curses.nocbreak()
-    stdscr.keypad(0)
-    curses.echo()
-    curses.endwin()
-
-def connected(p):
-    input_loop = task.LoopingCall(f=curses_check, a=None)
-    input_loop.start( 1 / 500)
-    start_keepalive(p)
-
-
-def main(stdscr):
+class HeldKeys(object):
+    """ Press and release events from a terminal, which only sends repeats.
+
+    A key is pressed on its first byte and released once its repeats stop:
+    after `delay` if none has come yet (the keyboard's repeat delay), or
+    after a few repeat intervals once they are flowing. Both are learnt
+    from the repeats seen, so a tap is released about as quickly as the
+    keyboard allows. The delay is only learnt once a second repeat shows
+    the first was one, not a quick double tap. Terminals only repeat the
+    last key pressed, so pressing another key releases the one before.
+    """
+    margin = 1.5 # allowance on the learnt repeat delay
+    gaps = 3 # repeat intervals to wait before calling a key released
+
+    def __init__(self, pressed, released, clock=reactor.seconds, delay=0.7, interval=0.05):
+        self.pressed = pressed
+        self.released = released
+        self.clock = clock
+        self.delay = delay
+        self.interval = interval
+        self.held = {} # key -> [last seen, repeats so far, release call, first gap]
+
+    def key(self, name):
+        now = self.clock()
+        state = self.held.get(name)
+        if state is None:
+            for other in list(self.held):
+                self._release(other)
+            call = reactor.callLater(self.delay, self._release, name)
+            self.held[name] = [now, 0, call, None]
+            self.pressed(name)
+            return
+        gap = now - state[0]
+        if state[1] == 0:
+            state[3] = gap # the repeat delay, or a quick second tap
+        else:
+            if state[1] == 1 and gap < state[3]:
+                # repeats have followed at the (shorter) repeat interval,
+                # so the first gap really was the keyboard's repeat delay
+                self.delay = max(0.1, state[3] * self.margin)
+            self.interval += (gap - self.interval) / 4.0
+        state[0] = now
+        state[1] += 1
+        state[2].reset(max(0.02, self.gaps * self.interval))
+
+    def _release(self, name):
+        state = self.held.pop(name, None)
+        if state is None:
+            return
+        if state[2].active():
+            state[2].cancel()
+        self.released(name)
+
+    def release_all(self):
+        for name in list(self.held):
+            self._release(name)
+
+
+class TerminalControls(protocol.Protocol):
+    """ Keys from stdin to commands on the client; one status line out """
+    def __init__(self, client, tilt_speed=45.0, pan_speed=45.0):
+        self.client = client
+        self.speeds = {UP: ("tilt", tilt_speed), DOWN: ("tilt", -tilt_speed),
+                       LEFT: ("pan", -pan_speed), RIGHT: ("pan", pan_speed)}
+        self.keys = HeldKeys(self.pressed, self.released)
+        self.axes = {} # axis -> the key driving it
+        self.buffer = b""
+
+    def connectionMade(self):
+        self.show("arrows move, space fires, w stops, q quits")
+
+    def dataReceived(self, data):
+        data = self.buffer + data
+        while data:
+            if data[:1] == b"\x1b":
+                if len(data) < 3:
+                    break # the rest of the sequence is on its way
+                name = arrows.get(data[2:3]) if data[1:2] in (b"[", b"O") else None
+                data = data[3:]
+            else:
+                name, data = data[:1], data[1:]
+            if name in self.speeds:
+                self.keys.key(name)
+            elif name == FIRE:
+                self.client.fire()
+                self.show("fire")
+            elif name == STOP:
+                self.keys.release_all()
+                self.client.stop_all()
+                self.show("stop")
+            elif name == QUIT:
+                self.quit()
+                return
+        self.buffer = data
+
+    def pressed(self, name):
+        axis, speed = self.speeds[name]
+        self.axes[axis] = name
+        getattr(self.client, axis)(speed)
+        self.show(name)
+
+    def released(self, name):
+        axis, speed = self.speeds[name]
+        if self.axes.get(axis) != name:
+            return # another key has the axis now
+        del self.axes[axis]
+        getattr(self.client, "stop_" + axis)()
+        self.show("")
+
+    def show(self, text):
+        link = self.client.link
+        rtt = "rtt {:.1f}ms".format(link.rtt * 1e3) if link.rtt is not None else "no link yet"
+        self.transport.write("\r{:<50} {}\x1b[K".format(text, rtt).encode("ascii"))
+
+    def quit(self):
+        self.keys.release_all()
+        self.client.stop_all()
+        self.transport.write(b"\r\n")
+        self.client.stop().addBoth(lambda _: reactor.stop())
+
+
+def main():
+    args = parse_args()
+    if args.log:
+        startLogging(open(args.log, "a"))
+
+    client = TurretClient(args.host, args.port, args.turret)
+    d = client.start()
+    d.addErrback(err, 'connection failed')
+    stdio.StandardIO(TerminalControls(client, args.tilt_speed, args.pan_speed))
+
+    # keys arrive one at a time, unechoed, and ctrl-c still interrupts
+    fd = sys.stdin.fileno()
+    saved = termios.tcgetattr(fd)
     try:
-        startLogging(stdout)
-        init_curses()
-        d = connect()
-        d.addCallback(connected)
-        d.addErrback(err, 'connection failed')
-        d.addErrback(lambda p: reactor.stop())
+        tty.setcbreak(fd)
         reactor.run()
     finally:
-        end_curses()
-
-
-    
-def Up():
-    turret.tilt(45)
-def Down():
-    turret.tilt(-45)
-def Left():
-    turret.pan_forever(-1)
-def Right():
-    turret.pan_forever(1)
-    
-def stop_all():
-    myturret.StopTilt()
-    myturret.StopPan()
-        
-controls = {curses.KEY_UP: Up,
-            curses.KEY_DOWN: Down,
-            curses.KEY_LEFT: Left,
-            curses.KEY_RIGHT: Right,
-            ord(' '): turret.fire,
-            ord('w'): stop_all
-            }
-    
+        termios.tcsetattr(fd, termios.TCSADRAIN, saved)
 
 
 if __name__ == "__main__":
-    curses.wrapper(main)
+    main()
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+## Hardware backends
+# A backend says where a Turret gets its I2C bus, RPi.GPIO and pigpio from.
+# Nothing is imported until a Turret asks for it, so TestTurret and --test
+# runs start on any host, and argument parsing happens before hardware init.
+
+
+class Backend(object):
+    """ Lazily loaded hardware for one process; shared by every Turret using it.
+
+    i2c(address, busnum) opens a PCA9685's bus device, gpio() returns an
+    RPi.GPIO-like module and pigpio() the pigpio-like module to use for DMA
+    waveforms (or None to drive the stepper through gpio instead).
+    Turrets on the same chip share one driver, see pwm().
+    """
+    def __init__(self, name, i2c, gpio, pigpio=None):
+        self.name = name
+        self._i2c = i2c
+        self._gpio = gpio
+        self._pigpio = pigpio
+        self.devices = {} # (address, busnum) -> I2C device
+        self.drivers = {} # (address, busnum) -> PCA9685 driver
+        self._gpio_module = None
+        self._pi = None
+        self._waves_claimed = False
+
+    def i2c_device(self, address=0x40, busnum=None):
+        key = (address, busnum)
+        if key not in self.devices:
+            self.devices[key] = self._i2c(address, busnum)
+        return self.devices[key]
+
+    def pwm(self, address=0x40, busnum=None):
+        """ The chip's driver, made once: the chip is only reset once, and
+        channel writes from every turret on it in one reactor tick go out
+        together, in as few block writes as the channels allow """
+        key = (address, busnum)
+        if key not in self.drivers:
+            from pca9685 import BatchedPCA9685, CachedPCA9685
+            self.drivers[key] = CachedPCA9685(BatchedPCA9685(self.i2c_device(address, busnum)))
+        return self.drivers[key]
+
+    def gpio(self):
+        if self._gpio_module is None:
+            self._gpio_module = self._gpio()
+            # Use BCM GPIO references
+            # instead of physical pin numbers
+            self._gpio_module.setmode(self._gpio_module.BCM)
+        return self._gpio_module
+
+    def pigpio(self):
+        """ (module, connected pi), or None when pigpio isn't available """
+        if self._pi is None and self._pigpio is not None:
+            module = self._pigpio()
+            if module is None:
+                self._pigpio = None
+                return None
+            pi = module.pi()
+            if not pi.connected:
+                self._pigpio = None
+                return None
+            self._pi = (module, pi)
+        return self._pi
+
+    def claim_waves(self):
+        """ pigpio() for the one stepper that may drive the wave engine;
+        None for everyone after it """
+        if self._waves_claimed:
+            return None
+        pigpio = self.pigpio()
+        self._waves_claimed = pigpio is not None
+        return pigpio
+
+    def cleanup(self):
+        if self._gpio_module is not None:
+            self._gpio_module.cleanup()
+            self._gpio_module = None
+
+
+def _adafruit_i2c(address, busnum):
+    from pca9685 import get_i2c_device
+    return get_i2c_device(address, busnum)
+
+def _rpi_gpio():
+    import RPi.GPIO as GPIO
+    return GPIO
+
+def _pigpio():
+    try:
+        import pigpio
+    except ImportError:
+        return None
+    return pigpio
+
+def _sim_i2c(address, busnum):
+    from fake_i2c import SimulatedI2CDevice
+    return SimulatedI2CDevice(address)
+
+def _fake_gpio():
+    import fake_gpio
+    return fake_gpio
+
+def _fake_pigpio():
+    import fake_pigpio
+    return fake_pigpio
+
+
+_registry = {}
+
+def register(backend):
+    _registry[backend.name] = backend
+    return backend
+
+def get(name):
+    """ The backend registered as name; Backend instances pass straight through """
+    if isinstance(name, Backend):
+        return name
+    try:
+        return _registry[name]
+    except KeyError:
+        raise KeyError("unknown backend {!r}, have {}".format(name, ", ".join(sorted(_registry))))
+
+def names():
+    return sorted(_registry)
+
+def cleanup():
+    """ Release every registered backend's GPIO. Backends are shared by all
+    the turrets in a process, so this is for when the process is done with
+    them, not for any one turret """
+    for backend in _registry.values():
+        backend.cleanup()
+
+register(Backend("real", _adafruit_i2c, _rpi_gpio, _pigpio))
+register(Backend("sim", _sim_i2c, _fake_gpio))
+register(Backend("sim-pigpio", _sim_i2c, _fake_gpio, _fake_pigpio))
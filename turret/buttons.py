@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+## Push button input
+# RPi.GPIO runs edge callbacks on its own thread, where touching a Turret (or
+# anything that schedules reactor calls) races the reactor. Buttons only
+# timestamps each edge there and hands them over in batches through
+# callFromThread; presses and releases are worked out on the reactor thread,
+# debounced from the timestamps.
+import threading
+
+from twisted.internet import reactor
+
+from timing import monotonic
+from loopstats import Histogram
+
+
+class Button(object):
+    """ One input pin's callbacks and debounce state """
+    def __init__(self, pin, pressed, released, debounce, active_low):
+        self.pin = pin
+        self.pressed = pressed
+        self.released = released
+        self.debounce = debounce
+        self.active_low = active_low
+        self.down = False # debounced state
+        self.level = False # latest raw state seen
+        self.quiet_until = 0.0 # edges before this are bounce
+        self.settle = None # looks at the pin again once it's quiet
+
+
+class Buttons(object):
+    """ pressed/released callbacks for push buttons, run on the reactor.
+
+    Debouncing is leading-edge: a change is acted on at once, then the pin's
+    edges are ignored for `debounce` seconds, and at the end of that window
+    the pin is read again in case it has since changed back. A press costs
+    no added latency and bounce inside the window never gets through, while
+    a release that RPi.GPIO's own bouncetime swallowed is still seen.
+    """
+    def __init__(self, gpio, clock=monotonic):
+        self.gpio = gpio
+        self.clock = clock
+        self.buttons = {} # pin -> Button
+        self.edges = 0
+        self.bounces = 0 # edges dropped inside a debounce window
+        self.batches = 0
+        self.latency = Histogram() # edge to callback, in seconds
+        self._lock = threading.Lock()
+        self._pending = [] # (time, pin, level) from the GPIO thread
+        self._scheduled = False
+
+    def add(self, pin, pressed, released=None, debounce=0.02, pull="down", bouncetime=None):
+        """ Watch pin; pull "down" means pressed reads high, "up" pressed reads low.
+        bouncetime (ms) is passed on to RPi.GPIO, if given """
+        gpio = self.gpio
+        gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP if pull == "up" else gpio.PUD_DOWN)
+        button = self.buttons[pin] = Button(pin, pressed, released, debounce, pull == "up")
+        button.level = button.down = self._is_down(button, gpio.input(pin))
+        options = {"bouncetime": bouncetime} if bouncetime else {}
+        gpio.add_event_detect(pin, gpio.BOTH, callback=self._edge, **options)
+        return button
+
+    def remove(self, pin):
+        button = self.buttons.pop(pin)
+        self.gpio.remove_event_detect(pin)
+        if button.settle is not None and button.settle.active():
+            button.settle.cancel()
+
+    def _is_down(self, button, level):
+        return bool(level) != button.active_low
+
+    def _edge(self, pin):
+        # on the GPIO thread: stamp it, queue it, and wake the reactor once per batch
+        edge = (self.clock(), pin, self.gpio.input(pin))
+        with self._lock:
+            self._pending.append(edge)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        reactor.callFromThread(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            edges, self._pending = self._pending, []
+            self._scheduled = False
+        self.batches += 1
+        for t, pin, level in edges:
+            button = self.buttons.get(pin)
+            if button is None:
+                continue
+            self.edges += 1
+            button.level = self._is_down(button, level)
+            if t < button.quiet_until:
+                self.bounces += 1
+                continue
+            self._change(button, t)
+
+    def _change(self, button, t):
+        if button.level == button.down:
+            return
+        button.down = button.level
+        button.quiet_until = t + button.debounce
+        if button.settle is not None and button.settle.active():
+            button.settle.cancel()
+        button.settle = reactor.callLater(max(0.0, button.quiet_until - self.clock()),
+                                          self._settle, button)
+        self.latency.add(max(0.0, self.clock() - t))
+        callback = button.pressed if button.down else button.released
+        if callback is not None:
+            callback()
+
+    def _settle(self, button):
+        button.settle = None
+        button.level = self._is_down(button, self.gpio.input(button.pin))
+        self._change(button, max(button.quiet_until, self.clock()))
+
+    def stats(self):
+        ms = 1e3
+        return {"edges": self.edges, "bounces": self.bounces, "batches": self.batches,
+                "latency_p50_ms": self.latency.percentile(50) * ms,
+                "latency_p99_ms": self.latency.percentile(99) * ms,
+                "latency_max_ms": self.latency.max * ms}
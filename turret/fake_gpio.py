@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+## Fake RPi.GPIO
+# Enough of the RPi.GPIO module API to run the turret without a Pi. Pin levels
+# are kept in memory and every call into the module is counted, so hot paths
+# can be measured by how often they cross into the GPIO library.
+# Set log to a list (or anything with append) to also record every output()
+# as (time, pins, levels), timestamped with the monotonic clock.
+# Inputs are driven with set_input(), or with an EdgeInjector playing a
+# script of edges on its own thread, the way RPi.GPIO calls back.
+import threading
+import time
+
+from timing import monotonic
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+mode = None
+levels = {}
+directions = {}
+events = {} # channel -> (edge, callback), from add_event_detect
+calls = 0 # output() calls, each one a trip into the C library
+pin_writes = 0 # individual pin levels written
+log = None
+
+
+def reset_counters():
+    global calls, pin_writes
+    calls = 0
+    pin_writes = 0
+
+def setmode(m):
+    global mode
+    mode = m
+
+def getmode():
+    return mode
+
+def setwarnings(flag):
+    pass
+
+def setup(channel, direction, pull_up_down=PUD_OFF, initial=None):
+    for pin in _channels(channel):
+        directions[pin] = direction
+        if initial is not None:
+            levels[pin] = initial
+        elif direction == IN and pull_up_down != PUD_OFF:
+            levels.setdefault(pin, HIGH if pull_up_down == PUD_UP else LOW)
+
+def output(channel, value):
+    """ Like RPi.GPIO, channel and value may be single values or sequences """
+    global calls, pin_writes
+    calls += 1
+    pins = _channels(channel)
+    if isinstance(value, (list, tuple)):
+        values = value
+    else:
+        values = [value]*len(pins)
+    for pin, v in zip(pins, values):
+        levels[pin] = 1 if v else 0
+    pin_writes += len(pins)
+    if log is not None:
+        log.append((monotonic(), tuple(pins), tuple(values)))
+
+def input(channel):
+    return levels.get(channel, LOW)
+
+def add_event_detect(channel, edge, callback=None, bouncetime=None):
+    events[channel] = (edge, callback)
+
+def remove_event_detect(channel):
+    events.pop(channel, None)
+
+def set_input(channel, level):
+    """ Drive an input as the outside world would; an edge runs the pin's
+    callback on the calling thread """
+    level = HIGH if level else LOW
+    if levels.get(channel, LOW) == level:
+        return
+    levels[channel] = level
+    edge, callback = events.get(channel, (None, None))
+    if callback is not None and edge in (BOTH, RISING if level else FALLING):
+        callback(channel)
+
+def press(channel, hold, bounces=0, spacing=0.0005, after=0.0, active_low=False):
+    """ EdgeInjector steps for one press of a switch held `hold` seconds,
+    chattering `bounces` times `spacing` apart as it makes and breaks """
+    down, up = (LOW, HIGH) if active_low else (HIGH, LOW)
+    steps = [(after, channel, down)]
+    steps += [(spacing, channel, up), (spacing, channel, down)] * bounces
+    steps.append((hold, channel, up))
+    steps += [(spacing, channel, down), (spacing, channel, up)] * bounces
+    return steps
+
+
+class EdgeInjector(threading.Thread):
+    """ Plays (delay, channel, level) steps on its own thread, delay being
+    seconds after the step before is due. Each step is logged to `played` as
+    (monotonic time, channel, level) """
+    daemon = True
+
+    def __init__(self, steps):
+        threading.Thread.__init__(self)
+        self.steps = steps
+        self.played = []
+
+    def run(self):
+        due = monotonic()
+        for delay, channel, level in self.steps:
+            # sleep to the step's place on the timeline, so one late wakeup
+            # doesn't stretch everything after it
+            due += delay
+            wait = due - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.played.append((monotonic(), channel, level))
+            set_input(channel, level)
+
+def cleanup(channel=None):
+    global mode
+    if channel is None:
+        levels.clear()
+        directions.clear()
+        events.clear()
+        mode = None
+    else:
+        for pin in _channels(channel):
+            levels.pop(pin, None)
+            directions.pop(pin, None)
+            events.pop(pin, None)
+
+def _channels(channel):
+    if isinstance(channel, (list, tuple)):
+        return list(channel)
+    return [channel]
@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+## Simulated I2C bus backend
+# Stands in for an Adafruit_GPIO I2C device so PWM write patterns can be
+# measured on a machine with no Pi.
+from timing import monotonic
+
+
+class SimulatedI2CDevice(object):
+    """ Register file plus bus counters, with the Adafruit_GPIO device API
+
+    transactions counts every start..stop sequence on the bus.
+    bytes_written counts the register pointer and data bytes sent to the
+    chip (the address byte is not included).
+    Set log to a list (or anything with append) to also record every write
+    as (time, register, values), timestamped with the monotonic clock.
+    """
+    def __init__(self, address=0x40):
+        self.address = address
+        self.registers = bytearray(256)
+        self.log = None
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def write8(self, register, value):
+        self.registers[register] = value & 0xFF
+        self.transactions += 1
+        self.bytes_written += 2
+        if self.log is not None:
+            self.log.append((monotonic(), register, [value]))
+
+    def writeList(self, register, data):
+        """ Block write, with the register pointer auto-incrementing """
+        for i, value in enumerate(data):
+            self.registers[(register + i) & 0xFF] = value & 0xFF
+        self.transactions += 1
+        self.bytes_written += 1 + len(data)
+        if self.log is not None:
+            self.log.append((monotonic(), register, list(data)))
+
+    def readU8(self, register):
+        self.transactions += 1
+        self.bytes_written += 1
+        self.bytes_read += 1
+        return self.registers[register]
+
+    def channel(self, ch):
+        """ Decode the (on, off) counts currently held for a PCA9685 channel """
+        base = 0x06 + 4*ch
+        r = self.registers
+        return (r[base] | r[base+1] << 8, r[base+2] | r[base+3] << 8)
+
+    def stats(self):
+        return {"transactions": self.transactions,
+                "bytes_written": self.bytes_written,
+                "bytes_read": self.bytes_read}
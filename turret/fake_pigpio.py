@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+## Fake pigpio
+# Enough of the pigpio module API to compile and check waveforms without a
+# pigpio daemon. Pass the module itself wherever the real pigpio module is
+# expected, and fake_pigpio.pi() wherever a connected pi is.
+from timing import monotonic
+
+INPUT = 0
+OUTPUT = 1
+
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+
+WAVE_MAX_PULSES = 12000
+
+
+class pulse(object):
+    """ Same fields as pigpio.pulse """
+    def __init__(self, gpio_on, gpio_off, delay):
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay
+
+    def __repr__(self):
+        return "pulse({:#x}, {:#x}, {})".format(self.gpio_on, self.gpio_off, self.delay)
+
+def tickDiff(t1, t2):
+    return (t2 - t1) & 0xFFFFFFFF
+
+
+class _callback(object):
+    """ What pi.callback returns; edge() runs func as pigpio's thread would """
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+
+def expand_chain(waves, chain):
+    """ Flatten a wave_chain command list into the pulses it would play.
+
+    Returns (pulses, forever): forever is the loop body repeated until
+    wave_tx_stop when the chain ends in 255 3, else None. Supports loops
+    (255 0 ... 255 1 x y) and delays (255 2 x y).
+    """
+    stack = [[]]
+    i = 0
+    while i < len(chain):
+        c = chain[i]
+        if c == 255:
+            cmd = chain[i+1]
+            if cmd == 0:
+                stack.append([])
+                i += 2
+            elif cmd == 1:
+                count = chain[i+2] + 256*chain[i+3]
+                body = stack.pop()
+                stack[-1].extend(body * count)
+                i += 4
+            elif cmd == 2:
+                stack[-1].append(pulse(0, 0, chain[i+2] + 256*chain[i+3]))
+                i += 4
+            elif cmd == 3:
+                body = stack.pop()
+                return stack[-1], body
+            else:
+                raise ValueError("unsupported chain command 255 {}".format(cmd))
+        else:
+            stack[-1].extend(waves[c])
+            i += 1
+    return stack[0], None
+
+
+class pi(object):
+    """ A pigpio connection with simulated GPIO levels and wave playback.
+
+    Waves play against `clock` (seconds), so wave_tx_busy and the bank levels
+    behave as they would on hardware, without any real timing.
+    Set log to a list (or anything with append) to record every level write
+    and transmission as (time, operation, argument).
+    """
+    connected = True
+
+    def __init__(self, host=None, port=None, clock=monotonic):
+        self.clock = clock
+        self.log = None
+        self.modes = {}
+        self.levels = 0
+        self.writes = 0
+        self.waves = {}
+        self.sent = [] # (kind, wave id or chain) per transmission, for inspection
+        self._new = []
+        self._tx = None # (start, pulses played once, pulses repeated or None)
+        self.callbacks = []
+
+    # GPIO
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+
+    def get_mode(self, gpio):
+        return self.modes.get(gpio, INPUT)
+
+    def write(self, gpio, level):
+        self.writes += 1
+        self._log("write", (gpio, level))
+        if level:
+            self.levels |= 1 << gpio
+        else:
+            self.levels &= ~(1 << gpio)
+
+    def read(self, gpio):
+        return (self.read_bank_1() >> gpio) & 1
+
+    def set_bank_1(self, bits):
+        self.writes += 1
+        self._log("set_bank_1", bits)
+        self.levels |= bits
+
+    def clear_bank_1(self, bits):
+        self.writes += 1
+        self._log("clear_bank_1", bits)
+        self.levels &= ~bits
+
+    def read_bank_1(self):
+        self._advance()
+        return self.levels
+
+    def get_current_tick(self):
+        return int(self.clock() * 1e6) & 0xFFFFFFFF
+
+    def set_glitch_filter(self, gpio, steady):
+        pass
+
+    def callback(self, user_gpio, edge=RISING_EDGE, func=None):
+        cb = _callback(self, user_gpio, edge, func)
+        self.callbacks.append(cb)
+        return cb
+
+    def edge(self, gpio, level, tick):
+        """ An input edge at tick: runs the callbacks watching for it """
+        for cb in list(self.callbacks):
+            if cb.gpio == gpio and cb.edge in (EITHER_EDGE, FALLING_EDGE if level == 0 else RISING_EDGE):
+                cb.func(gpio, level, tick)
+
+    # Waves
+    def wave_clear(self):
+        self.waves = {}
+        self._new = []
+
+    def wave_add_new(self):
+        self._new = []
+
+    def wave_add_generic(self, pulses):
+        self._new.extend(pulses)
+        return len(self._new)
+
+    def wave_create(self):
+        wid = 0 # like pigpio, reuse the lowest free id
+        while wid in self.waves:
+            wid += 1
+        self.waves[wid] = self._new
+        self._new = []
+        return wid
+
+    def wave_delete(self, wave_id):
+        del self.waves[wave_id]
+
+    def wave_get_max_pulses(self):
+        return WAVE_MAX_PULSES
+
+    def wave_send_once(self, wave_id):
+        self._start(list(self.waves[wave_id]), None)
+        self.sent.append(("once", wave_id))
+        self._log("wave_send_once", wave_id)
+
+    def wave_send_repeat(self, wave_id):
+        self._start([], list(self.waves[wave_id]))
+        self.sent.append(("repeat", wave_id))
+        self._log("wave_send_repeat", wave_id)
+
+    def wave_chain(self, data):
+        once, forever = expand_chain(self.waves, data)
+        self._start(once, forever)
+        self.sent.append(("chain", list(data)))
+        self._log("wave_chain", list(data))
+
+    def wave_tx_busy(self):
+        self._advance()
+        return 1 if self._tx is not None else 0
+
+    def wave_tx_stop(self):
+        self._advance()
+        self._tx = None
+
+    def stop(self):
+        self.connected = False
+
+    def _log(self, op, arg):
+        if self.log is not None:
+            self.log.append((monotonic(), op, arg))
+
+    def _start(self, once, forever):
+        self._advance()
+        self._tx = (self.clock(), once, forever)
+
+    def _advance(self):
+        """ Apply every pulse that has started by now """
+        if self._tx is None:
+            return
+        start, once, forever = self._tx
+        elapsed = (self.clock() - start) * 1e6
+        t = 0
+        for p in once:
+            if t > elapsed:
+                return
+            self._apply(p)
+            t += p.delay
+        if forever is None:
+            if elapsed >= t:
+                self._tx = None
+            return
+        period = sum(p.delay for p in forever)
+        into = elapsed - t
+        if period and into >= period:
+            # whole cycles leave the levels as after one cycle
+            for p in forever:
+                self._apply(p)
+            into %= period
+        t = 0
+        for p in forever:
+            if t > into:
+                break
+            self._apply(p)
+            t += p.delay
+
+    def _apply(self, p):
+        self.levels = (self.levels | p.gpio_on) & ~p.gpio_off
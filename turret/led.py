@@ -16,12 +16,14 @@ class DimmerRGB():
         self.ch_r = ch_r
         self.ch_g = ch_g
         self.ch_b = ch_b
+        self.color = None # last set_color
     
     def set_color(self, r, g, b):
         """ brightness being float from 0-1"""
         assert(0 <= r <= 1)
         assert(0 <= g <= 1)
         assert(0 <= b <= 1)
+        self.color = (r, g, b)
         self.pwm.set_pwm(self.ch_r, 0, int(r*4095))
         self.pwm.set_pwm(self.ch_g, 0, int(g*4095))
         self.pwm.set_pwm(self.ch_b, 0, int(b*4095))
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+## Loop timing statistics
+# Per-tick lateness and run time for the periodic actuator loops, kept in
+# fixed-size log-scale histograms so recording costs the same forever.
+import math
+
+from twisted.internet import reactor
+
+
+class Histogram(object):
+    """ Durations in log-spaced buckets, `per_octave` per doubling, from 1us
+    up to 2**octaves us. Percentiles are reported as the bucket's upper edge.
+    """
+    per_octave = 4
+    octaves = 24 # ~16 s
+
+    def __init__(self):
+        self.counts = [0]*(self.per_octave*self.octaves + 1)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        if us < 1:
+            i = 0
+        else:
+            i = min(int(math.log(us, 2) * self.per_octave) + 1, len(self.counts) - 1)
+        self.counts[i] += 1
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        target = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(2 ** (float(i) / self.per_octave) / 1e6, self.max)
+        return self.max
+
+    def reset(self):
+        self.counts = [0]*len(self.counts)
+        self.count = 0
+        self.max = 0.0
+
+
+class LoopStats(object):
+    """ Lateness and run time of one loop.
+
+    Call begin()/end() around each tick. For a fixed-interval loop
+    (LoopingCall) the next deadline follows from `interval`, skipping ahead
+    the way LoopingCall does when ticks are missed; loops that schedule
+    themselves with callLater call expect(delay) instead. A tick later than
+    its own period counts as missed.
+    """
+    def __init__(self, name, interval=None, clock=reactor.seconds):
+        self.name = name
+        self.interval = interval
+        self.clock = clock
+        self.lateness = Histogram()
+        self.runtime = Histogram()
+        self.ticks = 0
+        self.missed = 0
+        self._next = None # when the next tick is due
+        self._period = interval
+        self._began = 0.0
+
+    def expect(self, delay):
+        """ The next tick is due `delay` seconds from now """
+        self._next = self.clock() + delay
+        self._period = delay
+
+    def idle(self):
+        """ The loop stopped; don't count the gap until it restarts as lateness """
+        self._next = None
+
+    def begin(self):
+        now = self._began = self.clock()
+        self.ticks += 1
+        if self._next is None:
+            return
+        late = max(0.0, now - self._next)
+        self.lateness.add(late)
+        missed = int(late / self._period) if self._period else 0
+        self.missed += missed
+        if self.interval:
+            self._next += (missed + 1) * self.interval
+        else:
+            self._next = None
+
+    def end(self):
+        self.runtime.add(self.clock() - self._began)
+
+    def reset(self):
+        self.lateness.reset()
+        self.runtime.reset()
+        self.ticks = 0
+        self.missed = 0
+
+    def summary(self):
+        ms = 1e3
+        return {"interval_ms": self.interval * ms if self.interval else None,
+                "ticks": self.ticks,
+                "missed": self.missed,
+                "late_p50_ms": self.lateness.percentile(50) * ms,
+                "late_p99_ms": self.lateness.percentile(99) * ms,
+                "late_max_ms": self.lateness.max * ms,
+                "run_p50_ms": self.runtime.percentile(50) * ms,
+                "run_p99_ms": self.runtime.percentile(99) * ms,
+                "run_max_ms": self.runtime.max * ms}
+
+
+loops = {} # name -> LoopStats, for every instrumented loop in the process
+
+def loop_stats(name, interval=None):
+    """ The LoopStats registered under name, created on first use """
+    stats = loops.get(name)
+    if stats is None:
+        stats = loops[name] = LoopStats(name, interval)
+    return stats
+
+def summary():
+    return dict((name, stats.summary()) for name, stats in loops.items())
@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+## Stepper motion planning
+# Builds step-interval tables for accelerated moves. A 28BYJ-style motor
+# stalls if it is started straight at a short step delay, so every move ramps
+# up from a pull-in speed, cruises, and ramps back down.
+import math
+
+TRAPEZOID = "trapezoid"
+SCURVE = "scurve"
+
+
+def trapezoid_ramp(start_speed, max_speed, accel):
+    """ Intervals (s) for each step while ramping up at constant acceleration.
+    Speeds are in steps/s, accel in steps/s^2.
+    """
+    ramp = []
+    v2 = start_speed * start_speed
+    while v2 < max_speed * max_speed:
+        ramp.append(1.0 / math.sqrt(v2))
+        v2 += 2.0 * accel # v^2 = v0^2 + 2as, one step at a time
+    return ramp
+
+def scurve_ramp(start_speed, max_speed, accel):
+    """ Intervals (s) for a jerk-limited ramp: speed follows a half cosine in
+    time, with accel as the peak acceleration at the midpoint.
+    """
+    span = max_speed - start_speed
+    if span <= 0:
+        return []
+    duration = math.pi * span / (2.0 * accel)
+    ramp = []
+    t = 0.0
+    while t < duration:
+        v = start_speed + span * (1 - math.cos(math.pi * t / duration)) / 2
+        ramp.append(1.0 / v)
+        t += 1.0 / v
+    return ramp
+
+ramps = {TRAPEZOID: trapezoid_ramp,
+         SCURVE: scurve_ramp}
+
+
+class MotionPlanner(object):
+    """ Step-interval tables for a stepper, cached per (distance, profile).
+
+    A move is split into (accel, cruise, decel): the intervals while speeding
+    up, how many steps to run at max_speed, and the intervals while slowing
+    down. Short moves never reach max_speed and get a triangular profile.
+    """
+    cache_size = 256
+
+    def __init__(self, max_speed, accel, start_speed, profile=TRAPEZOID):
+        self.max_speed = float(max_speed)
+        self.accel = float(accel)
+        self.start_speed = float(start_speed)
+        self.profile = profile
+        self._ramps = {}
+        self._moves = {}
+
+    @property
+    def cruise_interval(self):
+        return 1.0 / self.max_speed
+
+    def ramp(self, profile=None):
+        profile = profile or self.profile
+        if profile not in self._ramps:
+            build = ramps[profile]
+            self._ramps[profile] = tuple(build(self.start_speed, self.max_speed, self.accel))
+        return self._ramps[profile]
+
+    def move_parts(self, steps, profile=None):
+        """ (accel, cruise steps, decel) for a move of `steps` steps """
+        profile = profile or self.profile
+        key = (steps, profile)
+        parts = self._moves.get(key)
+        if parts is None:
+            ramp = self.ramp(profile)
+            if 2*len(ramp) <= steps:
+                parts = (ramp, steps - 2*len(ramp), ramp[::-1])
+            else:
+                up = (steps + 1) // 2
+                parts = (ramp[:up], 0, ramp[:steps - up][::-1])
+            if len(self._moves) >= self.cache_size:
+                self._moves.clear()
+            self._moves[key] = parts
+        return parts
+
+    def move(self, steps, profile=None):
+        """ Flat interval table for a move; interval i follows step i """
+        accel, cruise, decel = self.move_parts(steps, profile)
+        return list(accel) + [self.cruise_interval]*cruise + list(decel)
+
+    def decel_from(self, level, profile=None):
+        """ Intervals to come to rest from `level` steps up the ramp """
+        return self.ramp(profile)[:level][::-1]
+
+    def duration(self, steps, profile=None):
+        accel, cruise, decel = self.move_parts(steps, profile)
+        return sum(accel) + cruise*self.cruise_interval + sum(decel)
+
+
+
+class RateGenerator(object):
+    """ Step timing for a speed that can change at any moment.
+
+    Speeds are signed, in steps/s. next() moves the speed one step's worth
+    toward the target (v^2 changes by at most 2*accel per step, as on the
+    trapezoid ramp) and returns it: take a step that way, then wait
+    1/abs(speed). At or below start_speed the motor can start, stop and
+    reverse outright, so there the speed jumps straight to the target.
+    next() returns 0 once the target is 0 and the motor is at rest.
+    """
+    def __init__(self, max_speed, accel, start_speed, speed=0.0):
+        self.max_speed = float(max_speed)
+        self.accel = float(accel)
+        self.start_speed = float(start_speed)
+        self.speed = float(speed)
+        self.target = 0.0
+
+    def set(self, speed):
+        self.target = max(-self.max_speed, min(self.max_speed, float(speed)))
+
+    def _toward(self, v, goal):
+        """ Next speed magnitude from v on the way to goal """
+        if max(v, goal) <= self.start_speed:
+            return goal
+        if goal > v:
+            return min(goal, max(self.start_speed, math.sqrt(v*v + 2*self.accel)))
+        v = math.sqrt(max(0.0, v*v - 2*self.accel))
+        return goal if v <= max(goal, self.start_speed) else v
+
+    def next(self):
+        if self.speed and self.speed * self.target <= 0:
+            # stopping or reversing: slow down in the old direction first
+            v = self._toward(abs(self.speed), 0.0)
+            self.speed = math.copysign(v, self.speed) if v else 0.0
+            if v or not self.target:
+                return self.speed
+        self.speed = math.copysign(self._toward(abs(self.speed), abs(self.target)), self.target)
+        return self.speed
+
+    def ramp(self):
+        """ Signed speeds of the steps it takes to reach the target speed """
+        speeds = []
+        while self.speed != self.target:
+            v = self.next()
+            if v:
+                speeds.append(v)
+        return speeds
+
+
+if __name__ == "__main__":
+    # Time-to-target against the old fixed 1.8 ms step delay
+    planner = MotionPlanner(max_speed=1000, accel=3000, start_speed=500)
+    ratio = 4076
+    print("top speed: {:.0f} steps/s ({:.0f} deg/s), was {:.0f} steps/s".format(
+        planner.max_speed, planner.max_speed * 360 / ratio, 1 / 1.8e-3))
+    for angle in (5, 30, 90, 180, 360):
+        steps = int(angle / 360.0 * ratio)
+        print("{:>4} deg: fixed {:.3f}s  trapezoid {:.3f}s  scurve {:.3f}s".format(
+            angle, steps * 1.8e-3, planner.duration(steps, TRAPEZOID),
+            planner.duration(steps, SCURVE)))
@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+## PCA9685 16-channel PWM driver
+# Register-level replacement for Adafruit_PCA9685.PCA9685.
+# BatchedPCA9685 gathers the channel updates made during one reactor tick and
+# sends each run of adjacent channels as a single auto-increment block write.
+# CachedPCA9685 sits in front of either and drops writes that change nothing.
+import math
+import time
+
+from twisted.internet import reactor
+
+# Registers
+MODE1 = 0x00
+MODE2 = 0x01
+PRESCALE = 0xFE
+LED0_ON_L = 0x06
+ALL_LED_ON_L = 0xFA
+
+# Bits
+RESTART = 0x80
+AI = 0x20 # register auto-increment
+SLEEP = 0x10
+ALLCALL = 0x01
+OUTDRV = 0x04
+
+OSC_FREQ = 25000000.0 # internal oscillator, Hz
+BLOCK_MAX = 32 # largest SMBus block write, in bytes
+
+def get_i2c_device(address=0x40, busnum=None):
+    """ Open the real bus through Adafruit_GPIO (installed with Adafruit_PCA9685) """
+    from Adafruit_GPIO import I2C
+    if busnum is None:
+        return I2C.get_i2c_device(address)
+    return I2C.get_i2c_device(address, busnum=busnum)
+
+def prescale_for(freq_hz):
+    """ PRESCALE register value for a PWM frequency, rounded as the datasheet does """
+    return int(math.floor(OSC_FREQ / 4096.0 / float(freq_hz) - 1.0 + 0.5))
+
+def channel_bytes(on, off):
+    """ LEDn_ON_L, LEDn_ON_H, LEDn_OFF_L, LEDn_OFF_H """
+    return [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+
+
+class PCA9685(object):
+    """ Same behaviour as Adafruit_PCA9685.PCA9685: every register is its own
+    transaction, so a single set_pwm costs four bus writes.
+    """
+    mode1 = ALLCALL
+
+    def __init__(self, device):
+        self.device = device
+        self.set_all_pwm(0, 0)
+        self.device.write8(MODE2, OUTDRV)
+        self.device.write8(MODE1, self.mode1)
+        time.sleep(0.005) # wait for oscillator
+        mode1 = self.device.readU8(MODE1)
+        self.device.write8(MODE1, mode1 & ~SLEEP) # wake up (reset sleep)
+        time.sleep(0.005)
+
+    def set_pwm_freq(self, freq_hz):
+        """ Sleeps the chip, reprograms the prescaler and restarts the outputs """
+        prescale = prescale_for(freq_hz)
+        oldmode = self.device.readU8(MODE1)
+        self.device.write8(MODE1, (oldmode & 0x7F) | SLEEP)
+        self.device.write8(PRESCALE, prescale)
+        self.device.write8(MODE1, oldmode)
+        time.sleep(0.005)
+        self.device.write8(MODE1, oldmode | RESTART)
+
+    def set_pwm(self, channel, on, off):
+        base = LED0_ON_L + 4*channel
+        for i, value in enumerate(channel_bytes(on, off)):
+            self.device.write8(base + i, value)
+
+    def set_all_pwm(self, on, off):
+        for i, value in enumerate(channel_bytes(on, off)):
+            self.device.write8(ALL_LED_ON_L + i, value)
+
+
+class BatchedPCA9685(PCA9685):
+    """ Stages set_pwm calls and writes them out in as few block writes as
+    possible. With autoflush the flush is scheduled for the end of the current
+    reactor tick, so e.g. a ServoPair and a DimmerRGB updated in one tick share
+    the bus trip; otherwise call flush() yourself.
+    """
+    mode1 = ALLCALL | AI
+
+    def __init__(self, device, autoflush=True):
+        self.pending = {}
+        self.autoflush = autoflush
+        self._flush_call = None
+        PCA9685.__init__(self, device)
+
+    def set_pwm(self, channel, on, off):
+        self.pending[channel] = (on, off)
+        if self.autoflush and self._flush_call is None:
+            self._flush_call = reactor.callLater(0, self.flush)
+
+    def set_all_pwm(self, on, off):
+        self.pending.clear()
+        PCA9685.set_all_pwm(self, on, off)
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if not self.pending:
+            return
+        per_block = BLOCK_MAX // 4
+        channels = sorted(self.pending)
+        start = channels[0]
+        data = []
+        for ch in channels:
+            if ch != start + len(data)//4 or len(data)//4 == per_block:
+                self.device.writeList(LED0_ON_L + 4*start, data)
+                start = ch
+                data = []
+            data += channel_bytes(*self.pending[ch])
+        self.device.writeList(LED0_ON_L + 4*start, data)
+        self.pending.clear()
+
+
+class CachedPCA9685(object):
+    """ Shadow registers for a PCA9685 (or anything with the same API).
+
+    Remembers the last value sent to each channel and the current prescaler,
+    and only passes on writes that would change the chip. Repeating a
+    set_pwm_freq is especially worth skipping, since it sleeps and restarts
+    the oscillator. hits counts dropped writes, misses the ones passed on.
+    """
+    def __init__(self, pwm):
+        self.pwm = pwm
+        self.channels = {} # channel -> (on, off) last written
+        self.prescale = None # unknown until we set it
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # flush() and friends go straight to the wrapped driver
+        return getattr(self.pwm, name)
+
+    def set_pwm(self, channel, on, off):
+        value = (on, off)
+        if self.channels.get(channel) == value:
+            self.hits += 1
+            return
+        self.misses += 1
+        self.channels[channel] = value
+        self.pwm.set_pwm(channel, on, off)
+
+    def set_all_pwm(self, on, off):
+        value = (on, off)
+        if len(self.channels) == 16 and all(v == value for v in self.channels.values()):
+            self.hits += 1
+            return
+        self.misses += 1
+        self.channels = dict((ch, value) for ch in range(16))
+        self.pwm.set_all_pwm(on, off)
+
+    def set_pwm_freq(self, freq_hz):
+        prescale = prescale_for(freq_hz)
+        if prescale == self.prescale:
+            self.hits += 1
+            return
+        self.misses += 1
+        self.prescale = prescale
+        self.pwm.set_pwm_freq(freq_hz)
+
+    def invalidate(self):
+        """ Forget the shadow state, e.g. after something else reset the chip """
+        self.channels = {}
+        self.prescale = None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+if __name__ == "__main__":
+    # Compare bus traffic for servo pair + status LED setup and two tilt
+    # ticks, the second one clamped at the limit (nothing changes)
+    from fake_i2c import SimulatedI2CDevice
+    from servo import ServoPair
+    from led import DimmerRGB
+
+    def plain(dev):
+        return PCA9685(dev)
+    def batched(dev):
+        return BatchedPCA9685(dev, autoflush=False)
+    def cached(dev):
+        return CachedPCA9685(BatchedPCA9685(dev, autoflush=False))
+
+    for make in (plain, batched, cached):
+        dev = SimulatedI2CDevice()
+        pwm = make(dev)
+        dev.reset_counters()
+        servos = ServoPair(pwm, 0, 1, 0, 180)
+        led = DimmerRGB(pwm, 8, 9, 10)
+        led.set_color(1, .4, 0)
+        for angle in (180, 190):
+            servos.set_angle(angle)
+            if hasattr(pwm, "flush"):
+                pwm.flush()
+        print("{}: {}".format(make.__name__, dev.stats()))
+        if isinstance(pwm, CachedPCA9685):
+            print("  cache: {}".format(pwm.stats()))
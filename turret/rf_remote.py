@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+## 433 MHz fob input
+# A fob sends its code over and over while a button is held, and even a tap
+# sends a burst of half a dozen. FobRemote turns the decoded codes into one
+# press per push and a release once the repeats stop, so a held button can
+# drive continuous motion. Codes are looked up in a dict; everything runs on
+# the reactor, with EdgeReader waking the decoder when edges come in.
+from twisted.internet import reactor
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implementer
+
+
+class FobButton(object):
+    """ One code's callbacks and hold state """
+    def __init__(self, code, pressed, released, holdoff):
+        self.code = code
+        self.pressed = pressed
+        self.released = released
+        self.holdoff = holdoff
+        self.held = None # releases the button unless another repeat comes
+        self.presses = 0
+        self.repeats = 0 # codes taken as part of a press already going
+
+
+class FobRemote(object):
+    """ pressed/released callbacks for fob codes, run on the reactor.
+
+    A code seen within `holdoff` seconds of its last sighting is a repeat
+    of the same press and is suppressed; once `holdoff` passes without one
+    the button is released. Pass code() to the decoder as its callback.
+    """
+    def __init__(self, holdoff=0.15, unknown=None):
+        self.holdoff = holdoff
+        self.unknown = unknown # called with codes not in the table
+        self.buttons = {} # code -> FobButton
+        self.strays = 0 # codes not in the table
+
+    def add(self, code, pressed, released=None, holdoff=None):
+        button = FobButton(code, pressed, released, holdoff or self.holdoff)
+        self.buttons[code] = button
+        return button
+
+    def remove(self, code):
+        button = self.buttons.pop(code)
+        if button.held is not None and button.held.active():
+            button.held.cancel()
+
+    def code(self, code, bits=None, gap=None, t0=None, t1=None):
+        button = self.buttons.get(code)
+        if button is None:
+            self.strays += 1
+            if self.unknown is not None:
+                self.unknown(code)
+            return
+        if button.held is not None:
+            button.repeats += 1
+            button.held.reset(button.holdoff)
+            return
+        button.presses += 1
+        button.held = reactor.callLater(button.holdoff, self._release, button)
+        button.pressed()
+
+    def _release(self, button):
+        button.held = None
+        if button.released is not None:
+            button.released()
+
+    def release_all(self):
+        for button in self.buttons.values():
+            if button.held is not None and button.held.active():
+                button.held.cancel()
+                self._release(button)
+
+    def stats(self):
+        return {"presses": sum(b.presses for b in self.buttons.values()),
+                "repeats": sum(b.repeats for b in self.buttons.values()),
+                "strays": self.strays}
+
+
+@implementer(IReadDescriptor)
+class EdgeReader(object):
+    """ Has the reactor poll a bulk decoder (_433.bulk_rx) whenever its
+    notification pipe is readable """
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.edges = 0
+        self.reads = 0
+
+    def start(self):
+        reactor.addReader(self)
+
+    def stop(self):
+        reactor.removeReader(self)
+
+    def fileno(self):
+        return self.decoder.source.fileno()
+
+    def doRead(self):
+        self.reads += 1
+        self.edges += self.decoder.poll()
+
+    def logPrefix(self):
+        return "EdgeReader"
+
+    def connectionLost(self, reason):
+        pass
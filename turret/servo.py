@@ -5,6 +5,8 @@
 # License: Public Domain
 import time
 
+from tracelog import trace
+
 
 def clamp(a, low, high):
     return max(low, min(high, a))
@@ -38,11 +40,10 @@ class Servo():
     def set_angle(self, angle):
         #clamp angle
         angle = clamp(angle, self.min_angle, self.max_angle)
-        print("angle: {}".format(angle))
         #map angle to pulse width
         pulse = (self.pulse_max-self.pulse_min) * (angle / 180.0) + self.pulse_min
         pulse = clamp(pulse, self.pulse_min, self.pulse_max) #safety limit
-        print("pulse: {}".format(pulse))
+        trace.debug("servo", (self.channel, angle, pulse))
         self._set_servo_pulse(pulse)
 
 class ServoPair():
@@ -3,18 +3,31 @@
 import sys
 import time
 import math
-import RPi.GPIO as GPIO
-
-# Use BCM GPIO references
-# instead of physical pin numbers
-GPIO.setmode(GPIO.BCM)
 from twisted.internet import task
 from twisted.internet import reactor
+from twisted.internet import defer
+
+from motion import MotionPlanner, RateGenerator, TRAPEZOID
+from loopstats import loop_stats
+
+# Motion states, as reported by Stepper.motion()
+IDLE = "idle"
+MOVING = "moving" # running a planned move (or decelerating to rest)
+CONTINUOUS = "continuous" # stepping until told to stop
 
 class Stepper(object):
-    def __init__(self):
+    # Motion limits, in steps/s and steps/s^2. The old fixed 1.8ms delay
+    # (~555 steps/s) was fine from a standstill, so ramps start just below it.
+    max_speed = 1000
+    start_speed = 500
+    accel = 3000
+
+    def __init__(self, gpio, profile=TRAPEZOID, pins=None, name="stepper"):
+        """ gpio is an RPi.GPIO-like module, set to BCM numbering; pins are
+        the four coil pins, and name labels the step loop's timing stats """
+        self.gpio = gpio
         self.ratio = 4076 #measure of # of steps to a complete revolution (360 degrees)
-        self.step_pins = [5, 6, 13, 19]
+        self.step_pins = list(pins or [5, 6, 13, 19])
         self.seq = [[1,0,0,1],
                [1,0,0,0],
                [1,1,0,0],
@@ -25,63 +38,528 @@ class Stepper(object):
                [0,0,0,1]]
         self.steps = len(self.seq)
         self.step_counter = 0 # start at initial position
-        for pin in self.step_pins:
-          GPIO.setup(pin,GPIO.OUT)
-          GPIO.output(pin, 0)
+        self._compile_phases()
+        self._init_pins()
 
-        self.step_delay = 1.8 / 1000 #ms
-        self.loop = None
-        self.loop_count = 0
+        self.profile = profile
+        self._planners = {}
+        self._use_planner(self.planner_for(None))
         self.loop_dir = 0
-    
+        self._call = None # pending reactor call for the next step
+        self._plan = () # step intervals for the current run
+        self._index = 0 # steps taken in the current run
+        self._forever = False # keep cruising once the plan runs out
+        self._start_level = 0 # ramp level the run started at
+        self._arrival = None # Deferred for the move in progress
+        self._rate = None # RateGenerator while stepping at a set speed
+        self._stepped = 0.0 # when the rate loop last stepped
+        self.stats = loop_stats(name)
+
+    def planner_for(self, speed):
+        """ Planner cruising at speed degrees per second, capped at max_speed """
+        steps = self.max_speed
+        if speed:
+            steps = max(1, min(self.max_speed, int(abs(speed) / 360.0 * self.ratio)))
+        planner = self._planners.get(steps)
+        if planner is None:
+            if len(self._planners) >= 16:
+                self._planners.clear()
+            planner = self._planners[steps] = MotionPlanner(
+                steps, self.accel, min(self.start_speed, steps), self.profile)
+        return planner
+
+    def _use_planner(self, planner):
+        # everything about the current run (ramp level, decel) reads self.planner
+        self.planner = planner
+        self.step_delay = planner.cruise_interval
+
+    def _finish(self, arrived):
+        """ Fire the move's Deferred: True on arrival, False if cut short """
+        d, self._arrival = self._arrival, None
+        if d is not None:
+            d.callback(arrived)
+
+    def _compile_phases(self):
+        """ Precompute each phase of seq as pin levels and as bank bitmasks,
+        so a step is a single write instead of one per pin """
+        self._all_mask = 0
+        for pin in self.step_pins:
+            self._all_mask |= 1 << pin
+        self._phase_levels = [tuple(row) for row in self.seq]
+        self._phase_masks = []
+        for row in self.seq:
+            mask = 0
+            for pin, level in zip(self.step_pins, row):
+                if level:
+                    mask |= 1 << pin
+            self._phase_masks.append(mask)
+        self._off_levels = (0,)*len(self.step_pins)
+
+    def _init_pins(self):
+        self.gpio.setup(self.step_pins, self.gpio.OUT)
+        self.gpio.output(self.step_pins, self._off_levels)
+
     def step(self, step_dir = 1):
         self.step_counter += step_dir
-        for pin in range(0,4):
-            io_pin=self.step_pins[pin]# Get GPIO
-            GPIO.output(io_pin, self.seq[self.step_counter%self.steps][pin])   
-    
-    def stop(self):
-        # TODO: deccelerate
-        if self.loop:
-            self.loop.stop()
-            self.loop = None
+        self.gpio.output(self.step_pins, self._phase_levels[self.step_counter % self.steps])
+
+    def _release(self):
         # leave motor coils off.
-        for pin in self.step_pins:
-            GPIO.output(pin, 0)
-    
+        self.gpio.output(self.step_pins, self._off_levels)
+
+    def _level(self, taken=None):
+        """ How many steps up the accel ramp the run is after `taken` steps """
+        if taken is None:
+            taken = self._index
+        level = min(self._start_level + taken, len(self.planner.ramp()))
+        if not self._forever:
+            level = min(level, len(self._plan) - taken)
+        return max(0, level)
+
+    def halt(self):
+        """ Stop at once, without decelerating """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._rate = None
+        self.stats.idle()
+        self._release()
+        self._finish(False)
+
+    def stop(self):
+        """ Decelerate to rest, then release the coils """
+        if self._call is None:
+            self._release()
+            return
+        if self._rate is not None:
+            self.step_at(0)
+            return
+        level = self._level()
+        self._run(self.planner.decel_from(level), self.loop_dir, start_level=level)
+
+    def is_moving(self):
+        return self._call is not None
+
+    def _progress(self):
+        """ Steps taken into the current run """
+        return self._index
+
+    def position(self):
+        """ Steps from the starting position, as of now """
+        return self.step_counter
+
+    def velocity(self):
+        """ Signed speed right now, in steps per second """
+        if not self.is_moving():
+            return 0.0
+        if self._rate is not None:
+            return self._rate.speed
+        i = self._progress()
+        interval = self._plan[i] if i < len(self._plan) else self.step_delay
+        return self.loop_dir / interval
+
+    def motion(self):
+        if not self.is_moving():
+            return IDLE
+        return CONTINUOUS if self._forever else MOVING
+
+    def _run(self, plan, direction, forever=False, start_level=0, arrival=None):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._finish(False)
+        self._rate = None
+        self._arrival = arrival
+        self._plan = plan
+        self._index = 0
+        self._forever = forever
+        self._start_level = start_level
+        self.loop_dir = direction
+        self.stats.idle()
+        self._step_loop()
+
     def _step_loop(self):
-        #TODO: accel
-        if self.loop_count == "inf":
-            self.step(self.loop_dir)
+        self._call = None
+        self.stats.begin()
+        i = self._index
+        if i < len(self._plan):
+            delay = self._plan[i]
+        elif self._forever:
+            delay = self.step_delay
         else:
-            if self.loop_count == 0:
+            self._release()
+            self.stats.end()
+            self._finish(True)
+            return
+        self.step(self.loop_dir)
+        self._index = i + 1
+        self.stats.expect(delay)
+        self._call = reactor.callLater(delay, self._step_loop)
+        self.stats.end()
+
+    def step_to_angle(self, angle, speed=None):
+        """ Step until angle is achieved, ramping speed up and down on the way.
+
+        speed caps the cruise speed, in degrees per second. Returns a Deferred
+        that fires True on arrival, or False if the move is stopped or replaced.
+        """
+        steps = int(angle/360.0 * self.ratio)
+        direction = -1 if steps < 0 else 1 # direction to step
+        d = defer.Deferred()
+        self._use_planner(self.planner_for(speed))
+        self._run(self.planner.move(abs(steps)), direction, arrival=d)
+        return d
+
+    def step_forever(self, direction):
+        direction = -1 if direction < 0 else 1 # direction to step
+        if self._call is not None and self._forever and self._rate is None and direction == self.loop_dir:
+            return # already on our way
+        self._use_planner(self.planner_for(None))
+        self._run(self.planner.ramp(), direction, forever=True)
+
+    def _steps_per_second(self, speed):
+        return speed / 360.0 * self.ratio
+
+    def step_at(self, speed):
+        """ Step continuously at speed degrees per second (signed) until
+        stopped; 0 slows to rest. A new speed takes over from the current one
+        mid-motion, changing at the accel limit, and speeds below the pull-in
+        speed are reached at once, so fine aiming costs no top speed.
+        """
+        rate = self._rate
+        if rate is None:
+            if not speed:
                 self.stop()
                 return
-            self.loop_count -= self.loop_dir
-            self.step(self.loop_dir)
-    
-    def step_to_angle(self, angle):
-        """ Initiate twisted loop to call step repeatedly, until angle is achieved."""
-        if self.loop != None:
-            self.loop.stop()
-        self.loop_count = int(angle/360 * self.ratio)
-        self.loop_dir = -1 if angle < 0 else 1 # direction to step
-        self.loop = task.LoopingCall(f=self._step_loop)
-        self.loop.start(self.step_delay)
-    
+            # take over from whatever the motor is doing, at its current speed
+            rate = RateGenerator(self.max_speed, self.accel, self.start_speed, self.velocity())
+            delay = 0.0
+            if self._call is not None and self._call.active():
+                delay = max(0.0, self._call.getTime() - reactor.seconds())
+                self._call.cancel()
+            self._finish(False)
+            self._plan, self._index = (), 0
+            self._rate = rate
+            rate.set(self._steps_per_second(speed))
+            self._forever = True
+            self.stats.expect(delay)
+            self._call = reactor.callLater(delay, self._rate_loop)
+            return
+        rate.set(self._steps_per_second(speed))
+        self._forever = bool(rate.target)
+        if self._call is not None and abs(rate.speed) <= rate.start_speed:
+            # a slow step already waiting shouldn't hold up the new speed
+            pace = min(abs(rate.target), rate.start_speed)
+            now = reactor.seconds()
+            due = self._stepped + 1.0 / pace if pace else now
+            if due < self._call.getTime():
+                delay = max(0.0, due - now)
+                self._call.reset(delay)
+                self.stats.expect(delay)
+
+    def _rate_loop(self):
+        self._call = None
+        self.stats.begin()
+        speed = self._rate.next()
+        if not speed:
+            self._rate = None
+            self._forever = False
+            self._release()
+            self.stats.end()
+            return
+        self.loop_dir = 1 if speed > 0 else -1
+        self.step(self.loop_dir)
+        self._stepped = reactor.seconds()
+        delay = 1.0 / abs(speed)
+        self.stats.expect(delay)
+        self._call = reactor.callLater(delay, self._rate_loop)
+        self.stats.end()
+
+
+class WaveStepper(Stepper):
+    """ Drives the coils from pigpio waveforms instead of reactor calls.
+
+    A move is compiled into one pulse per step, timed by the pigpio daemon's
+    DMA engine, and handed off whole. The reactor only starts, stops and
+    queries it, so network load can no longer slow or stutter the pan.
+    Pass fake_pigpio (and a fake_pigpio.pi()) to inspect the waveforms.
+    """
+    max_loop = 0xFFFF # wave chain loop counter is 16 bits
+
+    def __init__(self, pi, pigpio_module=None, profile=TRAPEZOID, pins=None, name="stepper"):
+        if pigpio_module is None:
+            import pigpio as pigpio_module
+        self.pi = pi
+        self.pigpio = pigpio_module
+        self._wids = []
+        self._move = None # start tick of the wave in flight
+        self._arrival_call = None # polls for the end of a move
+        self._reversed = 0 # leading steps of the run taken against loop_dir
+        self._lead = 0.0 # pause at the start of the run, before its first step
+        Stepper.__init__(self, None, profile, pins, name) # pins are written through pi
+
+    def _init_pins(self):
+        for pin in self.step_pins:
+            self.pi.set_mode(pin, self.pigpio.OUTPUT)
+        self.pi.clear_bank_1(self._all_mask)
+
+    def _pulses(self, intervals, direction, phase):
+        """ One pulse per step starting after `phase`; returns (pulses, end phase) """
+        pulses = []
+        for interval in intervals:
+            phase += direction
+            on = self._phase_masks[phase % self.steps]
+            pulses.append(self.pigpio.pulse(on, self._all_mask ^ on, int(round(interval * 1e6))))
+        return pulses, phase
+
+    def _off(self):
+        return self.pigpio.pulse(0, self._all_mask, 0)
+
+    def compile_move(self, steps, direction):
+        """ Compile a move of `steps` steps from the current phase.
+
+        Returns (head, cycle, loops, tail): the pulses while accelerating, one
+        pass through the coil sequence at cruise speed and how many times to
+        repeat it, then the remaining cruise steps and the deceleration,
+        followed by switching the coils off.
+        """
+        accel, cruise, decel = self.planner.move_parts(steps)
+        head, phase = self._pulses(accel, direction, self.step_counter)
+        loops, rest = divmod(cruise, self.steps)
+        # whole cycles end on the phase they started from
+        cycle, _ = self._pulses([self.step_delay]*self.steps, direction, phase)
+        tail, _ = self._pulses([self.step_delay]*rest + list(decel), direction, phase)
+        tail.append(self._off())
+        return head, cycle, loops, tail
+
+    def compile_forever(self, direction):
+        """ (head, cycle): accelerate, then repeat cycle until stopped """
+        head, phase = self._pulses(self.planner.ramp(), direction, self.step_counter)
+        cycle, _ = self._pulses([self.step_delay]*self.steps, direction, phase)
+        return head, cycle
+
+    def _create(self, pulses):
+        self.pi.wave_add_new()
+        self.pi.wave_add_generic(pulses)
+        wid = self.pi.wave_create()
+        self._wids.append(wid)
+        return wid
+
+    def _begin(self, plan, direction, forever=False, start_level=0, reversed=0, lead=0.0):
+        self._plan = plan
+        self._forever = forever
+        self._start_level = start_level
+        self._rate = None
+        self._reversed = reversed
+        self._lead = lead
+        self.loop_dir = direction
+        self._move = self.pi.get_current_tick()
+
+    def _elapsed(self):
+        """ Seconds into the current run's steps (negative during its lead) """
+        return self.pigpio.tickDiff(self._move, self.pi.get_current_tick()) / 1e6 - self._lead
+
+    def _taken(self, elapsed):
+        """ Steps played `elapsed` seconds into the current run """
+        t = 0.0
+        taken = 0
+        for interval in self._plan:
+            if t > elapsed:
+                return taken
+            taken += 1
+            t += interval
+        if self._forever and elapsed >= t:
+            taken += int((elapsed - t) / self.step_delay) + 1
+        return taken
+
+    def _next_step_in(self, elapsed):
+        """ Seconds from `elapsed` into the current run until its next step """
+        t = 0.0
+        for interval in self._plan:
+            if t > elapsed:
+                return t - elapsed
+            t += interval
+        if not self._forever:
+            return 0.0
+        if elapsed < t:
+            return t - elapsed
+        return self.step_delay - (elapsed - t) % self.step_delay
+
+    def _displacement(self, taken):
+        """ Signed steps moved by the first `taken` steps of the run """
+        back = min(taken, self._reversed)
+        return self.loop_dir * (taken - 2*back)
+
+    def _settle(self):
+        """ Stop any wave in flight, fold its progress into step_counter and
+        return how far up the accel ramp it had got """
+        self.pi.wave_tx_stop()
+        level = 0
+        if self._move is not None:
+            elapsed = self._elapsed()
+            taken = self._taken(elapsed)
+            level = self._level(taken)
+            counter = self.step_counter + self._displacement(taken)
+            # the coils tell us the real phase if the wave stopped mid-move
+            levels = self.pi.read_bank_1() & self._all_mask
+            if levels in self._phase_masks:
+                offset = (self._phase_masks.index(levels) - counter) % self.steps
+                if offset > self.steps // 2:
+                    offset -= self.steps
+                counter += offset
+            self.step_counter = counter
+            self._move = None
+        for wid in self._wids:
+            self.pi.wave_delete(wid)
+        self._wids = []
+        if self._arrival_call is not None and self._arrival_call.active():
+            self._arrival_call.cancel()
+        self._arrival_call = None
+        self._finish(False)
+        return level
+
+    def _check_arrival(self):
+        if self.pi.wave_tx_busy():
+            self._arrival_call = reactor.callLater(self.step_delay, self._check_arrival)
+            return
+        self._arrival_call = None
+        d, self._arrival = self._arrival, None
+        self._settle()
+        d.callback(True)
+
+    def step(self, step_dir = 1):
+        self._settle()
+        self.step_counter += step_dir
+        on = self._phase_masks[self.step_counter % self.steps]
+        self.pi.set_bank_1(on)
+        self.pi.clear_bank_1(self._all_mask ^ on)
+
+    def halt(self):
+        self._settle()
+        self._rate = None
+        # leave motor coils off.
+        self.pi.clear_bank_1(self._all_mask)
+
+    def stop(self):
+        """ Replace the wave in flight with a deceleration from its current speed """
+        if self._rate is not None:
+            self.step_at(0)
+            return
+        direction = self.loop_dir
+        level = self._settle()
+        if not level:
+            self.pi.clear_bank_1(self._all_mask)
+            return
+        decel = self.planner.decel_from(level)
+        pulses, _ = self._pulses(decel, direction, self.step_counter)
+        pulses.append(self._off())
+        self.pi.wave_send_once(self._create(pulses))
+        self._begin(decel, direction, start_level=level)
+
+    def is_moving(self):
+        return bool(self.pi.wave_tx_busy())
+
+    def _progress(self):
+        if self._move is None:
+            return 0
+        elapsed = self._elapsed()
+        return self._taken(elapsed)
+
+    def position(self):
+        # step_counter is only brought up to date when a wave is settled
+        return self.step_counter + self._displacement(self._progress())
+
+    def velocity(self):
+        # the wave holds the whole speed change, so read it off the plan
+        if not self.is_moving():
+            return 0.0
+        i = self._progress()
+        interval = self._plan[i] if i < len(self._plan) else self.step_delay
+        direction = -self.loop_dir if i < self._reversed else self.loop_dir
+        return direction / interval
+
+    def step_to_angle(self, angle, speed=None):
+        """ Hand the whole move to the pigpio daemon; returns immediately,
+        with a Deferred as for Stepper.step_to_angle."""
+        self._settle()
+        self._use_planner(self.planner_for(speed))
+        steps = int(angle/360.0 * self.ratio)
+        direction = -1 if steps < 0 else 1
+        head, cycle, loops, tail = self.compile_move(abs(steps), direction)
+        chain = []
+        if head:
+            chain.append(self._create(head))
+        cycle_wid = self._create(cycle)
+        while loops > 0:
+            n = min(loops, self.max_loop)
+            chain += [255, 0, cycle_wid, 255, 1, n & 0xFF, n >> 8]
+            loops -= n
+        chain.append(self._create(tail))
+        self.pi.wave_chain(chain)
+        plan = self.planner.move(abs(steps))
+        self._begin(plan, direction)
+        self._arrival = defer.Deferred()
+        self._arrival_call = reactor.callLater(sum(plan), self._check_arrival)
+        return self._arrival
+
     def step_forever(self, direction):
-        self.loop_count = "inf"
-        self.loop_dir = -1 if direction < 0 else 1 # direction to step
-        if self.loop: self.stop()
-        self.loop = task.LoopingCall(f=self._step_loop)
-        self.loop.start(self.step_delay)
-        
-
-    def accel(self):
-        # Acceleration loop
-        while True:
-            count += 1 
-            d = abs(actualTime - WaitTime) / 3.0
-            actualTime -= d
-            if actualTime < WaitTime:
-                actualTime = WaitTime
+        direction = -1 if direction < 0 else 1
+        if self._move is not None and self._forever and self._rate is None and direction == self.loop_dir:
+            return # already on our way
+        self._settle()
+        self._use_planner(self.planner_for(None))
+        head, cycle = self.compile_forever(direction)
+        chain = [self._create(head)] if head else []
+        chain += [255, 0, self._create(cycle), 255, 3] # loop forever
+        self.pi.wave_chain(chain)
+        self._begin(self.planner.ramp(), direction, forever=True)
+
+    def step_at(self, speed):
+        """ As Stepper.step_at. Each new speed replaces the wave in flight
+        with one that ramps from the current speed to the new one and then
+        repeats a coil cycle at it until stopped. The wave starts with a
+        pause for whatever was left of the step in progress. """
+        rate = RateGenerator(self.max_speed, self.accel, self.start_speed, self.velocity())
+        rate.set(self._steps_per_second(speed))
+        wait = 0.0
+        if self._move is not None and self.is_moving():
+            elapsed = self._elapsed()
+            wait = self._next_step_in(elapsed)
+        self._settle()
+        speeds = rate.ramp()
+        if not speeds and not rate.target:
+            self.pi.clear_bank_1(self._all_mask)
+            return
+        if speeds:
+            wait = min(wait, 1.0 / abs(speeds[0]))
+        elif rate.target:
+            wait = min(wait, 1.0 / abs(rate.target))
+        pulses = [self.pigpio.pulse(0, 0, int(round(wait * 1e6)))] if wait else []
+        phase = self.step_counter
+        for v in speeds:
+            step, phase = self._pulses([1.0 / abs(v)], 1 if v > 0 else -1, phase)
+            pulses += step
+        last = rate.target or (speeds[-1] if speeds else 0)
+        direction = 1 if last > 0 else -1
+        reversed = len([v for v in speeds if (v > 0) != (direction > 0)])
+        plan = [1.0 / abs(v) for v in speeds]
+        if rate.target:
+            self.step_delay = 1.0 / abs(rate.target)
+            cycle, _ = self._pulses([self.step_delay]*self.steps, direction, phase)
+            chain = [self._create(pulses)] if pulses else []
+            chain += [255, 0, self._create(cycle), 255, 3] # loop forever
+            self.pi.wave_chain(chain)
+        else:
+            pulses.append(self._off())
+            self.pi.wave_send_once(self._create(pulses))
+        self._begin(plan, direction, forever=bool(rate.target), reversed=reversed, lead=wait)
+        self._rate = rate
+
+
+def make_stepper(backend, pins=None, name="stepper"):
+    """ Prefer DMA-timed pulses when the backend has a pigpio daemon whose
+    wave engine is still free; it only plays one waveform at a time """
+    pigpio = backend.claim_waves()
+    if pigpio is None:
+        return Stepper(backend.gpio(), pins=pins, name=name)
+    module, pi = pigpio
+    return WaveStepper(pi, module, pins=pins, name=name)
@@ -0,0 +1,30 @@
+#! /usr/bin/env python
+## Clocks
+# monotonic() never jumps with NTP or date changes, so it is the clock to
+# measure motion and loop timing against.
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2: ask the kernel directly, falling back on the wall clock
+    import ctypes
+    import ctypes.util
+
+    CLOCK_MONOTONIC = 1
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    try:
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"),
+                                     use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    except (OSError, AttributeError, TypeError):
+        monotonic = time.time
+    else:
+        def monotonic():
+            t = _timespec()
+            if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                return time.time()
+            return t.tv_sec + t.tv_nsec * 1e-9
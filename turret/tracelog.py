@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+## Ring-buffer trace log
+# Cheap, timestamped event recording for actuator hot paths. Records go into
+# preallocated slots and are only formatted when dumped or flushed, so a
+# disabled level costs one comparison and an enabled one a few stores.
+from twisted.internet import task
+from twisted.python import log
+
+from timing import monotonic
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+OFF = 100
+
+level_names = {DEBUG: "debug", INFO: "info", WARN: "warn", OFF: "off"}
+
+
+class TraceLog(object):
+    """ Keeps the last `size` records; older ones are overwritten. """
+    def __init__(self, size=4096, level=INFO, clock=monotonic):
+        self.size = size
+        self.level = level
+        self.clock = clock
+        self._times = [0.0]*size
+        self._levels = [0]*size
+        self._events = [None]*size
+        self._values = [None]*size
+        self._written = 0 # records ever written
+        self._flushed = 0 # records ever flushed
+        self._flush_loop = None
+
+    def record(self, level, event, value=None):
+        if level < self.level:
+            return
+        i = self._written % self.size
+        self._times[i] = self.clock()
+        self._levels[i] = level
+        self._events[i] = event
+        self._values[i] = value
+        self._written += 1
+
+    def debug(self, event, value=None):
+        self.record(DEBUG, event, value)
+
+    def info(self, event, value=None):
+        self.record(INFO, event, value)
+
+    def warn(self, event, value=None):
+        self.record(WARN, event, value)
+
+    @property
+    def dropped(self):
+        """ Records overwritten before they could be flushed """
+        return max(0, self._written - self.size - self._flushed)
+
+    def _since(self, start):
+        start = max(start, self._written - self.size)
+        for n in range(start, self._written):
+            i = n % self.size
+            yield (self._times[i], self._levels[i], self._events[i], self._values[i])
+
+    def dump(self):
+        """ Everything still in the buffer, oldest first, as
+        (time, level, event, value) """
+        return list(self._since(0))
+
+    def clear(self):
+        self._flushed = self._written = 0
+
+    def flush(self, write=log.msg):
+        """ Write out the records added since the last flush """
+        dropped = self.dropped
+        if dropped:
+            write("trace: {} records dropped".format(dropped))
+        for t, level, event, value in self._since(self._flushed):
+            write("{:.6f} {} {}: {}".format(t, level_names.get(level, level), event, value))
+        self._flushed = self._written
+
+    def start_flushing(self, interval=1.0, write=log.msg):
+        """ Flush from the reactor every `interval` seconds, off the hot path """
+        self.stop_flushing()
+        self._flush_loop = task.LoopingCall(self.flush, write)
+        self._flush_loop.start(interval, now=False)
+
+    def stop_flushing(self):
+        if self._flush_loop is not None and self._flush_loop.running:
+            self._flush_loop.stop()
+        self._flush_loop = None
+
+
+trace = TraceLog() # shared by the whole turret package
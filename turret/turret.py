@@ -1,16 +1,31 @@
 #! /usr/bin/env python
 from servo import *
-from stepper import Stepper
+from stepper import make_stepper, IDLE, MOVING, CONTINUOUS
 from led import DimmerRGB
-import Adafruit_PCA9685
-import RPi.GPIO as IO
+from timing import monotonic
+from tracelog import trace
+from loopstats import loop_stats
+import backends
 
-from twisted.internet import task
+from twisted.internet import task, defer
 
 class Turret(object):
     left = 1
     right = -1
-    def __init__(self, tilt_min=0, tilt_max=180):
+    tilt_sign = -1 # servo pair is mounted so that positive speed lowers the angle
+    def __init__(self, tilt_min=0, tilt_max=180, backend="real", name=None,
+                 address=0x40, busnum=None, servo_channels=(0, 1), led_channels=(8, 9, 10),
+                 step_pins=None):
+        """ backend names a hardware backend (see backends.py); nothing is
+        imported from it until here. The rest say where this turret is wired
+        up, so several can share a Pi; name prefixes its loop stats. """
+        self.backend = backends.get(backend)
+        self.name = name
+        self.address = address
+        self.busnum = busnum
+        self.servo_channels = servo_channels
+        self.led_channels = led_channels
+        self.step_pins = step_pins
         self.min_angle = tilt_min
         self.max_angle = tilt_max
         self._init_servos()
@@ -18,89 +33,203 @@ class Turret(object):
         self._init_led()
     
     def _init_servos(self):
-        #init global PWM
-        self.pwm = Adafruit_PCA9685.PCA9685()
+        #init global PWM; channel writes made in one reactor tick go out as one block,
+        #and writes that change nothing (e.g. tilt held at a limit) are dropped
+        self.pwm = self.backend.pwm(self.address, self.busnum)
         #init servos
-        self.servos = ServoPair(self.pwm, chan_a=0, chan_b=1, min=self.min_angle, max=self.max_angle)
+        chan_a, chan_b = self.servo_channels
+        self.servos = ServoPair(self.pwm, chan_a=chan_a, chan_b=chan_b, min=self.min_angle, max=self.max_angle)
         
         #calibrate
         self.servos.set_angle(90)
+        self._init_tilt()
+    
+    def _init_tilt(self):
         self.tilt_angle = 90
         self.tilt_speed = 45 # Default tilt speed, in degrees per second
-        self.tilt_delay = 1.0/60.0 # time between step increments; servo pulses are only 60hz
+        self.tilt_delay = 1.0/60.0 # one servo PWM frame; servo pulses are only 60hz
         self.tilt_loop = None
-        self.tilt_dir = 0 # Angle increment per step
+        self.clock = monotonic
+        self._tilt_from = 90 # angle the current tilt started from
+        self._tilt_t0 = 0 # and when
+        self._tilt_rate = 0 # degrees per second
+        self._tilt_frame = 0 # last frame written
+        self._tilt_target = None # angle to stop at, for tilt_toward
+        self._tilt_arrival = None # and its Deferred
+        self.tilt_stats = loop_stats(self._stats_name("tilt"), self.tilt_delay)
+    
+    def _stats_name(self, loop):
+        if self.name is None:
+            return loop
+        return "{}.{}".format(self.name, loop)
         
     def _init_stepper(self):
         #init steppers
-        self.stepper = Stepper()
-        self.pan_angle = 0 # angle
+        self.stepper = make_stepper(self.backend, self.step_pins, self._stats_name("stepper"))
+        self._pan_zero = self.stepper.position()
+    
+    @property
+    def pan_angle(self):
+        """ Live, from the stepper's position, whichever way it got there """
+        steps = self.stepper.position() - self._pan_zero
+        return steps * 360.0 / self.stepper.ratio % 360
     
     def _init_led(self):
-        self.status_led = DimmerRGB(self.pwm, 8,9,10)
+        self.status_led = DimmerRGB(self.pwm, *self.led_channels)
         self.status_led.set_color(1,.4,0)
         
     def tilt_to(self, angle):
         self.tilt_angle = max(self.min_angle, min(self.max_angle, angle))
-        print("tilt:{}".format(self.tilt_angle))
+        trace.debug("tilt", self.tilt_angle)
         self.servos.set_angle(self.tilt_angle)
         return self.tilt_angle == self.max_angle or self.tilt_angle == self.min_angle
     
     def pan(self, d_angle):
-        self.pan_angle += d_angle
-        self.pan_angle %= 360
         self.stepper.step_to_angle(d_angle)
     
+    def pan_to(self, angle, speed=None):
+        """ Pan the short way round to angle; returns a Deferred firing True
+        on arrival, False if the move is cut short """
+        d_angle = (angle - self.pan_angle + 180) % 360 - 180
+        return self.stepper.step_to_angle(d_angle, speed)
+    
     def pan_forever(self, direction):
         """ Direction is 1 or -1 """
         self.stepper.step_forever(-direction)
     
+    def pan_at(self, speed):
+        """ Pan at speed degrees per second until stopped. A new speed takes
+        over mid-motion; 0 slows to a stop """
+        self.stepper.step_at(-speed)
+    
     def stop_pan(self):
         self.stepper.stop()
     
     def _tilt_loop(self):
-        maxed = self.tilt_to(self.tilt_angle-self.tilt_dir)
+        self.tilt_stats.begin()
+        try:
+            self._tilt_frame_update()
+        finally:
+            self.tilt_stats.end()
+    
+    def _tilt_frame_update(self):
+        # Position is a function of time since the tilt started, counted in
+        # whole servo frames: late or skipped ticks catch up instead of slowing
+        # the tilt, and ticks inside a frame the servo has already seen do nothing.
+        frame = int((self.clock() - self._tilt_t0) / self.tilt_delay + 0.5)
+        if frame == self._tilt_frame:
+            return
+        self._tilt_frame = frame
+        angle = self._tilt_from + self._tilt_rate * frame * self.tilt_delay
+        target = self._tilt_target
+        if target is not None and (angle - target) * self._tilt_rate >= 0:
+            self.tilt_to(target)
+            self._end_tilt(True)
+            return
+        maxed = self.tilt_to(angle)
         if maxed:
             self.stop_tilt()
     
     def tilt(self, speed=None):
         """ Tilt up until told to stop
         
+        speed is in degrees per second; a new speed takes over from the
+        current angle without restarting the loop.
         """
+        if speed == 0:
+            self.stop_tilt()
+            return
         if speed == None: speed = self.tilt_speed
-        self.tilt_dir = speed * self.tilt_delay
-        if self.tilt_loop: self.stop_tilt()
-        self.tilt_loop = task.LoopingCall(f=self._tilt_loop)
-        self.tilt_loop.start(self.tilt_delay)
+        self._end_tilt(False, stop=False)
+        self._start_tilt(self.tilt_sign * speed)
+    
+    def tilt_toward(self, angle, speed=None):
+        """ Tilt to angle at speed (degrees per second), in servo frames
+        like tilt(); returns a Deferred firing True on arrival, or False
+        if stopped or given another tilt first. speed 0 or None means
+        tilt_speed, as it means the default for pan_to """
+        if not speed: speed = self.tilt_speed
+        angle = max(self.min_angle, min(self.max_angle, angle))
+        self._end_tilt(False, stop=False)
+        d = self._tilt_arrival = defer.Deferred()
+        self._tilt_target = angle
+        if angle == self.tilt_angle:
+            self._end_tilt(True)
+        else:
+            self._start_tilt(abs(speed) if angle > self.tilt_angle else -abs(speed))
+        return d
+    
+    def _start_tilt(self, rate):
+        """ Move at rate degrees per second, in servo angle terms """
+        self._tilt_from = self.tilt_angle
+        self._tilt_t0 = self.clock()
+        self._tilt_rate = rate
+        self._tilt_frame = 0
+        if self.tilt_loop is None:
+            self.tilt_loop = task.LoopingCall(f=self._tilt_loop)
+            self.tilt_stats.expect(self.tilt_delay)
+            self.tilt_loop.start(self.tilt_delay, now=False)
     
     def tilt_down(self, speed=None):
         if speed == None: speed = self.tilt_speed
         self.tilt(-speed)
     
     def stop_tilt(self):
-        try:
+        if self.tilt_loop is not None and self.tilt_loop.running:
             self.tilt_loop.stop()
-        except:
-            pass
         self.tilt_loop = None
+        self.tilt_stats.idle()
+        self._end_tilt(False, stop=False)
+    
+    def _end_tilt(self, arrived, stop=True):
+        """ Finish a tilt_toward, firing its Deferred """
+        d, self._tilt_arrival = self._tilt_arrival, None
+        self._tilt_target = None
+        if stop and self.tilt_loop is not None:
+            self.stop_tilt()
+        if d is not None:
+            d.callback(arrived)
     
     def fire(self):
         print("bang")
     
+    def tilt_velocity(self):
+        """ Degrees per second, in servo angle terms """
+        return float(self._tilt_rate) if self.tilt_loop is not None else 0.0
+    
+    def tilt_motion(self):
+        if self.tilt_loop is None:
+            return IDLE
+        return CONTINUOUS if self._tilt_target is None else MOVING
+    
+    def pan_velocity(self):
+        return self.stepper.velocity() * 360.0 / self.stepper.ratio
+    
+    def pan_motion(self):
+        return self.stepper.motion()
+    
+    def led_color(self):
+        return self.status_led.color
+    
+    def telemetry(self):
+        """ Where the turret points and what it's doing """
+        return {"tilt": float(self.tilt_angle),
+                "tilt_velocity": self.tilt_velocity(),
+                "tilt_state": self.tilt_motion(),
+                "pan": float(self.pan_angle),
+                "pan_velocity": self.pan_velocity(),
+                "pan_state": self.pan_motion(),
+                "led": self.led_color()}
+    
     def calibrate(self):
         print("Calibrating... DING")
-    
-    def __del__(self):
-        IO.cleanup()
 
 class TestTurret(Turret):
+    tilt_sign = 1
+    pan_angle = 0 # no stepper to ask; just remember what we were told
     
     def _init_servos(self):
-        self.tilt_angle = 90
-        self.tilt_speed = 45 # Default tilt speed, in degrees per second
-        self.tilt_delay = 1.0/20.0 # time between step increments; servo pulses are only 60hz
-        self.tilt_loop = None
-        self.tilt_dir = 0 # Angle increment per step
+        self._init_tilt()
 
     def _init_stepper(self):
         self.pan_angle = 0
@@ -110,7 +239,7 @@ class TestTurret(Turret):
     
     def tilt_to(self, angle):
         self.tilt_angle = max(self.min_angle, min(self.max_angle, angle))
-        print("tilt:{}".format(self.tilt_angle))
+        trace.debug("tilt", self.tilt_angle)
         return self.tilt_angle == self.max_angle or self.tilt_angle == self.min_angle
     
     def pan(self, d_angle):
@@ -118,54 +247,49 @@ class TestTurret(Turret):
         self.pan_angle %= 360
         print("pan angle: {}".format(d_angle))
     
+    def pan_to(self, angle, speed=None):
+        self.pan_angle = angle % 360
+        print("pan to: {}".format(angle))
+        return defer.succeed(True)
+    
     def pan_forever(self, direction):
         """ Direction is 1 or -1 """
         print("panning forever %s" %direction)
     
+    def pan_at(self, speed):
+        print("panning at {}".format(speed))
+    
     def stop_pan(self):
         print("stopped pan")
     
+    def pan_velocity(self):
+        return 0.0
+    
+    def pan_motion(self):
+        return IDLE
+    
+    def led_color(self):
+        return None
+    
     def _tilt_loop(self):
         try:
-            maxed = self.tilt_to(self.tilt_angle+self.tilt_dir)
-            if maxed:
-                self.stop_tilt()
+            Turret._tilt_loop(self)
         except Exception as e:
             print("ERR: {}".format(e))
-            
     
     def tilt(self, speed=None):
         """ Tilt up until told to stop
         
         """
-        if speed == 0:
-            self.stop_tilt()
-            return
-        if speed == None: speed = self.tilt_speed
-        self.tilt_dir = speed * self.tilt_delay
-        print("tilting forever at {}".format(self.tilt_dir))
-        if self.tilt_loop: self.stop_tilt()
-        self.tilt_loop = task.LoopingCall(f=self._tilt_loop)
-        self.tilt_loop.start(self.tilt_delay)
-    
-    def tilt_down(self, speed=None):
-        if speed == None: speed = self.tilt_speed
-        self.tilt(-speed)
+        print("tilting forever at {}".format(speed))
+        Turret.tilt(self, speed)
     
     def stop_tilt(self):
         print("stopped at {}".format(self.tilt_angle))
-        try:
-            self.tilt_loop.stop()
-        except Exception as e:
-            print("ERR: {}".format(e))
-        self.tilt_loop = None
+        Turret.stop_tilt(self)
     
     def fire(self):
         print("bang")
-    
-    def __del__(self):
-        #IO.cleanup()
-        pass
 """
 panLeft()
 panRight()
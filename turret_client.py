@@ -0,0 +1,380 @@
+#! /usr/bin/env python
+## Turret control client
+# One persistent connection to a turret server, shared by the command-line,
+# terminal and any other controllers. Commands are pipelined (nothing waits
+# for an earlier answer), the connection comes back by itself after a drop
+# with the session picked up where it was, and the keepalive pings measure
+# the round trip time and the offset between our clock and the server's.
+
+from twisted.internet import reactor, defer, task
+from twisted.internet.protocol import Factory, DatagramProtocol
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.application.internet import ClientService, backoffPolicy
+from twisted.protocols import amp
+
+from commands import (TiltCommand, PanCommand, StopTiltCommand, StopPanCommand,
+                      FireCommand, TiltToCommand, PanToCommand, AimCommand,
+                      KeepalivePing, AcquireControlCommand, ReleaseControlCommand,
+                      TelemetryCommand, TelemetryFrame, StatsCommand, pack_control)
+from turret.timing import monotonic
+
+
+class NotConnected(Exception):
+    """ The command needs an answer, and there's no connection to ask on """
+
+
+class ClientProtocol(amp.AMP):
+    """ Hands telemetry to the client, and tells it when the connection drops """
+    @TelemetryFrame.responder
+    def telemetry_frame(self, **fields):
+        self.factory.client._telemetry(dict((k, v) for k, v in fields.items() if v is not None))
+        return {}
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.factory.client._disconnected()
+
+class ClientFactory(Factory):
+    """ Builds ClientProtocols that report back to one TurretClient """
+    protocol = ClientProtocol
+
+    def __init__(self, client):
+        self.client = client
+
+
+class LinkStats(object):
+    """ Round trip time and clock offset from timestamped pings.
+
+    rtt is smoothed the way TCP does it (1/8 gain, with rttvar the mean
+    deviation); the offset comes from the quickest of the last `window`
+    samples, since queueing delay only ever makes a sample worse.
+    """
+    window = 16
+
+    def __init__(self):
+        self.rtt = None
+        self.rttvar = None
+        self.rtt_min = None
+        self.offset = None # server clock - our clock
+        self.samples = 0
+        self.lost = 0
+        self._recent = [] # (rtt, offset)
+
+    def add(self, sent, server_time, received):
+        rtt = received - sent
+        offset = server_time - (sent + received) / 2.0
+        self.samples += 1
+        if self.rtt is None:
+            self.rtt, self.rttvar = rtt, rtt / 2.0
+        else:
+            self.rttvar += (abs(self.rtt - rtt) - self.rttvar) / 4.0
+            self.rtt += (rtt - self.rtt) / 8.0
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+        self._recent = (self._recent + [(rtt, offset)])[-self.window:]
+        self.offset = min(self._recent)[1]
+
+    def summary(self):
+        ms = 1e3
+        if self.rtt is None:
+            return {"samples": 0, "lost": self.lost}
+        return {"samples": self.samples, "lost": self.lost,
+                "rtt_ms": self.rtt * ms, "rttvar_ms": self.rttvar * ms,
+                "rtt_min_ms": self.rtt_min * ms, "offset_ms": self.offset * ms}
+
+
+class InputShaper(object):
+    """ Thins a stream of axis speed samples down to the commands worth sending.
+
+    Speeds within `deadband` of zero count as zero, and the rest are
+    rounded to multiples of `step`. With `on_change`, a speed that matches
+    the last one sent is dropped. Sends are at least `min_interval` apart:
+    a change inside that window is held back and the latest value is sent
+    when it ends, so the last word always gets through. Zero (stop) never
+    waits. `clock` is anything with seconds() and callLater(), such as the
+    reactor or a task.Clock.
+    """
+    def __init__(self, send, deadband=0.0, step=0.0, min_interval=0.0, on_change=True,
+                 clock=reactor):
+        self.send = send
+        self.deadband = deadband
+        self.step = step
+        self.min_interval = min_interval
+        self.on_change = on_change
+        self.clock = clock
+        self.samples = 0
+        self.sent = 0
+        self.value = None # last speed sent
+        self.wanted = None # latest shaped sample
+        self._last = None # when value was sent
+        self._call = None # held-back send
+
+    def shape(self, speed):
+        if abs(speed) <= self.deadband:
+            return 0.0
+        if self.step:
+            speed = round(speed / self.step) * self.step
+        return float(speed)
+
+    def update(self, speed):
+        """ Take a new sample; returns True if it was sent straight away """
+        self.samples += 1
+        self.wanted = self.shape(speed)
+        if self.on_change and self.wanted == self.value:
+            self._cancel() # back where we were, nothing to send
+            return False
+        if self.wanted == 0:
+            self._flush() # a stop never waits, even behind a held-back send
+            return True
+        if self._call is not None:
+            return False # goes out with the held-back send
+        wait = 0.0
+        if self._last is not None:
+            wait = self._last + self.min_interval - self.clock.seconds()
+        if wait > 0:
+            self._call = self.clock.callLater(wait, self._flush)
+            return False
+        self._flush()
+        return True
+
+    def assume(self, value):
+        """ value went out some other way (e.g. a stop-all); start from it """
+        self._cancel()
+        self.value = self.wanted = value
+
+    def _cancel(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _flush(self):
+        self._cancel()
+        self.value = self.wanted
+        self._last = self.clock.seconds()
+        self.sent += 1
+        self.send(self.value)
+
+    def summary(self):
+        return {"samples": self.samples, "sent": self.sent,
+                "suppressed": self.samples - self.sent}
+
+
+class TurretClient(object):
+    """ A controller's connection to one turret (or one turret of a fleet).
+
+    Speed commands remember the latest intent per axis. They go out at once
+    when connected, and after a reconnect the session is resumed: the
+    control lease is taken back if we had it, telemetry is resubscribed
+    and the latest intent for each axis is sent again. Commands that need
+    an answer fail with NotConnected while the connection is down.
+    Keepalive pings go out every `keepalive` seconds; a ping not answered
+    within `timeout` drops the connection so the reconnect starts early.
+    """
+    keepalive = 1.0
+    timeout = 3.0
+
+    def __init__(self, host='127.0.0.1', port=8750, turret=None, clock=reactor.seconds):
+        self.host = host
+        self.port = port
+        self.turret = turret
+        self.clock = clock
+        self.protocol = None
+        self.link = LinkStats()
+        self.intent = {} # axis -> (command, arguments), resent on reconnect
+        self.has_control = False
+        self.telemetry = {} # latest fields from the server
+        self.on_telemetry = None # called with each frame's fields
+        self.shapers = {} # axis -> InputShaper
+        self._subscription = None # TelemetryCommand arguments, resent on reconnect
+        self._ping_loop = None
+        self._pinging = None # (sent, timeout call) for the ping in flight
+        endpoint = TCP4ClientEndpoint(reactor, host, port)
+        self.service = ClientService(endpoint, ClientFactory(self), retryPolicy=backoffPolicy(0.5, 15.0),
+                                     prepareConnection=self._connected)
+
+    def start(self):
+        """ Connect (and keep reconnecting); fires with self once connected """
+        self.service.startService()
+        return self.service.whenConnected().addCallback(lambda proto: self)
+
+    def stop(self):
+        self._stop_pinging()
+        return self.service.stopService()
+
+    def _connected(self, proto):
+        self.protocol = proto
+        self._ping_loop = task.LoopingCall(self.ping)
+        self._ping_loop.start(self.keepalive)
+        if self.has_control:
+            self.acquire_control()
+        if self._subscription is not None:
+            self._call(TelemetryCommand, **self._subscription)
+        for command, arguments in self.intent.values():
+            self._call(command, **arguments)
+
+    def _disconnected(self):
+        self.protocol = None
+        self._stop_pinging()
+
+    def _stop_pinging(self):
+        if self._ping_loop is not None and self._ping_loop.running:
+            self._ping_loop.stop()
+        self._ping_loop = None
+        if self._pinging is not None and self._pinging[1].active():
+            self._pinging[1].cancel()
+        self._pinging = None
+
+    def _call(self, command, **arguments):
+        if self.turret is not None and any(name == 'turret' for name, _ in command.arguments):
+            arguments['turret'] = self.turret
+        if self.protocol is None:
+            if command.requiresAnswer:
+                return defer.fail(NotConnected())
+            return None
+        return self.protocol.callRemote(command, **arguments)
+
+    def _intend(self, axis, command, **arguments):
+        self.intent[axis] = (command, arguments)
+        return self._call(command, **arguments)
+
+    ## Link measurement
+
+    def ping(self):
+        if self._pinging is not None:
+            return # still waiting on the last one
+        proto = self.protocol
+        sent = self.clock()
+        self._pinging = (sent, reactor.callLater(self.timeout, self._ping_timeout, proto))
+        d = proto.callRemote(KeepalivePing)
+        d.addCallback(self._pong, sent)
+        d.addErrback(lambda failure: None) # the connection went; _disconnected cleans up
+
+    def _pong(self, answer, sent):
+        received = self.clock()
+        if self._pinging is None or self._pinging[0] != sent:
+            return
+        self._pinging[1].cancel()
+        self._pinging = None
+        if answer.get('time') is not None:
+            self.link.add(sent, answer['time'], received)
+
+    def _ping_timeout(self, proto):
+        self._pinging = None
+        self.link.lost += 1
+        proto.transport.abortConnection()
+
+    def latency(self):
+        """ One way network latency estimate, in seconds (None until measured) """
+        if self.link.rtt is None:
+            return None
+        return self.link.rtt / 2.0
+
+    def to_local(self, server_time):
+        """ A server timestamp (e.g. a telemetry frame's) on our clock """
+        return server_time - (self.link.offset or 0.0)
+
+    ## Commands
+
+    def tilt(self, speed):
+        return self._intend('tilt', TiltCommand, speed=float(speed))
+
+    def stop_tilt(self):
+        return self._intend('tilt', StopTiltCommand)
+
+    def pan(self, speed):
+        return self._intend('pan', PanCommand, speed=float(speed))
+
+    def stop_pan(self):
+        return self._intend('pan', StopPanCommand)
+
+    def stop_all(self):
+        self.stop_tilt()
+        self.stop_pan()
+        for shaper in self.shapers.values():
+            shaper.assume(0.0)
+
+    def shaper(self, axis, **options):
+        """ An InputShaper feeding speed samples for axis ("tilt" or "pan")
+        to the turret; options as for InputShaper """
+        move, stop = getattr(self, axis), getattr(self, "stop_" + axis)
+        def send(speed):
+            if speed:
+                move(speed)
+            else:
+                stop()
+        shaper = self.shapers[axis] = InputShaper(send, **options)
+        return shaper
+
+    def shaping(self):
+        """ Per axis sample and suppression counts """
+        return dict((axis, shaper.summary()) for axis, shaper in self.shapers.items())
+
+    def fire(self):
+        return self._call(FireCommand)
+
+    def tilt_to(self, angle, speed=None, deadline=None):
+        self.intent.pop('tilt', None)
+        return self._call(TiltToCommand, angle=float(angle), speed=speed, deadline=deadline)
+
+    def pan_to(self, angle, speed=None, deadline=None):
+        self.intent.pop('pan', None)
+        return self._call(PanToCommand, angle=float(angle), speed=speed, deadline=deadline)
+
+    def aim(self, tilt, pan, tilt_speed=None, pan_speed=None, deadline=None):
+        self.intent.pop('tilt', None)
+        self.intent.pop('pan', None)
+        return self._call(AimCommand, tilt=float(tilt), pan=float(pan), tilt_speed=tilt_speed,
+                          pan_speed=pan_speed, deadline=deadline)
+
+    def acquire_control(self, lease=None):
+        def granted(answer):
+            self.has_control = answer['granted']
+            return answer['granted']
+        return self._call(AcquireControlCommand, lease=lease).addCallback(granted)
+
+    def release_control(self):
+        self.has_control = False
+        return self._call(ReleaseControlCommand)
+
+    def subscribe(self, rate=None, callback=None):
+        """ Keep self.telemetry up to date, calling callback(fields) per frame """
+        self._subscription = {"rate": rate} if rate is not None else {}
+        self.on_telemetry = callback
+        return self._call(TelemetryCommand, **self._subscription)
+
+    def _telemetry(self, fields):
+        self.telemetry.update(fields)
+        if self.on_telemetry is not None:
+            self.on_telemetry(fields)
+
+    def stats(self):
+        return self._call(StatsCommand)
+
+
+class ControlSender(DatagramProtocol):
+    """ Streams the current control state to the turret at a fixed rate """
+    def __init__(self, host, port, rate=50.0):
+        self.address = (host, port)
+        self.interval = 1.0 / rate
+        self.seq = 0
+        self.tilt = 0.0
+        self.pan = 0.0
+        self.fire = False
+        self.loop = task.LoopingCall(self.send)
+
+    def startProtocol(self):
+        self.loop.start(self.interval)
+
+    def stopProtocol(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def set(self, tilt=None, pan=None, fire=None):
+        if tilt is not None: self.tilt = tilt
+        if pan is not None: self.pan = pan
+        if fire is not None: self.fire = fire
+        self.send() # don't wait for the next tick to change state
+
+    def send(self):
+        self.seq += 1
+        packet = pack_control(self.seq, monotonic(), self.tilt, self.pan, self.fire)
+        self.transport.write(packet, self.address)
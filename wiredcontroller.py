@@ -1,26 +1,19 @@
 #!/usr/bin/env python
-import RPi.GPIO as GPIO
-
+## Wired Turret Controller
+# push buttons on the Pi's GPIO pins drive the turret directly
 from sys import stdout
 
 from turret import Turret, TestTurret
-from twisted.python.log import startLogging, err
-from twisted.internet import reactor, task
+from turret import backends
+from turret.buttons import Buttons
+from twisted.python.log import startLogging
+from twisted.internet import reactor
 
 import yaml
-config = yaml.load(open("wired_config.yml").read())
-pinconfig = config["pinconfig"]
-buttons = config["buttons"]
 
-def add_fn(pin, bounce, fn, release=None):
-    GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-    def call(ch):
-        if(GPIO.input(pin)):
-            fn()
-        else:
-            if release:
-                release()
-    GPIO.add_event_detect(pin, GPIO.BOTH, callback=call, bouncetime=bounce)
+def load_config(path):
+    with open(path) as f:
+        return yaml.safe_load(f)
 
 
 def main():
@@ -28,36 +21,51 @@ def main():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--test", action="store_false")
+    parser.add_argument("-b", "--backend", choices=backends.names(), default="real",
+                        help="where the buttons' GPIO comes from")
+    parser.add_argument("-c", "--config", default="wired_config.yml")
     args = parser.parse_args()
     
+    config = load_config(args.config)
+    pinconfig = config["pinconfig"]
+    pins = config["buttons"]
+    backend = backends.get(args.backend)
+    
     if args.test:
         turret = TestTurret()
     else:
-        turret = Turret()
+        turret = Turret(backend=backend)
     
-    GPIO.setmode(GPIO.BCM)
+    speeds = config.get("speeds", {})
+    tilt_speed = speeds.get("tilt", 45.0)
+    pan_speed = speeds.get("pan", 45.0)
+
     print("Running")
-    bounce = pinconfig["bouncetime"]
     def Up():
-        turret.tilt(45)
+        turret.tilt(tilt_speed)
     def Down():
-        turret.tilt(-45)
+        turret.tilt(-tilt_speed)
     def Left():
-        turret.pan_forever(-1)
+        turret.pan_at(-pan_speed)
     def Right():
-        turret.pan_forever(1)
+        turret.pan_at(pan_speed)
     
-    add_fn(buttons["up"], bounce, Up, turret.stop_tilt)
-    add_fn(buttons["down"], bounce, Down, turret.stop_tilt)
-    add_fn(buttons["left"], bounce, Left, turret.stop_pan)
-    add_fn(buttons["right"], bounce, Right, turret.stop_pan)
-    add_fn(buttons["fire"], bounce, turret.fire)
+    buttons = Buttons(backend.gpio())
+    options = {"pull": pinconfig.get("pinpull", "down"),
+               "debounce": pinconfig.get("debounce", 20) / 1000.0,
+               "bouncetime": pinconfig.get("bouncetime")}
+    buttons.add(pins["up"], Up, turret.stop_tilt, **options)
+    buttons.add(pins["down"], Down, turret.stop_tilt, **options)
+    buttons.add(pins["left"], Left, turret.stop_pan, **options)
+    buttons.add(pins["right"], Right, turret.stop_pan, **options)
+    buttons.add(pins["fire"], turret.fire, **options)
     
-    reactor.run()
+    try:
+        reactor.run()
+    finally:
+        print("buttons: {}".format(buttons.stats()))
+        backend.cleanup()
     
 
 if __name__ == "__main__":
-    try:
-        main()
-    finally:
-        GPIO.cleanup()
+    main()